@@ -1 +1 @@
-__all__ = ["gw_basicauth", "request_utils", "svc_mgr"]
\ No newline at end of file
+__all__ = ["gw_basicauth", "request_utils", "router", "svc_mgr"]
\ No newline at end of file
@@ -0,0 +1,145 @@
+# Standard Imports
+from collections import OrderedDict
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+class CredentialCache:
+    def __init__(self, cache_config: dict = None, invalidations = None) -> None:
+        '''
+        A bounded, least-recently-used cache of credential checks so that the
+        gateway does not have to ask the users service to verify the same
+        username and password on every request.
+        Takes an optional cache config object defined as:
+
+        {
+            "MAX_ENTRIES": <max_cached_credentials>,
+            "TTL": <seconds_a_successful_check_is_trusted>,
+            "NEGATIVE_TTL": <seconds_a_failed_check_is_trusted>,
+            "KEY": <secret_bytes_or_str_used_to_key_digests>
+        }
+
+        Credentials are never stored. Entries are keyed by an HMAC of the
+        username and password, using KEY or a random per-process key.
+
+        When several gateway processes each keep a cache, invalidations are
+        shared through a SharedInvalidations (see shared_state). An entry is
+        only trusted while its user's generation there is the one it was
+        stored with, so a password change seen by one process takes effect
+        in every process on their next lookup.
+        '''
+
+        cache_config = cache_config or {}
+        self.__max_entries = cache_config.get("MAX_ENTRIES", 10000)
+        self.__ttl = cache_config.get("TTL", 300)
+        self.__negative_ttl = cache_config.get("NEGATIVE_TTL", 5)
+        key = cache_config.get("KEY") or secrets.token_bytes(32)
+        self.__key = key.encode() if isinstance(key, str) else key
+        self.__shared = invalidations
+
+        # digest -> (verified, expires_at, user_digest, generation)
+        self.__entries = OrderedDict()
+        # user_digest -> set of digests, so all of a user's entries can be invalidated
+        self.__by_user = {}
+        self.__lock = threading.Lock()
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__invalidations = 0
+
+    def __digest(self, *parts: str) -> bytes:
+        msg = b'\0'.join(part.encode('utf-8') for part in parts)
+        return hmac.new(self.__key, msg, hashlib.sha256).digest()
+
+    def lookup(self, username: str, password: str):
+        ''' Returns True or False if the outcome of checking these credentials
+            is cached and still fresh, otherwise returns None. '''
+
+        digest = self.__digest('cred', username, password)
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(digest)
+            if entry is None:
+                self.__misses += 1
+                return None
+            verified, expires_at, user_digest, generation = entry
+            if expires_at <= now or generation != self.get_generation(username):
+                self.__discard(digest, user_digest)
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(digest)
+            self.__hits += 1
+            return verified
+
+    def get_generation(self, username: str) -> int:
+        ''' Returns the shared invalidation generation of the username, or
+            None if invalidations are not shared. '''
+        if self.__shared is None:
+            return None
+        return self.__shared.get_generation(username)
+
+    def store(self, username: str, password: str, verified: bool, generation: int = None) -> None:
+        ''' Remember the outcome of checking these credentials. Failed checks
+            are kept for NEGATIVE_TTL, successful ones for TTL. Pass the
+            generation from get_generation() taken before the check, so an
+            invalidation made while it ran is not missed. '''
+
+        digest = self.__digest('cred', username, password)
+        user_digest = self.__digest('user', username)
+        ttl = self.__ttl if verified else self.__negative_ttl
+        if ttl <= 0 or self.__max_entries <= 0:
+            return
+        if generation is None:
+            generation = self.get_generation(username)
+
+        with self.__lock:
+            self.__entries[digest] = (verified, time.monotonic() + ttl, user_digest, generation)
+            self.__entries.move_to_end(digest)
+            self.__by_user.setdefault(user_digest, set()).add(digest)
+            # Evict least recently used entries until we're back within bounds
+            while len(self.__entries) > self.__max_entries:
+                old_digest, (_, _, old_user, _) = self.__entries.popitem(last=False)
+                self.__discard_index(old_digest, old_user)
+                self.__evictions += 1
+
+    def invalidate(self, username: str) -> int:
+        ''' Drop every cached entry for the given username, e.g. after its
+            password changes, in this process and, if invalidations are
+            shared, in every other. Returns the number of entries dropped here. '''
+
+        if self.__shared is not None:
+            self.__shared.increment(username)
+        user_digest = self.__digest('user', username)
+        with self.__lock:
+            digests = self.__by_user.pop(user_digest, set())
+            for digest in digests:
+                self.__entries.pop(digest, None)
+            self.__invalidations += len(digests)
+            return len(digests)
+
+    def get_stats(self) -> dict:
+        ''' Returns the hit/miss counters and current size of the cache. '''
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+                'invalidations': self.__invalidations,
+                'entries': len(self.__entries),
+                'max_entries': self.__max_entries,
+            }
+
+    # Both helpers below expect the lock to already be held
+    def __discard(self, digest: bytes, user_digest: bytes) -> None:
+        self.__entries.pop(digest, None)
+        self.__discard_index(digest, user_digest)
+
+    def __discard_index(self, digest: bytes, user_digest: bytes) -> None:
+        digests = self.__by_user.get(user_digest)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self.__by_user[user_digest]
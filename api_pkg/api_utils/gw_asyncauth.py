@@ -0,0 +1,144 @@
+# Standard Imports
+import asyncio
+import logging
+import time
+
+# Third-Party Imports
+import aiohttp
+from aiohttp import web
+from flask_api import status
+
+# Local Imports
+from .cred_cache import CredentialCache
+from .gw_basicauth import INVALIDATE_HEADER, AuthUnavailable, unavailable_response
+from .metrics import GatewayMetrics
+from .shared_state import open_invalidations
+from .tracing import forward_headers, get_current, record_phase
+from .svc_mgr import MicroServiceManager
+
+logger = logging.getLogger(__name__)
+
+class AsyncGatewayBasicAuth:
+    # The asyncio counterpart of GatewayBasicAuth. auth_exclude should be a
+    # set of paths that are public and do not require authorization
+    def __init__(self, auth_config: dict, svc_mgr: MicroServiceManager, realm: str = '',
+                 metrics: GatewayMetrics = None, state_config: dict = None) -> None:
+        self.__auth_exclude = auth_config['EXCLUDE']
+        self.__auth_url = auth_config['AUTH_URL']
+        self.__auth_svc = auth_config['AUTH_SVC']
+        self.__svc_mgr = svc_mgr
+        self.__realm = realm
+        # Gateway processes sharing a state file also share credential invalidations
+        self.__cred_cache = CredentialCache(auth_config.get('CACHE'), open_invalidations(state_config))
+        self.__metrics = metrics
+
+    async def authenticate(self, request: web.Request, client: aiohttp.ClientSession) -> bool:
+        ''' Returns True if the request is for a public path or carries valid
+            basic auth credentials. Raises AuthUnavailable if the credentials
+            could not be checked. '''
+
+        # Public paths are always accessible, see GatewayBasicAuth.authenticate
+        if request.path in self.__auth_exclude:
+            return True
+
+        auth = get_authorization(request)
+        return (
+            auth is not None and
+            await self.check_credentials(client, auth.login, auth.password)
+        )
+
+    async def check_credentials(self, client: aiohttp.ClientSession, username: str, password: str) -> bool:
+        ''' Check the credentials against the cache, then against the users microservice. '''
+        started = time.perf_counter()
+        verified = self.__cred_cache.lookup(username, password)
+        source = 'cache'
+        if verified is None:
+            verified = await self.verify_upstream(client, username, password)
+            source = 'upstream'
+        seconds = time.perf_counter() - started
+        if self.__metrics is not None:
+            self.__metrics.observe_auth(source, verified, seconds)
+        record_phase('auth', seconds, source)
+        return verified
+
+    async def verify_upstream(self, client: aiohttp.ClientSession, username: str, password: str) -> bool:
+        ''' Ask the users microservice to verify the credentials and cache the
+            outcome. Raises AuthUnavailable if it could not tell whether they
+            are valid. '''
+        port = self.__svc_mgr.get_worker(self.__auth_svc)
+        if port == -1:
+            raise AuthUnavailable()
+
+        request_url = self.__svc_mgr.get_worker_url(port) + self.__auth_url
+        # Taken first, so a password change made during the check drops its outcome
+        generation = self.__cred_cache.get_generation(username)
+        self.__svc_mgr.begin_request(self.__auth_svc, port)
+        started = time.perf_counter()
+        latency = None
+        try:
+            async with client.post(
+                request_url,
+                data={'username': username, 'password': password},
+                headers=forward_headers({}, get_current()),
+            ) as response:
+                await response.read()
+                latency = time.perf_counter() - started
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # See GatewayBasicAuth.verify_upstream
+            logger.warning('Checking credentials on %s failed: %r', request_url, e)
+            self.__svc_mgr.report_failure(self.__auth_svc, port)
+            raise AuthUnavailable() from e
+        finally:
+            self.__svc_mgr.end_request(self.__auth_svc, port, latency)
+            if self.__metrics is not None:
+                status_code = response.status if latency is not None else None
+                self.__metrics.observe_upstream(self.__auth_svc, port, status_code, latency)
+        if response.status >= 500:
+            self.__svc_mgr.report_failure(self.__auth_svc, port)
+        else:
+            self.__svc_mgr.report_success(self.__auth_svc, port)
+
+        if response.status == status.HTTP_200_OK:
+            self.__cred_cache.store(username, password, True, generation)
+            return True
+        if response.status == status.HTTP_401_UNAUTHORIZED:
+            self.__cred_cache.store(username, password, False, generation)
+            return False
+        # An unavailable or failing worker is not a rejection, and is not cached
+        raise AuthUnavailable(response.headers.get('Retry-After'))
+
+    def challenge(self) -> web.Response:
+        ''' Challenge the client for a username and password. '''
+        return web.Response(
+            status=status.HTTP_401_UNAUTHORIZED,
+            headers={'WWW-Authenticate': 'Basic realm="%s"' % self.__realm},
+        )
+
+    def unavailable(self, error: AuthUnavailable) -> web.Response:
+        ''' Tell the client its credentials could not be checked, see unavailable_response. '''
+        body, status_code, headers = unavailable_response(error)
+        return web.json_response(body, status=status_code, headers=headers)
+
+    def handle_upstream_headers(self, service_type: str, headers) -> None:
+        ''' Drop cached credentials named by the auth service in INVALIDATE_HEADER,
+            then remove that header so it is not passed on to the client. '''
+
+        username = headers.pop(INVALIDATE_HEADER, None)
+        if username is not None and service_type == self.__auth_svc:
+            self.__cred_cache.invalidate(username)
+
+    def get_cache_stats(self) -> dict:
+        ''' Returns the hit/miss counters of the credential cache. '''
+        return self.__cred_cache.get_stats()
+
+def get_authorization(request: web.Request):
+    ''' Returns the request's basic auth credentials as an aiohttp.BasicAuth,
+        or None if there are none or they can't be decoded. '''
+
+    header = request.headers.get('Authorization')
+    if header is None:
+        return None
+    try:
+        return aiohttp.BasicAuth.decode(header)
+    except ValueError:
+        return None
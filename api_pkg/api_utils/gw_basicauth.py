@@ -1,3 +1,8 @@
+# Standard Imports
+from functools import wraps
+import logging
+import time
+
 # Third-Party Imports
 from flask import Flask, request
 from flask_api import status
@@ -5,18 +10,63 @@ from flask_basicauth import BasicAuth
 import requests
 
 # Local Imports
+from .cred_cache import CredentialCache
+from .metrics import GatewayMetrics
+from .shared_state import open_invalidations
+from .tracing import forward_headers, get_current, record_phase
 from .svc_mgr import MicroServiceManager
 
+# Response header the auth service sets to make the gateway forget cached
+# credentials for a username, e.g. after the user's password changes
+INVALIDATE_HEADER = 'X-Invalidate-Credentials'
+
+logger = logging.getLogger(__name__)
+
+class AuthUnavailable(Exception):
+    ''' The users microservice could not check the credentials, e.g. because
+        it is busy hashing other passwords. retry_after is its Retry-After
+        header, or None if it sent none. '''
+
+    def __init__(self, retry_after: str = None) -> None:
+        super().__init__('Credentials could not be checked')
+        self.retry_after = retry_after
+
+def unavailable_response(error: AuthUnavailable) -> tuple:
+    ''' Returns the body, status and headers of the 503 response to a request
+        whose credentials could not be checked. '''
+    headers = {'Retry-After': error.retry_after} if error.retry_after is not None else {}
+    return {
+        'message': 'Credentials could not be checked, try again shortly.'
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, headers
+
 class GatewayBasicAuth(BasicAuth):
     # auth_exclude should be a set of paths that are public
     # and do not require authorization
-    def __init__(self, app: Flask, auth_config: dict, upstream: str, svc_mgr: MicroServiceManager) -> None:
+    def __init__(self, app: Flask, auth_config: dict, upstream: str, svc_mgr: MicroServiceManager,
+                 metrics: GatewayMetrics = None, state_config: dict = None) -> None:
         super().__init__(app=app)
         self.__auth_exclude = auth_config['EXCLUDE']
         self.__auth_url = auth_config['AUTH_URL']
         self.__auth_svc = auth_config['AUTH_SVC']
         self.__upstream = upstream
         self.__svc_mgr = svc_mgr
+        # Gateway processes sharing a state file also share credential invalidations
+        self.__cred_cache = CredentialCache(auth_config.get('CACHE'), open_invalidations(state_config))
+        self.__metrics = metrics
+
+    # Override required so that a request whose credentials could not be
+    # checked gets a 503, not a challenge to send other ones
+    def required(self, view_func):
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            try:
+                verified = self.authenticate()
+            except AuthUnavailable as e:
+                return unavailable_response(e)
+            if verified:
+                return view_func(*args, **kwargs)
+            return self.challenge()
+        return wrapper
 
     # Override authenticate so that certain urls can be excluded from authentication.
     def authenticate(self) -> bool:
@@ -33,19 +83,77 @@ class GatewayBasicAuth(BasicAuth):
             self.check_credentials(auth.username, auth.password)
         )
 
-    # Override check_credentials to authenticate with the users microservice
+    # Override check_credentials to authenticate with the users microservice,
+    # unless the outcome of checking these credentials is already cached
     def check_credentials(self, username, password) -> bool:
+        started = time.perf_counter()
+        verified = self.__cred_cache.lookup(username, password)
+        source = 'cache'
+        if verified is None:
+            verified = self.verify_upstream(username, password)
+            source = 'upstream'
+        seconds = time.perf_counter() - started
+        if self.__metrics is not None:
+            self.__metrics.observe_auth(source, verified, seconds)
+        record_phase('auth', seconds, source)
+        return verified
+
+    # Ask the users microservice to verify the credentials and cache the outcome.
+    # Raises AuthUnavailable if it could not tell whether they are valid.
+    def verify_upstream(self, username, password) -> bool:
         port = self.__svc_mgr.get_worker(self.__auth_svc)
         if port == -1:
-            return False
+            raise AuthUnavailable()
         else:
-            request_url = self.__upstream + ':' + str(port) + self.__auth_url
+            request_url = self.__svc_mgr.get_worker_url(port) + self.__auth_url
+
+        # Taken first, so a password change made during the check drops its outcome
+        generation = self.__cred_cache.get_generation(username)
+        # Reuse the worker's keep-alive session instead of opening a new connection
+        self.__svc_mgr.begin_request(self.__auth_svc, port)
+        latency = None
+        try:
+            response = self.__svc_mgr.get_session(port).request(
+                'POST', request_url, 
+                data = {'username':username, 'password':password},
+                headers=forward_headers({}, get_current()),
+                timeout=self.__svc_mgr.get_timeout(),
+            )
+            latency = response.elapsed.total_seconds()
+        except requests.exceptions.RequestException as e:
+            # A worker that can't be reached counts against its breaker, like
+            # one proxied to, so it stops being asked
+            logger.warning('Checking credentials on %s failed: %r', request_url, e)
+            self.__svc_mgr.report_failure(self.__auth_svc, port)
+            raise AuthUnavailable() from e
+        finally:
+            self.__svc_mgr.end_request(self.__auth_svc, port, latency)
+            if self.__metrics is not None:
+                status_code = response.status_code if latency is not None else None
+                self.__metrics.observe_upstream(self.__auth_svc, port, status_code, latency)
+        if response.status_code >= 500:
+            self.__svc_mgr.report_failure(self.__auth_svc, port)
+        else:
+            self.__svc_mgr.report_success(self.__auth_svc, port)
 
-        response = requests.request(
-            'POST', request_url, 
-            data = {'username':username, 'password':password}
-        )
         if response.status_code == status.HTTP_200_OK:
+            self.__cred_cache.store(username, password, True, generation)
             return True
+        elif response.status_code == status.HTTP_401_UNAUTHORIZED:
+            self.__cred_cache.store(username, password, False, generation)
+            return False
         else:
-            return False
\ No newline at end of file
+            # An unavailable or failing worker is not a rejection, and is not cached
+            raise AuthUnavailable(response.headers.get('Retry-After'))
+
+    def handle_upstream_headers(self, service_type: str, headers) -> None:
+        ''' Drop cached credentials named by the auth service in INVALIDATE_HEADER,
+            then remove that header so it is not passed on to the client. '''
+
+        username = headers.pop(INVALIDATE_HEADER, None)
+        if username is not None and service_type == self.__auth_svc:
+            self.__cred_cache.invalidate(username)
+
+    def get_cache_stats(self) -> dict:
+        ''' Returns the hit/miss counters of the credential cache. '''
+        return self.__cred_cache.get_stats()
\ No newline at end of file
@@ -0,0 +1,164 @@
+# Standard Imports
+import logging
+import threading
+import time
+
+# Third-Party Imports
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 1, success_threshold: int = 1, open_interval: float = 10) -> None:
+        '''
+        Tracks whether a single worker should receive traffic.
+
+        A closed breaker lets traffic through. After failure_threshold consecutive
+        failures it opens and the worker is taken out of its pool. Once an open
+        breaker has waited open_interval seconds, a successful health check moves
+        it to half-open and the worker is re-admitted on trial. success_threshold
+        consecutive successes close it again, and any failure re-opens it.
+        '''
+
+        self.__failure_threshold = max(1, failure_threshold)
+        self.__success_threshold = max(1, success_threshold)
+        self.__open_interval = open_interval
+        self.__state = CLOSED
+        self.__failures = 0
+        self.__successes = 0
+        self.__changed_at = time.monotonic()
+
+    def get_state(self) -> str:
+        ''' Returns one of CLOSED, OPEN or HALF_OPEN. '''
+        return self.__state
+
+    def is_settled(self) -> bool:
+        ''' Returns True if the breaker is closed with no failures counted,
+            so a success would not change anything. '''
+        return self.__state == CLOSED and self.__failures == 0
+
+    def record_failure(self) -> str:
+        ''' Count a failed request or health check. Returns the new state. '''
+        if self.__state == OPEN:
+            # A failed trial restarts the wait before the next one
+            self.__changed_at = time.monotonic()
+            return self.__state
+        self.__failures += 1
+        if self.__state == HALF_OPEN or self.__failures >= self.__failure_threshold:
+            self.__set_state(OPEN)
+        return self.__state
+
+    def record_success(self) -> str:
+        ''' Count a successful request or health check. Returns the new state. '''
+        if self.__state == CLOSED:
+            self.__failures = 0
+            return self.__state
+        if self.__state == OPEN:
+            self.__set_state(HALF_OPEN)
+        self.__successes += 1
+        if self.__successes >= self.__success_threshold:
+            self.__set_state(CLOSED)
+        return self.__state
+
+    def force_open(self) -> str:
+        ''' Open the breaker regardless of the failure count. Returns the new state. '''
+        self.__set_state(OPEN)
+        return self.__state
+
+    def force_close(self) -> str:
+        ''' Close the breaker regardless of the success count. Returns the new state. '''
+        self.__set_state(CLOSED)
+        return self.__state
+
+    def ready_for_trial(self) -> bool:
+        ''' Returns True if the breaker is open and has waited long enough
+            to have the worker checked again. '''
+        return (
+            self.__state == OPEN and
+            time.monotonic() - self.__changed_at >= self.__open_interval
+        )
+
+    def to_dict(self) -> dict:
+        ''' Returns a dictionary representation of the breaker. '''
+        return {
+            'state': self.__state,
+            'failures': self.__failures,
+            'successes': self.__successes,
+            'since': round(time.monotonic() - self.__changed_at, 3),
+        }
+
+    def __set_state(self, state: str) -> None:
+        if state != self.__state:
+            self.__state = state
+            self.__changed_at = time.monotonic()
+            self.__failures = 0
+            self.__successes = 0
+
+class HealthChecker:
+    def __init__(self, svc_mgr, health_config: dict = None) -> None:
+        '''
+        Probes workers in the background and reports the results to the
+        service manager, so that workers taken out of their pool are re-admitted
+        once they recover. Takes an optional health config object defined as:
+
+        {
+            "ENABLED": <whether_to_run_the_checker>,
+            "INTERVAL": <seconds_between_rounds_of_checks>,
+            "TIMEOUT": <seconds_to_wait_for_a_health_check>
+        }
+
+        Breaker thresholds from the same config are applied by the service manager.
+        '''
+
+        health_config = health_config or {}
+        self.__svc_mgr = svc_mgr
+        self.__enabled = health_config.get("ENABLED", True)
+        self.__interval = health_config.get("INTERVAL", 5)
+        self.__timeout = health_config.get("TIMEOUT", 1)
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self) -> None:
+        ''' Start checking workers on a daemon thread, if enabled. '''
+        if not self.__enabled or self.__thread is not None:
+            return
+        self.__thread = threading.Thread(target=self.__run, name='health-checker', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        ''' Stop checking workers and wait for the current round to finish. '''
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def check_all(self) -> None:
+        ''' Run one round of health checks on every worker that is due one. '''
+        for service_key, port in self.__svc_mgr.get_probe_targets():
+            if self.probe(service_key, port):
+                self.__svc_mgr.report_success(service_key, port)
+            else:
+                self.__svc_mgr.report_failure(service_key, port)
+
+    def probe(self, service_key: str, port: int) -> bool:
+        ''' Returns True if the worker answered its health check with a non-5xx status. '''
+        url = self.__svc_mgr.get_worker_url(port) + self.__svc_mgr.get_health_path(service_key)
+        try:
+            response = self.__svc_mgr.get_session(port).get(url, timeout=self.__timeout)
+            response.close()
+        except requests.exceptions.RequestException:
+            return False
+        return response.status_code < 500
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.__interval):
+            try:
+                self.check_all()
+            except Exception:
+                # Never let one bad round stop the checker
+                logger.exception('Health check round failed')
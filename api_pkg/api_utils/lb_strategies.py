@@ -0,0 +1,161 @@
+# Standard Imports
+import itertools
+import math
+import random
+import threading
+import time
+
+# Strategies are called by many request threads at once without a lock, and
+# the pool they are given is an immutable snapshot. Their own state is either
+# an itertools.count, whose next() is atomic, or guarded by a lock of their own.
+
+class InstanceStats:
+    def __init__(self, decay_time: float = 10) -> None:
+        '''
+        Live load figures for one instance, recorded by the gateway as it
+        proxies requests.
+
+        in_flight is the number of requests currently sent to the instance.
+        ewma is a peak-sensitive moving average of its latency in seconds: a
+        slower response is taken as-is, while faster ones pull the average down
+        with a time constant of decay_time seconds. get_ewma() also lets it decay
+        while the instance gets no traffic, so a slow instance is tried again.
+        '''
+
+        self.__decay_time = decay_time
+        self.in_flight = 0
+        self.ewma = 0.0
+        self.samples = 0
+        self.__updated_at = time.monotonic()
+        # Only held to update the figures of this one instance. Strategies
+        # read them without it, so they may see a value one update behind.
+        self.__lock = threading.Lock()
+
+    def begin_request(self) -> None:
+        ''' Count a request to the instance as in flight. '''
+        with self.__lock:
+            self.in_flight += 1
+
+    def end_request(self, latency: float = None) -> None:
+        ''' Count a request to the instance as finished, and fold its
+            latency in seconds into the moving average if given. '''
+        with self.__lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            if latency is not None:
+                self.__record_latency(latency)
+
+    def __record_latency(self, seconds: float) -> None:
+        now = time.monotonic()
+        if self.samples == 0 or seconds > self.ewma:
+            self.ewma = seconds
+        else:
+            weight = math.exp(-(now - self.__updated_at) / self.__decay_time)
+            self.ewma = self.ewma * weight + seconds * (1 - weight)
+        self.samples += 1
+        self.__updated_at = now
+
+    def get_ewma(self) -> float:
+        ''' Returns the moving average latency, decayed for the time since the last sample. '''
+        idle = time.monotonic() - self.__updated_at
+        return self.ewma * math.exp(-idle / self.__decay_time)
+
+    def to_dict(self) -> dict:
+        ''' Returns a dictionary representation of the stats. '''
+        return {
+            'in_flight': self.in_flight,
+            'ewma_ms': round(self.get_ewma() * 1000, 3),
+            'samples': self.samples,
+        }
+
+class RoundRobin:
+    ''' Hands out instances in turn. '''
+
+    def __init__(self, svc_cfg: dict) -> None:
+        self.__counter = itertools.count()
+
+    def choose(self, pool: tuple, stats: dict) -> int:
+        # The pool can shrink between calls, so wrap the index here
+        return pool[next(self.__counter) % len(pool)]
+
+class LeastOutstanding:
+    ''' Picks the instance with the fewest requests in flight. Ties are
+        broken in turn so idle instances share the load. '''
+
+    def __init__(self, svc_cfg: dict) -> None:
+        self.__counter = itertools.count()
+
+    def choose(self, pool: tuple, stats: dict) -> int:
+        start = next(self.__counter) % len(pool)
+        rotated = pool[start:] + pool[:start]
+        return min(rotated, key=lambda port: stats[port].in_flight)
+
+class PeakEwma:
+    ''' Picks the instance with the lowest expected wait: its peak-EWMA
+        latency scaled by the requests already in flight to it. '''
+
+    def __init__(self, svc_cfg: dict) -> None:
+        self.__counter = itertools.count()
+
+    def choose(self, pool: tuple, stats: dict) -> int:
+        start = next(self.__counter) % len(pool)
+        rotated = pool[start:] + pool[:start]
+        return min(rotated, key=lambda port: stats[port].get_ewma() * (stats[port].in_flight + 1))
+
+class PowerOfTwoChoices:
+    ''' Picks two instances at random and keeps the less loaded one, by
+        requests in flight and then by latency. '''
+
+    def __init__(self, svc_cfg: dict) -> None:
+        pass
+
+    def choose(self, pool: tuple, stats: dict) -> int:
+        if len(pool) == 1:
+            return pool[0]
+        first, second = random.sample(pool, 2)
+        return min(
+            (first, second),
+            key=lambda port: (stats[port].in_flight, stats[port].get_ewma()),
+        )
+
+class WeightedRoundRobin:
+    ''' Hands out instances in turn, in proportion to the "WEIGHTS" given
+        for their ports (default 1). Uses smooth weighted round-robin so
+        heavier instances are interleaved rather than picked in bursts.
+        This is the only strategy that takes a lock to choose. '''
+
+    def __init__(self, svc_cfg: dict) -> None:
+        self.__weights = svc_cfg.get("WEIGHTS", {})
+        self.__current = {}
+        self.__lock = threading.Lock()
+
+    def choose(self, pool: tuple, stats: dict) -> int:
+        with self.__lock:
+            total = 0
+            best = None
+            for port in pool:
+                weight = self.__weights.get(port, 1)
+                total += weight
+                self.__current[port] = self.__current.get(port, 0) + weight
+                if best is None or self.__current[port] > self.__current[best]:
+                    best = port
+            self.__current[best] -= total
+            return best
+
+STRATEGIES = {
+    'round_robin': RoundRobin,
+    'least_outstanding': LeastOutstanding,
+    'peak_ewma': PeakEwma,
+    'power_of_two': PowerOfTwoChoices,
+    'weighted_round_robin': WeightedRoundRobin,
+}
+
+def make_strategy(svc_cfg: dict):
+    ''' Create the load balancing strategy named by "STRATEGY" in a service's
+        config, round-robin by default. '''
+
+    name = svc_cfg.get("STRATEGY", 'round_robin')
+    if name not in STRATEGIES:
+        raise ValueError(
+            'Unknown load balancing strategy ' + repr(name) + ', expected one of ' + ', '.join(STRATEGIES)
+        )
+    return STRATEGIES[name](svc_cfg)
@@ -0,0 +1,320 @@
+# Standard Imports
+from bisect import bisect_left
+import math
+import threading
+import weakref
+
+# Local Imports
+from .health import OPEN
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Content-Type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Methods get their own label value, anything else is counted as "other"
+KNOWN_METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'})
+
+# Status classes by the first digit of the status code
+STATUS_CLASSES = ('0xx', '1xx', '2xx', '3xx', '4xx', '5xx')
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        '''
+        Counters and histograms that request threads record into without
+        taking a lock.
+
+        Each thread records into a shard of its own, a dict of cells keyed by
+        metric and label values, which no other thread writes to. render()
+        adds the shards up, so a scrape may see a histogram's count a request
+        ahead of its sum, but no update is ever lost. Once a thread exits its
+        shard is folded into the totals of finished threads, so servers that
+        start a thread per connection don't collect shards.
+        '''
+
+        self.__metrics = []
+        self.__local = threading.local()
+        # (weak reference to the thread, its shard) for every thread that recorded
+        self.__shards = []
+        self.__finished = {}
+        # Taken when a thread records for the first time and when rendering,
+        # never when recording
+        self.__lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> 'Counter':
+        return self.__register(Counter(self, name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets=DEFAULT_BUCKETS) -> 'Histogram':
+        return self.__register(Histogram(self, name, help_text, labelnames, buckets))
+
+    def callback(self, name: str, help_text: str, labelnames: tuple, collect, kind: str = 'gauge') -> 'Callback':
+        ''' Register a metric whose values are read when rendering, by calling
+            collect() for (label values, value) pairs. For figures that are
+            already kept elsewhere, like requests in flight. '''
+        return self.__register(Callback(name, help_text, labelnames, collect, kind))
+
+    def get_shard(self) -> dict:
+        ''' Returns the shard of the calling thread. '''
+        try:
+            return self.__local.shard
+        except AttributeError:
+            shard = self.__local.shard = {}
+            with self.__lock:
+                self.__fold_finished()
+                self.__shards.append((weakref.ref(threading.current_thread()), shard))
+            return shard
+
+    def render(self) -> str:
+        ''' Returns every metric in the Prometheus text exposition format. '''
+        with self.__lock:
+            self.__fold_finished()
+            totals = {}
+            add_cells(totals, self.__finished)
+            for _, shard in self.__shards:
+                # Copying a dict happens in one step under the GIL, so the
+                # owner adding a cell meanwhile can't break the iteration
+                add_cells(totals, shard.copy())
+
+        by_metric = {}
+        for (metric, labels), cell in totals.items():
+            by_metric.setdefault(metric, {})[labels] = cell
+        lines = []
+        for metric in self.__metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.render(by_metric.get(metric, {})))
+        return '\n'.join(lines) + '\n'
+
+    def __register(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    # Expects the lock to already be held
+    def __fold_finished(self) -> None:
+        live = []
+        for thread_ref, shard in self.__shards:
+            thread = thread_ref()
+            if thread is not None and thread.is_alive():
+                live.append((thread_ref, shard))
+            else:
+                # The thread is gone, so nothing writes to its shard anymore
+                add_cells(self.__finished, shard)
+        self.__shards = live
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, registry: MetricsRegistry, name: str, help_text: str, labelnames: tuple) -> None:
+        self.__registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        ''' Add amount to the counter with the given label values. '''
+        shard = self.__registry.get_shard()
+        key = (self, labels)
+        cell = shard.get(key)
+        if cell is None:
+            cell = shard[key] = [0]
+        cell[0] += amount
+
+    def render(self, series: dict) -> list:
+        return [
+            '%s%s %s' % (self.name, format_labels(self.labelnames, labels), format_value(cell[0]))
+            for labels, cell in sorted(series.items())
+        ]
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, registry: MetricsRegistry, name: str, help_text: str, labelnames: tuple, buckets) -> None:
+        self.__registry = registry
+        self.__bounds = tuple(sorted(buckets))
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+
+    def observe(self, labels: tuple, value: float) -> None:
+        ''' Count value into its bucket of the histogram with the given label values. '''
+        shard = self.__registry.get_shard()
+        key = (self, labels)
+        cell = shard.get(key)
+        if cell is None:
+            # A count for each bucket, one for above the last, then the sum
+            cell = shard[key] = [0] * (len(self.__bounds) + 2)
+        cell[bisect_left(self.__bounds, value)] += 1
+        cell[-1] += value
+
+    def render(self, series: dict) -> list:
+        lines = []
+        names = self.labelnames + ('le',)
+        for labels, cell in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.__bounds + (math.inf,), cell):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(names, labels + (bound,)), cumulative))
+            label_text = format_labels(self.labelnames, labels)
+            lines.append('%s_sum%s %s' % (self.name, label_text, format_value(cell[-1])))
+            lines.append('%s_count%s %d' % (self.name, label_text, cumulative))
+        return lines
+
+class Callback:
+    def __init__(self, name: str, help_text: str, labelnames: tuple, collect, kind: str) -> None:
+        self.__collect = collect
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.kind = kind
+
+    def render(self, series: dict) -> list:
+        return [
+            '%s%s %s' % (self.name, format_labels(self.labelnames, labels), format_value(value))
+            for labels, value in sorted(self.__collect())
+        ]
+
+class GatewayMetrics:
+    def __init__(self, svc_mgr, metrics_config: dict = None) -> None:
+        '''
+        The metrics recorded by the gateways. Takes an optional metrics
+        config object defined as:
+
+        {
+            "PATH": <path_the_metrics_are_served_on_without_auth, or_None>,
+            "BUCKETS": [<upper_bound_of_a_latency_bucket_in_seconds>, ...]
+        }
+
+        Requests are counted by the route they matched, not by their path,
+        so the number of series stays bounded. Requests in flight and pool
+        sizes are read from the service manager when the metrics are rendered.
+        '''
+
+        metrics_config = metrics_config or {}
+        self.__svc_mgr = svc_mgr
+        self.__path = metrics_config.get("PATH", '/metrics')
+        buckets = metrics_config.get("BUCKETS", DEFAULT_BUCKETS)
+
+        self.registry = MetricsRegistry()
+        self.__requests = self.registry.counter(
+            'gateway_requests_total', 'Requests answered by the gateway, by route and status class.',
+            ('service', 'route', 'method', 'code'),
+        )
+        self.__durations = self.registry.histogram(
+            'gateway_request_duration_seconds', 'Time until the gateway had the response headers ready, by route.',
+            ('service', 'route'), buckets,
+        )
+        self.__upstream_requests = self.registry.counter(
+            'gateway_upstream_requests_total', 'Requests sent to each instance, by status class, or "error" if none came back.',
+            ('service', 'instance', 'code'),
+        )
+        self.__upstream_latency = self.registry.histogram(
+            'gateway_upstream_latency_seconds', 'Time until an instance sent its response headers.',
+            ('service', 'instance'), buckets,
+        )
+        self.__retries = self.registry.counter(
+            'gateway_retries_total', 'Requests sent again to another instance after a failure ("retry") or because the first was slow ("hedge"), and ones the retry budget refused.',
+            ('service', 'kind', 'result'),
+        )
+        self.__auth = self.registry.histogram(
+            'gateway_auth_duration_seconds', 'Time spent checking credentials, by where the outcome came from.',
+            ('source', 'result'), buckets,
+        )
+        self.registry.callback(
+            'gateway_upstream_in_flight', 'Requests sent to each instance and not yet finished.',
+            ('service', 'instance'), self.__collect_in_flight,
+        )
+        self.registry.callback(
+            'gateway_pool_instances', 'Instances of each service in its pool, taking requests.',
+            ('service',), self.__collect_pool_sizes,
+        )
+        self.registry.callback(
+            'gateway_connections_idle', 'Idle keep-alive connections to each instance.',
+            ('service', 'instance'), lambda: self.__collect_connections('idle'),
+        )
+        self.registry.callback(
+            'gateway_connections_opened_total', 'Keep-alive connections opened to each instance.',
+            ('service', 'instance'), lambda: self.__collect_connections('connections_opened'), kind='counter',
+        )
+
+    def get_path(self) -> str:
+        ''' Returns the path the metrics are served on, or None. '''
+        return self.__path
+
+    def observe_request(self, service: str, route: str, method: str, status_code: int, seconds: float) -> None:
+        ''' Record a request answered by the gateway. '''
+        if method not in KNOWN_METHODS:
+            method = 'other'
+        self.__requests.inc((service, route, method, status_class(status_code)))
+        self.__durations.observe((service, route), seconds)
+
+    def observe_upstream(self, service: str, port: int, status_code: int = None, seconds: float = None) -> None:
+        ''' Record a request sent to an instance, with no status code if it failed. '''
+        instance = str(port)
+        self.__upstream_requests.inc((service, instance, 'error' if status_code is None else status_class(status_code)))
+        if seconds is not None:
+            self.__upstream_latency.observe((service, instance), seconds)
+
+    def observe_retry(self, service: str, kind: str, sent: bool = True) -> None:
+        ''' Record a "retry" or "hedge" sent, or refused by the retry budget. '''
+        self.__retries.inc((service, kind, 'sent' if sent else 'denied'))
+
+    def observe_auth(self, source: str, allowed: bool, seconds: float) -> None:
+        ''' Record a credential check answered from "cache" or "upstream". '''
+        self.__auth.observe((source, 'allowed' if allowed else 'denied'), seconds)
+
+    def render(self) -> str:
+        return self.registry.render()
+
+    def __collect_in_flight(self) -> list:
+        return [
+            ((svc_key, str(port)), stats['in_flight'])
+            for svc_key, instances in self.__svc_mgr.get_load_stats().items()
+            for port, stats in instances.items()
+        ]
+
+    def __collect_pool_sizes(self) -> list:
+        return [
+            ((svc_key, ), sum(1 for state in instances.values() if state['state'] != OPEN))
+            for svc_key, instances in self.__svc_mgr.get_pools().items()
+        ]
+
+    def __collect_connections(self, field: str) -> list:
+        return [
+            ((svc_key, str(port)), stats[field])
+            for svc_key, instances in self.__svc_mgr.get_pool_stats().items()
+            for port, stats in instances.items()
+        ]
+
+def add_cells(totals: dict, shard: dict) -> None:
+    ''' Add the cells of a shard into totals. '''
+    for key, cell in shard.items():
+        values = list(cell)
+        total = totals.get(key)
+        if total is None:
+            totals[key] = values
+        else:
+            for i, value in enumerate(values):
+                total[i] += value
+
+def status_class(status_code: int) -> str:
+    index = status_code // 100
+    return STATUS_CLASSES[index] if 0 <= index < len(STATUS_CLASSES) else 'other'
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value)) for name, value in zip(names, values))
+
+def escape_label(value) -> str:
+    if isinstance(value, float):
+        return format_value(value)
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if value.is_integer():
+            return str(int(value))
+    return repr(value)
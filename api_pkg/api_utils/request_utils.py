@@ -6,6 +6,18 @@ import flask
 import flask_api
 
 
+# Headers that only apply to a single connection and must not be forwarded by the gateway.
+# Forwarding a client's 'Connection: close' would defeat the upstream keep-alive pool.
+HOP_BY_HOP_HEADERS = {
+	'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+	'te', 'trailers', 'transfer-encoding', 'upgrade',
+}
+
+def remove_hop_by_hop(headers):
+	"""Returns a dict copy of the headers without hop-by-hop headers."""
+	return {k: v for k, v in dict(headers).items() if k.casefold() not in HOP_BY_HOP_HEADERS}
+
+
 # Just a quick decorator to simplify the specification of required fields
 class require_fields(object):
 	def __init__(self, required_fields):
@@ -0,0 +1,242 @@
+# Standard Imports
+from collections import OrderedDict
+import threading
+import time
+
+# Local Imports
+from .router import PrefixRouter
+
+# States of a cached response returned by ResponseCache.lookup
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+MISS = 'miss'
+
+# Rough per-entry cost of the key, headers and bookkeeping, on top of the body
+_ENTRY_OVERHEAD = 512
+
+class CacheRule:
+    def __init__(self, rule_cfg: dict) -> None:
+        '''
+        How GET responses under a route prefix are cached, defined as:
+
+        {
+            "PREFIX": <prefix_of_URL>,
+            "TTL": <seconds_a_response_is_served_without_asking_upstream>,
+            "STALE_WHILE_REVALIDATE": <further_seconds_it_is_served_while_refreshed>,
+            "PER_USER": <whether_each_authenticated_user_gets_their_own_copy>
+        }
+        '''
+
+        self.prefix = rule_cfg["PREFIX"]
+        # Only GETs are cached, see PrefixRouter.match
+        self.methods = frozenset({'GET'})
+        self.ttl = rule_cfg.get("TTL", 5)
+        self.stale_while_revalidate = rule_cfg.get("STALE_WHILE_REVALIDATE", 0)
+        self.per_user = rule_cfg.get("PER_USER", False)
+
+class CachedResponse:
+    ''' A complete upstream response, with the headers to relay and the
+        body as the worker sent it. '''
+
+    __slots__ = ('status', 'headers', 'body', 'etag', 'cacheable', 'stored_at', 'fresh_until', 'stale_until')
+
+    def __init__(self, status: int, headers: dict, body: bytes, cacheable: bool = True) -> None:
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = headers.get('ETag')
+        self.cacheable = cacheable
+        self.stored_at = self.fresh_until = self.stale_until = 0.0
+
+    def get_size(self) -> int:
+        return len(self.body) + _ENTRY_OVERHEAD
+
+    def get_age(self) -> int:
+        return int(time.monotonic() - self.stored_at)
+
+class _Flight:
+    # A fetch of one key that other requests for the key can wait on
+    def __init__(self, generation: int) -> None:
+        self.done = threading.Event()
+        self.result = None
+        # The cache's generation when the fetch began, see ResponseCache.store
+        self.generation = generation
+
+    def wait(self, timeout: float):
+        ''' Returns the leader's CachedResponse, or None if it could not get
+            one in time. '''
+        self.done.wait(timeout)
+        return self.result
+
+class ResponseCache:
+    def __init__(self, cache_config: dict = None) -> None:
+        '''
+        A least-recently-used cache of upstream GET responses, bounded by
+        the memory their bodies take up. Takes an optional cache config
+        object defined as:
+
+        {
+            "MAX_BYTES": <memory_budget_for_all_cached_responses>,
+            "MAX_ENTRY_BYTES": <largest_body_that_is_cached>,
+            "ROUTES": [<cache_rule>, ...]
+        }
+
+        See CacheRule for the rules. Nothing is cached outside their prefixes.
+        Concurrent misses of the same key share one upstream fetch, see
+        join_flight.
+        '''
+
+        cache_config = cache_config or {}
+        self.__max_bytes = cache_config.get("MAX_BYTES", 64 * 1024 * 1024)
+        self.__max_entry_bytes = cache_config.get("MAX_ENTRY_BYTES", 1024 * 1024)
+        self.__rules = PrefixRouter()
+        for rule_cfg in cache_config.get("ROUTES", []):
+            self.__rules.add_route(CacheRule(rule_cfg))
+
+        # key -> CachedResponse, least recently used first
+        self.__entries = OrderedDict()
+        self.__size = 0
+        # key -> _Flight for fetches in progress
+        self.__flights = {}
+        # Bumped by each invalidate, which records it against its prefix, so
+        # a fetch begun before a write is not cached after it
+        self.__generation = 0
+        self.__invalidated = {}
+        self.__lock = threading.Lock()
+
+        self.__hits = 0
+        self.__stale_hits = 0
+        self.__misses = 0
+        self.__coalesced = 0
+        self.__evictions = 0
+
+    def match(self, path: str, method: str):
+        ''' Returns the CacheRule for the request, or None if it is not cached. '''
+        return self.__rules.match(path, method)
+
+    def get_max_entry_bytes(self) -> int:
+        return self.__max_entry_bytes
+
+    def make_key(self, rule: CacheRule, full_path: str, username: str, headers) -> tuple:
+        ''' Returns the cache key of a request. Responses can differ by the
+            representation the client accepts, and by user on PER_USER routes. '''
+        return (
+            full_path,
+            username if rule.per_user else None,
+            headers.get('Accept', ''),
+            headers.get('Accept-Encoding', ''),
+        )
+
+    def lookup(self, key: tuple) -> tuple:
+        ''' Returns (CachedResponse, state), where state is FRESH, STALE,
+            EXPIRED or MISS. Expired responses are returned so their ETag can
+            be used to revalidate them. '''
+
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__misses += 1
+                return None, MISS
+            self.__entries.move_to_end(key)
+            if now < entry.fresh_until:
+                self.__hits += 1
+                return entry, FRESH
+            if now < entry.stale_until:
+                self.__stale_hits += 1
+                return entry, STALE
+            self.__misses += 1
+            return entry, EXPIRED
+
+    def store(self, key: tuple, rule: CacheRule, entry: CachedResponse) -> None:
+        ''' Cache the response under the key for the TTL of the rule. A
+            response fetched by the key's flight is dropped instead if its
+            prefix was invalidated since the flight began, as it may predate
+            the write. '''
+        if not entry.cacheable or len(entry.body) > self.__max_entry_bytes:
+            return
+        now = time.monotonic()
+        entry.stored_at = now
+        entry.fresh_until = now + rule.ttl
+        entry.stale_until = entry.fresh_until + rule.stale_while_revalidate
+
+        with self.__lock:
+            flight = self.__flights.get(key)
+            if flight is not None and self.__invalidated_since(key[0], flight.generation):
+                return
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__size -= old.get_size()
+            self.__entries[key] = entry
+            self.__size += entry.get_size()
+            # Evict least recently used entries until we're back within budget
+            while self.__size > self.__max_bytes and self.__entries:
+                _, evicted = self.__entries.popitem(last=False)
+                self.__size -= evicted.get_size()
+                self.__evictions += 1
+
+    def invalidate(self, prefix: str) -> int:
+        ''' Drop every cached response under the prefix, e.g. after a write
+            to it. Returns the number of responses dropped. '''
+
+        prefix = prefix.rstrip('/')
+        with self.__lock:
+            self.__generation += 1
+            self.__invalidated[prefix] = self.__generation
+            keys = [
+                key for key in self.__entries
+                if _under_prefix(key[0].partition('?')[0], prefix)
+            ]
+            for key in keys:
+                self.__size -= self.__entries.pop(key).get_size()
+            return len(keys)
+
+    def join_flight(self, key: tuple) -> tuple:
+        ''' Returns (flight, leader). The first caller for a key is the leader
+            and must fetch the response and pass it to finish_flight. The
+            others can wait on the flight for it. '''
+
+        with self.__lock:
+            flight = self.__flights.get(key)
+            if flight is not None:
+                self.__coalesced += 1
+                return flight, False
+            flight = self.__flights[key] = _Flight(self.__generation)
+            return flight, True
+
+    def __invalidated_since(self, full_path: str, generation: int) -> bool:
+        # Whether a prefix of the path was invalidated after the generation
+        path = full_path.partition('?')[0]
+        return any(
+            invalidated > generation and _under_prefix(path, prefix)
+            for prefix, invalidated in self.__invalidated.items()
+        )
+
+    def finish_flight(self, key: tuple, result) -> None:
+        ''' Hand the leader's CachedResponse, or None if it got none, to the
+            requests waiting on the key. '''
+
+        with self.__lock:
+            flight = self.__flights.pop(key, None)
+        if flight is not None:
+            flight.result = result
+            flight.done.set()
+
+    def get_stats(self) -> dict:
+        ''' Returns the hit/miss counters and current size of the cache. '''
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'stale_hits': self.__stale_hits,
+                'misses': self.__misses,
+                'coalesced': self.__coalesced,
+                'evictions': self.__evictions,
+                'entries': len(self.__entries),
+                'bytes': self.__size,
+                'max_bytes': self.__max_bytes,
+            }
+
+def _under_prefix(path: str, prefix: str) -> bool:
+    # Compares whole segments, as PrefixRouter does
+    return path == prefix or path.startswith(prefix + '/')
@@ -0,0 +1,174 @@
+# Standard Imports
+import itertools
+import threading
+import time
+
+# Methods whose requests can be sent twice without changing the outcome
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# Status codes that say the instance, not the request, was at fault
+RETRY_STATUSES = (500, 502, 503, 504)
+
+class RetryPolicy:
+    def __init__(self, policy_config: dict = None) -> None:
+        '''
+        How requests to one service are retried and hedged. Takes an optional
+        policy config object defined as:
+
+        {
+            "ATTEMPTS": <most_instances_one_request_is_sent_to, 1_to_never_retry>,
+            "METHODS": [<http_method_retried_after_an_error_or_a_retried_status>, ...],
+            "ON_STATUS": [<status_code_retried_on_another_instance>, ...],
+            "HEDGE": <whether_GETs_are_also_sent_to_a_second_instance_when_slow>,
+            "HEDGE_PERCENTILE": <percentile_of_recent_GET_latency_waited_before_hedging>,
+            "HEDGE_MIN_DELAY": <fewest_seconds_waited_before_hedging>
+        }
+
+        A request that could not connect never reached the instance, so it is
+        retried whatever its method. Other failures are only retried for
+        METHODS, and only if the request body can be sent again.
+        '''
+
+        policy_config = policy_config or {}
+        self.__attempts = max(1, policy_config.get("ATTEMPTS", 2))
+        self.__methods = frozenset(m.upper() for m in policy_config.get("METHODS", IDEMPOTENT_METHODS))
+        self.__statuses = frozenset(policy_config.get("ON_STATUS", RETRY_STATUSES))
+        self.__hedge = policy_config.get("HEDGE", False)
+        self.__hedge_percentile = policy_config.get("HEDGE_PERCENTILE", 95)
+        self.__hedge_min_delay = policy_config.get("HEDGE_MIN_DELAY", 0.005)
+        # Recent GET latencies by route prefix, only kept if hedging
+        self.__latencies = {}
+
+    def get_attempts(self) -> int:
+        return self.__attempts
+
+    def can_retry(self, method: str, status_code: int = None, connect_failed: bool = False,
+                  streamed_body: bool = False) -> bool:
+        ''' Returns True if a request that failed with the given status code,
+            or with an error if there is none, may be sent to another instance.
+            A streamed request body has been read and cannot be sent again,
+            unless the request failed to connect. '''
+        if connect_failed:
+            return True
+        if streamed_body or method not in self.__methods:
+            return False
+        return status_code is None or status_code in self.__statuses
+
+    def get_hedge_delay(self, route) -> float:
+        ''' Returns the seconds to wait for a GET through the route before
+            hedging it, or None if it should not be hedged, e.g. because too
+            few of its latencies have been recorded yet. '''
+        if not self.__hedge:
+            return None
+        tracker = self.__latencies.get(route.prefix)
+        percentile = tracker.get_percentile() if tracker is not None else None
+        if percentile is None:
+            return None
+        return max(self.__hedge_min_delay, percentile)
+
+    def record_latency(self, route, seconds: float) -> None:
+        ''' Record how long a GET through the route took to get its response headers. '''
+        if self.__hedge:
+            tracker = self.__latencies.get(route.prefix)
+            if tracker is None:
+                # setdefault is atomic, so racing threads end up with the same tracker
+                tracker = self.__latencies.setdefault(route.prefix, LatencyTracker(self.__hedge_percentile))
+            tracker.record(seconds)
+
+class LatencyTracker:
+    def __init__(self, percentile: float, size: int = 1000, refresh_every: int = 100) -> None:
+        '''
+        A percentile of the last size latencies recorded, recomputed every
+        refresh_every records so that reading it costs nothing. Request
+        threads record without a lock: two of them may write the same slot,
+        which only loses a sample.
+        '''
+
+        self.__percentile = percentile
+        self.__size = size
+        self.__refresh_every = refresh_every
+        self.__samples = [0.0] * size
+        self.__counter = itertools.count()
+        self.__value = None
+
+    def record(self, seconds: float) -> None:
+        index = next(self.__counter)
+        self.__samples[index % self.__size] = seconds
+        if index % self.__refresh_every == self.__refresh_every - 1:
+            samples = sorted(self.__samples[:min(index + 1, self.__size)])
+            rank = int(len(samples) * self.__percentile / 100)
+            self.__value = samples[min(rank, len(samples) - 1)]
+
+    def get_percentile(self) -> float:
+        ''' Returns the percentile in seconds, or None until refresh_every latencies were recorded. '''
+        return self.__value
+
+class RetryBudget:
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 5, burst: float = 20) -> None:
+        '''
+        Limits retries and hedges, across every service, to a fraction of
+        the requests the gateway handles. Each request adds ratio to the
+        budget, and it also refills by min_per_second each second so a quiet
+        gateway can still retry. It never holds more than burst.
+
+        When an outage fails nearly every request, retries without a budget
+        would multiply the load on the instances still up by ATTEMPTS. With
+        one, they add at most about ratio to it.
+        '''
+
+        self.__ratio = ratio
+        self.__min_per_second = min_per_second
+        self.__burst = burst
+        self.__balance = burst
+        self.__refilled_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def deposit(self) -> None:
+        ''' Add to the budget for a request the gateway received. '''
+        with self.__lock:
+            self.__balance = min(self.__burst, self.__balance + self.__ratio)
+
+    def withdraw(self) -> bool:
+        ''' Take one retry from the budget. Returns False if it is spent. '''
+        with self.__lock:
+            now = time.monotonic()
+            self.__balance = min(self.__burst, self.__balance + (now - self.__refilled_at) * self.__min_per_second)
+            self.__refilled_at = now
+            if self.__balance < 1:
+                return False
+            self.__balance -= 1
+            return True
+
+    def get_balance(self) -> float:
+        return self.__balance
+
+class RetryPolicies:
+    def __init__(self, services_config: dict, retry_config: dict = None) -> None:
+        '''
+        The retry policy of each service, and the budget they share. Takes
+        the service config object (see MicroServiceManager), where a service
+        can override any policy key (see RetryPolicy) under "RETRY", and an
+        optional retry config object defined as:
+
+        {
+            <policy_key>: <default_for_every_service>,
+            ...,
+            "BUDGET_RATIO": <retries_allowed_per_request_received>,
+            "BUDGET_MIN_PER_SECOND": <retries_allowed_each_second_regardless>,
+            "BUDGET_BURST": <most_retries_that_can_be_saved_up>
+        }
+        '''
+
+        retry_config = retry_config or {}
+        self.budget = RetryBudget(
+            retry_config.get("BUDGET_RATIO", 0.1),
+            retry_config.get("BUDGET_MIN_PER_SECOND", 5),
+            retry_config.get("BUDGET_BURST", 20),
+        )
+        self.__policies = {
+            svc_key: RetryPolicy(dict(retry_config, **services_config[svc_key].get("RETRY", {})))
+            for svc_key in services_config
+        }
+
+    def get_policy(self, service_key: str) -> RetryPolicy:
+        return self.__policies[service_key]
@@ -0,0 +1,88 @@
+class Route:
+    def __init__(self, service_key: str, prefix: str, methods=None, timeout=None, strategy=None) -> None:
+        '''
+        A rule sending requests whose path starts with prefix to a service.
+
+        methods - the HTTP methods the rule applies to, or None for all.
+
+        timeout - overrides the read timeout, or the (connect, read) timeout,
+            of requests sent to the service through this rule.
+
+        strategy - overrides the load balancing strategy of the service for
+            requests routed through this rule.
+        '''
+
+        self.service_key = service_key
+        self.prefix = prefix
+        # Methods are compared as given by the WSGI server, which upper-cases them
+        self.methods = frozenset(m.upper() for m in methods) if methods else None
+        self.timeout = timeout
+        self.strategy = strategy
+
+    def allows(self, method: str) -> bool:
+        ''' Returns True if the rule applies to the given HTTP method. '''
+        return self.methods is None or method in self.methods
+
+    def __repr__(self) -> str:
+        return 'Route(%r, %r, methods=%r)' % (self.service_key, self.prefix, self.methods)
+
+class _Node:
+    __slots__ = ('children', 'routes')
+
+    def __init__(self) -> None:
+        self.children = {}
+        # Rules ending at this node, most specific methods first
+        self.routes = []
+
+class PrefixRouter:
+    '''
+    Matches request paths to routes by their longest prefix.
+
+    Prefixes are compiled into a trie of path segments, so a lookup walks
+    the segments of the path once and its cost does not grow with the number
+    of routes. A prefix only matches whole segments: "/api/v1/users" matches
+    "/api/v1/users" and "/api/v1/users/1" but not "/api/v1/usersX".
+    When the longest matching prefix has no rule for the request's method,
+    the next shorter one is tried.
+    '''
+
+    def __init__(self) -> None:
+        self.__root = _Node()
+
+    def add_route(self, route: Route) -> None:
+        ''' Add a rule to the router. Rules for the same prefix are tried in
+            the order added, except that method-specific rules come first. '''
+        node = self.__root
+        for segment in split_path(route.prefix):
+            node = node.children.setdefault(segment, _Node())
+        node.routes.append(route)
+        # sort() is stable, so rules keep their order within each group
+        node.routes.sort(key=lambda r: r.methods is None)
+
+    def match(self, path: str, method: str = 'GET'):
+        ''' Returns the Route for the given path and method, or None if no
+            rule matches. Any query string is ignored. '''
+
+        best = None
+        node = self.__root
+        segments = split_path(path)
+        depth = 0
+        while True:
+            for route in node.routes:
+                if route.methods is None or method in route.methods:
+                    best = route
+                    break
+            if depth == len(segments):
+                return best
+            node = node.children.get(segments[depth])
+            if node is None:
+                return best
+            depth += 1
+
+def split_path(path: str) -> list:
+    ''' Returns the non-empty segments of a path, without any query string. '''
+    path = path.partition('?')[0]
+    segments = path.split('/')
+    if '' in segments:
+        segments = [segment for segment in segments if segment]
+    return segments
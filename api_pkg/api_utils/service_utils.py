@@ -0,0 +1,65 @@
+# Standard Imports
+import logging
+
+# Third-Party Imports
+from flask import Flask, request
+from flask_api import status
+from werkzeug.serving import WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+# Bytes read at a time when draining a request body nobody read
+DRAIN_CHUNK_SIZE = 64 * 1024
+
+# Path the gateway's health checks GET, see HEALTH_PATH in routes.cfg
+HEALTH_PATH = '/health'
+
+def serve_gateway(app: Flask, check_health, check_errors=Exception) -> None:
+    '''
+    Set up a service app to sit behind the gateway: serve it the way the
+    gateway's connections expect, and add the health check the gateway uses
+    to decide whether an instance gets traffic.
+
+    check_health - called with no arguments on each health check, to touch
+        whatever the service cannot work without. The instance is reported
+        unavailable if it raises one of check_errors.
+    '''
+
+    serve_keep_alive(app)
+    # The headers and body of a response are written separately, and with
+    # Nagle's algorithm the body waits for the gateway to acknowledge the
+    # headers, which it delays by up to 40ms
+    WSGIRequestHandler.disable_nagle_algorithm = True
+
+    # Outside the service prefixes, so it is not reachable through the gateway
+    @app.route(HEALTH_PATH)
+    def health():
+        try:
+            check_health()
+        except check_errors as e:
+            return {'status': 'unavailable', 'error': str(e)}, status.HTTP_503_SERVICE_UNAVAILABLE
+        return {'status': 'ok'}, status.HTTP_200_OK
+
+def serve_keep_alive(app: Flask) -> None:
+    '''
+    Speak HTTP/1.1 under `flask run`, so the gateway's keep-alive connections
+    to the service are not closed after every response.
+
+    Werkzeug's development server leaves whatever a handler did not read of
+    the request body on the connection, where it would be parsed as the next
+    request, one the gateway never authenticated. So the rest of every body
+    is read and thrown away once its request is handled.
+    '''
+
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    app.teardown_request(drain_request_body)
+
+def drain_request_body(exception=None) -> None:
+    ''' Read the current request's body to its end. '''
+    stream = request.stream
+    try:
+        while stream.read(DRAIN_CHUNK_SIZE):
+            pass
+    except OSError:
+        # The client went away, and the connection with it
+        logger.debug('Could not drain the body of %s %s', request.method, request.path)
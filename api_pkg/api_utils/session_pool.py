@@ -0,0 +1,128 @@
+# Standard Imports
+from http.cookiejar import DefaultCookiePolicy
+import time
+
+# Third-Party Imports
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+# Local Imports
+from .tracing import record_phase
+
+class TimedHTTPConnection(HTTPConnection):
+    ''' Adds the time taken to open the connection to the "connect" phase of
+        the request being traced, see tracing.py. '''
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            record_phase('connect', time.perf_counter() - started)
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class UpstreamSessionPool:
+    def __init__(self, upstream: str, pool_config: dict = None) -> None:
+        '''
+        Holds one keep-alive requests.Session per worker so that proxied
+        requests reuse TCP connections instead of opening a new one each time.
+        Takes an optional pool config object defined as:
+
+        {
+            "POOL_SIZE": <max_connections_kept_per_worker>,
+            "POOL_BLOCK": <wait_for_a_free_connection_instead_of_opening_more>,
+            "CONNECT_TIMEOUT": <seconds>,
+            "READ_TIMEOUT": <seconds>
+        }
+
+
+        Params:
+
+        upstream - the scheme and host that workers run on, e.g. 'http://localhost'.
+
+        pool_config - the pool config object. Missing keys use the defaults below.
+        '''
+
+        pool_config = pool_config or {}
+        self.__upstream = upstream
+        self.__pool_size = pool_config.get("POOL_SIZE", 10)
+        self.__pool_block = pool_config.get("POOL_BLOCK", False)
+        self.__timeout = (
+            pool_config.get("CONNECT_TIMEOUT", 3.05),
+            pool_config.get("READ_TIMEOUT", 30),
+        )
+        self.__sessions = {}
+
+    def add_worker(self, port: int) -> None:
+        ''' Create the session for the worker listening on the given port. '''
+        if port in self.__sessions:
+            return
+        # Each session only ever talks to one host:port, so a single
+        # urllib3 connection pool of POOL_SIZE connections is enough.
+        # Retries are left to the gateway, which decides what to do with failing workers.
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.__pool_size,
+            pool_block=self.__pool_block,
+            max_retries=0,
+        )
+        # Time new connections, the rest of the wait is in the response's elapsed
+        adapter.poolmanager.pool_classes_by_scheme = dict(
+            adapter.poolmanager.pool_classes_by_scheme, http=TimedHTTPConnectionPool
+        )
+        session = requests.Session()
+        session.mount(self.__upstream, adapter)
+        # Sessions are shared by every client of the gateway, so cookies set by a
+        # worker must never be stored and replayed on someone else's request.
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        # Skip proxy and .netrc lookups from the environment on every request.
+        session.trust_env = False
+        self.__sessions[port] = session
+
+    def get_session(self, port: int) -> requests.Session:
+        ''' Get the keep-alive session for the worker on the given port. '''
+        if port not in self.__sessions:
+            self.add_worker(port)
+        return self.__sessions[port]
+
+    def get_timeout(self) -> tuple:
+        ''' Get the (connect, read) timeout to use for upstream requests. '''
+        return self.__timeout
+
+    def get_url(self, port: int) -> str:
+        ''' Get the base URL of the worker on the given port. '''
+        return self.__upstream + ':' + str(port)
+
+    def get_stats(self, port: int) -> dict:
+        ''' Returns the connection pool statistics for the worker on the given port. '''
+        stats = {
+            'max_size': self.__pool_size,
+            'connections_opened': 0,
+            'requests': 0,
+            'idle': 0,
+        }
+        session = self.__sessions.get(port)
+        if session is None:
+            return stats
+
+        adapter = session.get_adapter(self.get_url(port))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            conn_pool = pools.get(key)
+            if conn_pool is None:
+                continue
+            stats['connections_opened'] += conn_pool.num_connections
+            stats['requests'] += conn_pool.num_requests
+            # Empty slots in the queue are None, idle connections are not
+            stats['idle'] += sum(1 for conn in list(conn_pool.pool.queue) if conn is not None)
+        return stats
+
+    def close(self) -> None:
+        ''' Close all sessions and the connections they hold. '''
+        for session in self.__sessions.values():
+            session.close()
+        self.__sessions.clear()
@@ -0,0 +1,220 @@
+# Standard Imports
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# The state file is a header followed by one slot per worker port
+_MAGIC = b'GWPOOLS2'
+_HEADER = struct.Struct('<8sIxxxxQ16s')   # magic, number of slots, last sequence number, run id
+_SLOT = struct.Struct('<IIQ')          # port, evicted, sequence number of the last change
+
+# The invalidations file is a header followed by one generation per slot
+_CRED_MAGIC = b'GWCREDS1'
+_CRED_HEADER = struct.Struct('<8sI4x')  # magic, number of slots
+_GENERATION = struct.Struct('<Q')
+
+# Gateway processes started together share a run id, see gunicorn_conf.py.
+# One started on its own gets a run id of its own.
+RUN_ID_ENVVAR = 'GATEWAY_RUN_ID'
+_own_run_id = uuid.uuid4().hex
+
+def get_run_id() -> bytes:
+    ''' Returns the run id of this gateway process. '''
+    return uuid.UUID(os.environ.get(RUN_ID_ENVVAR, _own_run_id)).bytes
+
+class SharedPoolState:
+    def __init__(self, path: str, ports: list) -> None:
+        '''
+        Records which workers are evicted from their pools in a memory-mapped
+        file, so that every gateway process using the same file sees the
+        evictions and re-admissions of the others.
+
+        Every change gets the next sequence number from the header, so a
+        process can tell which slots changed since it last looked, and the
+        latest change to a worker wins. Writers and readers hold an flock on
+        the file while they touch it.
+
+        The header also holds the run id of the processes using the file
+        (see get_run_id). A file left by a previous run holds another one,
+        and its evictions are forgotten rather than applied to the workers
+        of this run.
+        '''
+
+        self.__ports = sorted(ports)
+        self.__run_id = get_run_id()
+        self.__index = {port: i for i, port in enumerate(self.__ports)}
+        self.__size = _HEADER.size + _SLOT.size * len(self.__ports)
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Serializes this process's threads, the flock only excludes other processes
+        self.__lock = threading.Lock()
+
+        with self.__locked(fcntl.LOCK_EX):
+            if not self.__is_valid():
+                # New file, or one written by a previous run or for a different set of workers
+                os.ftruncate(self.__fd, 0)
+                os.ftruncate(self.__fd, self.__size)
+                os.pwrite(self.__fd, _HEADER.pack(_MAGIC, len(self.__ports), 0, self.__run_id), 0)
+                for i, port in enumerate(self.__ports):
+                    os.pwrite(self.__fd, _SLOT.pack(port, 0, 0), _HEADER.size + i * _SLOT.size)
+        self.__mmap = mmap.mmap(self.__fd, self.__size)
+
+    def publish(self, port: int, evicted: bool) -> int:
+        ''' Record that the worker was evicted from, or re-admitted into, its
+            pool. Returns the sequence number of the change. '''
+
+        with self.__locked(fcntl.LOCK_EX):
+            _, count, seq, run_id = _HEADER.unpack_from(self.__mmap, 0)
+            seq += 1
+            _SLOT.pack_into(self.__mmap, _HEADER.size + self.__index[port] * _SLOT.size, port, int(evicted), seq)
+            _HEADER.pack_into(self.__mmap, 0, _MAGIC, count, seq, run_id)
+            return seq
+
+    def read(self) -> dict:
+        ''' Returns {port: (evicted, sequence number)} for every worker. '''
+        with self.__locked(fcntl.LOCK_SH):
+            slots = {}
+            for i in range(len(self.__ports)):
+                port, evicted, seq = _SLOT.unpack_from(self.__mmap, _HEADER.size + i * _SLOT.size)
+                slots[port] = (bool(evicted), seq)
+            return slots
+
+    def close(self) -> None:
+        self.__mmap.close()
+        os.close(self.__fd)
+
+    def __is_valid(self) -> bool:
+        if os.fstat(self.__fd).st_size != self.__size:
+            return False
+        magic, count, _, run_id = _HEADER.unpack(os.pread(self.__fd, _HEADER.size, 0))
+        if magic != _MAGIC or count != len(self.__ports) or run_id != self.__run_id:
+            return False
+        for i, port in enumerate(self.__ports):
+            slot_port, _, _ = _SLOT.unpack(os.pread(self.__fd, _SLOT.size, _HEADER.size + i * _SLOT.size))
+            if slot_port != port:
+                return False
+        return True
+
+    def __locked(self, operation: int):
+        return _FileLock(self.__fd, operation, self.__lock)
+
+class _FileLock:
+    def __init__(self, fd: int, operation: int, thread_lock: threading.Lock) -> None:
+        self.__fd = fd
+        self.__operation = operation
+        self.__thread_lock = thread_lock
+
+    def __enter__(self) -> None:
+        self.__thread_lock.acquire()
+        fcntl.flock(self.__fd, self.__operation)
+
+    def __exit__(self, *exc_info) -> None:
+        fcntl.flock(self.__fd, fcntl.LOCK_UN)
+        self.__thread_lock.release()
+
+class SharedInvalidations:
+    def __init__(self, path: str, slots: int = 4096) -> None:
+        '''
+        Counts credential invalidations per username in a memory-mapped file,
+        so that a password change seen by one gateway process reaches the
+        credential caches of all of them at once (see CredentialCache).
+
+        Usernames are hashed into a fixed number of slots, each holding a
+        generation that every invalidation of a user in the slot increments.
+        Users sharing a slot only cost each other a cache miss. Generations
+        only grow and are read without the lock, so a read racing an
+        increment sees either the old or the new value.
+        '''
+
+        self.__slots = slots
+        self.__size = _CRED_HEADER.size + _GENERATION.size * slots
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.__lock = threading.Lock()
+
+        with self.__locked(fcntl.LOCK_EX):
+            if os.fstat(self.__fd).st_size != self.__size or \
+                    _CRED_HEADER.unpack(os.pread(self.__fd, _CRED_HEADER.size, 0)) != (_CRED_MAGIC, slots):
+                os.ftruncate(self.__fd, 0)
+                os.ftruncate(self.__fd, self.__size)
+                os.pwrite(self.__fd, _CRED_HEADER.pack(_CRED_MAGIC, slots), 0)
+        self.__mmap = mmap.mmap(self.__fd, self.__size)
+
+    def get_generation(self, username: str) -> int:
+        return _GENERATION.unpack_from(self.__mmap, self.__offset(username))[0]
+
+    def increment(self, username: str) -> None:
+        ''' Invalidate every process's cached credentials for the username. '''
+        offset = self.__offset(username)
+        with self.__locked(fcntl.LOCK_EX):
+            _GENERATION.pack_into(self.__mmap, offset, _GENERATION.unpack_from(self.__mmap, offset)[0] + 1)
+
+    def close(self) -> None:
+        self.__mmap.close()
+        os.close(self.__fd)
+
+    def __offset(self, username: str) -> int:
+        # Not hash(), which differs between processes
+        digest = hashlib.blake2b(username.encode('utf-8'), digest_size=8).digest()
+        return _CRED_HEADER.size + int.from_bytes(digest, 'little') % self.__slots * _GENERATION.size
+
+    def __locked(self, operation: int):
+        return _FileLock(self.__fd, operation, self.__lock)
+
+def open_invalidations(state_config: dict = None):
+    ''' Returns the SharedInvalidations kept next to the state file of the
+        state config (see SharedStateSync), or None if there is none. '''
+    state_config = state_config or {}
+    if not state_config.get("PATH"):
+        return None
+    return SharedInvalidations(state_config["PATH"] + '.credentials')
+
+class SharedStateSync:
+    def __init__(self, svc_mgr, state_config: dict = None) -> None:
+        '''
+        Applies evictions and re-admissions made by other gateway processes
+        to this process's service manager in the background. Takes an
+        optional state config object defined as:
+
+        {
+            "PATH": <state_file_shared_by_gateway_processes>,
+            "SYNC_INTERVAL": <seconds_between_reads_of_the_state_file>
+        }
+
+        A change made by one process shows up in the others within
+        SYNC_INTERVAL seconds. Nothing is shared if PATH is not set.
+        '''
+
+        state_config = state_config or {}
+        self.__svc_mgr = svc_mgr
+        self.__enabled = bool(state_config.get("PATH"))
+        self.__interval = state_config.get("SYNC_INTERVAL", 0.5)
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self) -> None:
+        ''' Start syncing on a daemon thread, if a state file is configured. '''
+        if not self.__enabled or self.__thread is not None:
+            return
+        self.__thread = threading.Thread(target=self.__run, name='state-sync', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        ''' Stop syncing and wait for the thread to finish. '''
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.__interval):
+            try:
+                self.__svc_mgr.sync_shared_state()
+            except Exception:
+                # Never let one bad read stop the sync
+                logger.exception('Shared state sync failed')
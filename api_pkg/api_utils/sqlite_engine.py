@@ -0,0 +1,115 @@
+# Third-Party Imports
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_JOURNAL_MODE = 'WAL'
+DEFAULT_SYNCHRONOUS = 'NORMAL'
+DEFAULT_BUSY_TIMEOUT = 5000
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+# Values PRAGMA synchronous reports for each setting
+_SYNCHRONOUS_LEVELS = {'OFF': 0, 'NORMAL': 1, 'FULL': 2, 'EXTRA': 3}
+
+def make_engine(database_url: str, sqlite_config: dict = None) -> Engine:
+    '''
+    Build the SQLAlchemy engine of a service's SQLite database, for
+    pugsql's setengine. Takes an optional sqlite config object defined as:
+
+    {
+        "JOURNAL_MODE": <"WAL" so readers and the writer don't block each other>,
+        "SYNCHRONOUS": <"OFF", "NORMAL", "FULL" or "EXTRA">,
+        "BUSY_TIMEOUT": <milliseconds_to_wait_for_a_lock>,
+        "MMAP_SIZE": <bytes_of_the_file_read_through_mmap>,
+        "CACHED_STATEMENTS": <prepared_statements_kept_per_connection>,
+        "IMMEDIATE_TRANSACTIONS": <whether_transactions_take_the_write_lock_up_front>,
+        "POOL_SIZE": <connections_kept_open>,
+        "MAX_OVERFLOW": <connections_opened_beyond_POOL_SIZE_under_load>,
+        "POOL_TIMEOUT": <seconds_to_wait_for_a_free_connection>
+    }
+
+    By default SQLAlchemy opens a new SQLite connection for every statement.
+    Here connections are pooled and shared by the request threads, and each
+    one is set up with the pragmas above when it is opened.
+
+    With IMMEDIATE_TRANSACTIONS, transactions start with BEGIN IMMEDIATE.
+    A deferred transaction that reads and then writes, like checking a user
+    exists before following them, fails at once with "database is locked"
+    if another process wrote in between, instead of waiting BUSY_TIMEOUT.
+    '''
+
+    sqlite_config = sqlite_config or {}
+    busy_timeout = sqlite_config.get("BUSY_TIMEOUT", DEFAULT_BUSY_TIMEOUT)
+    pragmas = [
+        ('journal_mode', sqlite_config.get("JOURNAL_MODE", DEFAULT_JOURNAL_MODE)),
+        ('synchronous', sqlite_config.get("SYNCHRONOUS", DEFAULT_SYNCHRONOUS)),
+        ('busy_timeout', busy_timeout),
+        ('mmap_size', sqlite_config.get("MMAP_SIZE", DEFAULT_MMAP_SIZE)),
+    ]
+    immediate = sqlite_config.get("IMMEDIATE_TRANSACTIONS", True)
+
+    engine = create_engine(
+        database_url,
+        poolclass=QueuePool,
+        pool_size=sqlite_config.get("POOL_SIZE", 8),
+        max_overflow=sqlite_config.get("MAX_OVERFLOW", 8),
+        pool_timeout=sqlite_config.get("POOL_TIMEOUT", 10),
+        connect_args={
+            'timeout': busy_timeout / 1000,
+            'cached_statements': sqlite_config.get("CACHED_STATEMENTS", 128),
+            # Pooled connections move between request threads
+            'check_same_thread': False,
+        },
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        # Let SQLAlchemy decide when transactions begin, see do_begin
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(connection):
+        connection.exec_driver_sql('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+
+    return engine
+
+def check_pragmas(engine: Engine, sqlite_config: dict = None) -> dict:
+    '''
+    Read the pragmas back from a pooled connection and raise RuntimeError if
+    any did not take effect, e.g. WAL on a file system without shared memory.
+    Returns the pragmas as read.
+    '''
+
+    sqlite_config = sqlite_config or {}
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        actual = {}
+        for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size'):
+            row = cursor.execute('PRAGMA ' + name).fetchone()
+            actual[name] = row[0] if row else None
+        cursor.close()
+    finally:
+        raw.close()
+
+    journal_mode = sqlite_config.get("JOURNAL_MODE", DEFAULT_JOURNAL_MODE)
+    synchronous = sqlite_config.get("SYNCHRONOUS", DEFAULT_SYNCHRONOUS)
+    busy_timeout = sqlite_config.get("BUSY_TIMEOUT", DEFAULT_BUSY_TIMEOUT)
+    mmap_size = sqlite_config.get("MMAP_SIZE", DEFAULT_MMAP_SIZE)
+    wrong = []
+    if str(actual['journal_mode']).upper() != journal_mode.upper():
+        wrong.append('journal_mode is %s, not %s' % (actual['journal_mode'], journal_mode))
+    if actual['synchronous'] != _SYNCHRONOUS_LEVELS.get(synchronous.upper()):
+        wrong.append('synchronous is %s, not %s' % (actual['synchronous'], synchronous))
+    if actual['busy_timeout'] != busy_timeout:
+        wrong.append('busy_timeout is %s, not %s' % (actual['busy_timeout'], busy_timeout))
+    # SQLite caps mmap_size at a compile-time limit, so only check it's on
+    if mmap_size > 0 and not actual['mmap_size']:
+        wrong.append('mmap_size is %s, mmap is unavailable' % actual['mmap_size'])
+    if wrong:
+        raise RuntimeError('SQLite settings did not take effect: ' + '; '.join(wrong))
+    return actual
@@ -1,5 +1,16 @@
+# Standard Imports
+import threading
+
+# Local Imports
+from .health import CircuitBreaker, OPEN
+from .lb_strategies import InstanceStats, RoundRobin, make_strategy
+from .router import PrefixRouter, Route
+from .session_pool import UpstreamSessionPool
+from .shared_state import SharedPoolState
+
 class MicroService:
-    def __init__(self, start_port: int, instances: int, prefix: str) -> None:
+    def __init__(self, start_port: int, instances: int, prefix: str, breaker_config: dict = None,
+                 strategy = None, ewma_decay: float = 10) -> None:
         '''
         This microservice object provides functionality for managing a pool of
         instances that represent actual running instances.
@@ -13,44 +24,164 @@ class MicroService:
 
         prefix - the common part of the URL that all endpoints for this service
             will share.
+
+        breaker_config - the "FAILURE_THRESHOLD", "SUCCESS_THRESHOLD" and
+            "OPEN_INTERVAL" of the circuit breaker kept for each instance.
+
+        strategy - the load balancing strategy that picks an instance from the
+            pool (see lb_strategies). Defaults to round-robin.
+
+        ewma_decay - the time constant, in seconds, of each instance's
+            moving average latency.
         '''
 
+        breaker_config = breaker_config or {}
         self.__prefix = prefix
         self.__start_port = start_port
         self.__max_inst = instances
-        self.__pool = [ (self.__start_port + i) for i in range(self.__max_inst) ]
-        self.__curr = 0
+        self.__ports = [ (self.__start_port + i) for i in range(self.__max_inst) ]
+        # The pool is an immutable snapshot that is replaced, never changed in
+        # place, so get_instance can use it without taking the lock
+        self.__pool = tuple(self.__ports)
+        self.__strategy = strategy or RoundRobin({})
+        self.__stats = {port: InstanceStats(ewma_decay) for port in self.__ports}
+        self.__breakers = {
+            port: CircuitBreaker(
+                breaker_config.get("FAILURE_THRESHOLD", 1),
+                breaker_config.get("SUCCESS_THRESHOLD", 1),
+                breaker_config.get("OPEN_INTERVAL", 10),
+            ) for port in self.__ports
+        }
+        # Serializes changes to the breakers and pool, which request threads
+        # and the health checker make concurrently. Picking an instance and
+        # recording load never take it.
+        self.__lock = threading.Lock()
+
+    # The optional callbacks of the methods below are called with the lock
+    # held, so what they do happens in the same order as the changes to the
+    # pool, e.g. publishing them to other gateway processes
+
+    def remove_instance(self, port: int, on_change = None) -> None:
+        ''' Remove a port number from the pool. The port represents an instance.
+            It stays out until a health check finds it has recovered.
+            on_change(port, True) is called once it is out. '''
+        with self.__lock:
+            self.__breakers[port].force_open()
+            self.__evict(port)
+            if on_change is not None:
+                on_change(port, True)
+
+    def report_failure(self, port: int, on_change = None) -> bool:
+        ''' Count a failure of the instance. Returns True if this took the
+            instance out of the pool, after calling on_change(port, True). '''
+        with self.__lock:
+            if self.__breakers[port].record_failure() == OPEN and port in self.__pool:
+                self.__evict(port)
+                if on_change is not None:
+                    on_change(port, True)
+                return True
+            return False
+
+    def report_success(self, port: int, on_change = None) -> bool:
+        ''' Count a success of the instance. Returns True if this re-admitted
+            the instance into the pool, after calling on_change(port, False). '''
+        # Nearly every request succeeds against a healthy instance, which
+        # changes nothing, so skip the lock for those
+        if self.__breakers[port].is_settled():
+            return False
+        with self.__lock:
+            if self.__breakers[port].record_success() != OPEN and port not in self.__pool:
+                self.__admit(port)
+                if on_change is not None:
+                    on_change(port, False)
+                return True
+            return False
+
+    def set_evicted(self, port: int, evicted: bool, is_current = None) -> bool:
+        ''' Take the instance out of the pool, or put it back, regardless of
+            its breaker, e.g. because another gateway process did. Nothing
+            changes if is_current(port) returns False. Returns True if the
+            pool changed. '''
+        with self.__lock:
+            if is_current is not None and not is_current(port):
+                return False
+            if evicted and port in self.__pool:
+                self.__breakers[port].force_open()
+                self.__evict(port)
+                return True
+            if not evicted and port not in self.__pool:
+                self.__breakers[port].force_close()
+                self.__admit(port)
+                return True
+            return False
+
+    def get_probe_targets(self) -> list:
+        ''' Return the ports that are due a health check: every instance
+            in the pool, and removed ones that have waited long enough. '''
+        with self.__lock:
+            return [
+                port for port in self.__ports
+                if self.__breakers[port].get_state() != OPEN or self.__breakers[port].ready_for_trial()
+            ]
 
-    def remove_instance(self, port: int) -> None:
-        ''' Remove a port number from the pool. The port represents an instance. '''
-        self.__pool.remove(port)
-        # If current index is not out of bounds, reset to zero
-        if self.__curr >= len(self.__pool):
-            self.__curr = 0
+    def get_instance_states(self) -> dict:
+        ''' Return the circuit breaker state of every instance, keyed by port. '''
+        with self.__lock:
+            return {port: self.__breakers[port].to_dict() for port in self.__ports}
 
     def get_prefix(self) -> str:
         ''' Get the endpoint prefix for this microservice. '''
         return self.__prefix
 
-    def get_instance(self) -> int:
+    def get_instance(self, strategy = None, exclude = ()) -> int:
         ''' Return a port number representing an instance of the microservice.
-            If no instances are available, returns -1. '''
+            If no instances are available, returns -1. A strategy can be
+            given to pick with instead of the service's own, and ports to
+            exclude, e.g. instances a request was already sent to. '''
 
+        # Take one snapshot, it may be replaced while the strategy runs
+        pool = self.__pool
+        if exclude:
+            pool = tuple(port for port in pool if port not in exclude)
         # If pool is empty, retrun -1
-        if len(self.__pool) == 0:
+        if len(pool) == 0:
             return -1
-        # Else get the port at the current index and increment current index
+        # Else let the strategy pick from the pool
         else:
-            port = self.__pool[self.__curr]
-            self.__curr = (self.__curr + 1) % len(self.__pool)
-            return port
+            return (strategy or self.__strategy).choose(pool, self.__stats)
+
+    def begin_request(self, port: int) -> None:
+        ''' Count a request sent to the instance as in flight. '''
+        self.__stats[port].begin_request()
+
+    def end_request(self, port: int, latency: float = None) -> None:
+        ''' Count a request to the instance as finished, and record how long
+            the instance took to respond if given. '''
+        self.__stats[port].end_request(latency)
+
+    def get_instance_stats(self) -> dict:
+        ''' Return the load figures of every instance, keyed by port. '''
+        return {port: self.__stats[port].to_dict() for port in self.__ports}
+
+    def get_ports(self) -> list:
+        ''' Return every port this microservice started with, including removed ones. '''
+        return self.__ports
 
     def get_pool(self) -> list:
         ''' Return a list representation of this microservice's worker pool. '''
-        return self.__pool
+        return list(self.__pool)
+
+    # Both helpers below expect the lock to already be held
+    def __evict(self, port: int) -> None:
+        self.__pool = tuple(p for p in self.__pool if p != port)
+
+    def __admit(self, port: int) -> None:
+        # Keep the pool in port order, as it started
+        self.__pool = tuple(p for p in self.__ports if p in self.__pool or p == port)
 
 class MicroServiceManager:
-    def __init__(self, services_config):
+    def __init__(self, services_config, upstream: str = 'http://localhost', pool_config: dict = None,
+                 health_config: dict = None, state_config: dict = None):
         '''
         The service manager is used to manage service worker pools.
         A worker in this context refers to an instance of the microservice.
@@ -60,47 +191,212 @@ class MicroServiceManager:
             <service_name>: {
                 "PREFIX": <prefix_of_URL>
                 "PORT": <starting_port>,
-                "INSTANCES": <num_instances>
+                "INSTANCES": <num_instances>,
+                "HEALTH_PATH": <path_to_check_health_of_an_instance>,
+                "STRATEGY": <load_balancing_strategy>,
+                "WEIGHTS": {<port>: <weight>, ...},
+                "EWMA_DECAY": <seconds>,
+                "ROUTES": [
+                    {
+                        "PREFIX": <longer_prefix_of_URL>,
+                        "METHODS": [<http_method>, ...],
+                        "TIMEOUT": <read_timeout_or_(connect, read)>,
+                        "STRATEGY": <load_balancing_strategy>
+                    },
+                    ...
+                ]
             },
             ...
         }
+
+        Requests are routed to the service with the longest matching prefix
+        (see PrefixRouter). Extra "ROUTES" can override the timeout and
+        strategy for part of a service, or for some methods only.
+
+        Each worker also gets a keep-alive connection pool to the given upstream,
+        configured by pool_config (see UpstreamSessionPool), and a circuit
+        breaker configured by health_config (see HealthChecker).
+
+        If state_config has a "PATH", evictions and re-admissions are also
+        written to that file, and sync_shared_state() applies the ones made
+        by other gateway processes (see SharedStateSync).
         '''
 
         self.__services = {}
+        self.__health_paths = {}
+        self.__router = PrefixRouter()
+        self.__sessions = UpstreamSessionPool(upstream, pool_config)
         for svc_key in services_config:
             svc_cfg = services_config[svc_key]
             prefix = svc_cfg["PREFIX"]
             start_port = svc_cfg["PORT"]
             instances = svc_cfg["INSTANCES"]
-            self.__services[svc_key] = MicroService(start_port, instances, prefix)
+            self.__services[svc_key] = MicroService(
+                start_port, instances, prefix, health_config,
+                make_strategy(svc_cfg), svc_cfg.get("EWMA_DECAY", 10),
+            )
+            self.__health_paths[svc_key] = svc_cfg.get("HEALTH_PATH", "/health")
+            for port in self.__services[svc_key].get_ports():
+                self.__sessions.add_worker(port)
+
+            self.__router.add_route(Route(svc_key, prefix))
+            for route_cfg in svc_cfg.get("ROUTES", []):
+                self.__router.add_route(Route(
+                    svc_key,
+                    route_cfg["PREFIX"],
+                    route_cfg.get("METHODS"),
+                    route_cfg.get("TIMEOUT"),
+                    make_strategy(route_cfg) if "STRATEGY" in route_cfg else None,
+                ))
+
+        state_config = state_config or {}
+        self.__shared_state = None
+        # Sequence number of the last change to each worker that was seen in
+        # the state file. Read and written with the worker's service locked too.
+        self.__shared_seen = {}
+        self.__seen_lock = threading.Lock()
+        if state_config.get("PATH"):
+            ports = [port for svc in self.__services.values() for port in svc.get_ports()]
+            self.__shared_state = SharedPoolState(state_config["PATH"], ports)
+            self.__port_services = {
+                port: svc_key for svc_key in self.__services for port in self.__services[svc_key].get_ports()
+            }
+            # Start from the evictions other processes have already made
+            self.sync_shared_state()
 
 
     def remove_worker(self, service_key: str, port: int) -> None:
         ''' Remove the worker of the given service type/key with the given port. '''
-        self.__services[service_key].remove_instance(port)
+        self.__services[service_key].remove_instance(port, self.__publish)
 
-    def get_worker(self, service_key) -> int:
-        ''' Get a port of a running instance of the specified type/key. '''
-        return self.__services[service_key].get_instance()
+    def report_failure(self, service_key: str, port: int) -> bool:
+        ''' Count a failure of the given worker. Returns True if the worker
+            was taken out of its pool as a result. '''
+        return self.__services[service_key].report_failure(port, self.__publish)
+
+    def report_success(self, service_key: str, port: int) -> bool:
+        ''' Count a success of the given worker. Returns True if the worker
+            was re-admitted into its pool as a result. '''
+        return self.__services[service_key].report_success(port, self.__publish)
+
+    def sync_shared_state(self) -> list:
+        ''' Apply evictions and re-admissions that other gateway processes
+            wrote to the shared state file since the last sync. Returns the
+            (service key, port) of every worker whose pool changed. '''
+
+        if self.__shared_state is None:
+            return []
+        changed = []
+        for port, (evicted, seq) in self.__shared_state.read().items():
+            svc_key = self.__port_services[port]
+            # Checked with the service locked, as this process may have
+            # published a newer change since the file was read
+            if self.__services[svc_key].set_evicted(port, evicted, lambda port, seq=seq: self.__see(port, seq)):
+                changed.append((svc_key, port))
+        return changed
+
+    # Called with the worker's service locked, see MicroService
+    def __publish(self, port: int, evicted: bool) -> None:
+        if self.__shared_state is not None:
+            # Our own change does not need applying on the next sync
+            seq = self.__shared_state.publish(port, evicted)
+            with self.__seen_lock:
+                self.__shared_seen[port] = max(seq, self.__shared_seen.get(port, 0))
+
+    def __see(self, port: int, seq: int) -> bool:
+        # Record a change read from the state file, returning whether it is
+        # newer than the last one seen for the worker
+        with self.__seen_lock:
+            if seq <= self.__shared_seen.get(port, 0):
+                return False
+            self.__shared_seen[port] = seq
+            return True
+
+    def begin_request(self, service_key: str, port: int) -> None:
+        ''' Count a request sent to the given worker as in flight. '''
+        self.__services[service_key].begin_request(port)
+
+    def end_request(self, service_key: str, port: int, latency: float = None) -> None:
+        ''' Count a request to the given worker as finished, with the number
+            of seconds it took to respond if known. '''
+        self.__services[service_key].end_request(port, latency)
+
+    def get_load_stats(self) -> dict:
+        ''' Returns the in-flight requests and latency of every worker. '''
+        return {
+            svc_key: self.__services[svc_key].get_instance_stats()
+            for svc_key in self.__services
+        }
+
+    def get_probe_targets(self) -> list:
+        ''' Returns (service key, port) pairs for every worker due a health check. '''
+        return [
+            (svc_key, port)
+            for svc_key in self.__services
+            for port in self.__services[svc_key].get_probe_targets()
+        ]
+
+    def get_health_path(self, service_key: str) -> str:
+        ''' Get the path that health checks of the given service type/key request. '''
+        return self.__health_paths[service_key]
+
+    def get_worker(self, service_key, route: Route = None, exclude = ()) -> int:
+        ''' Get a port of a running instance of the specified type/key,
+            using the strategy of the route it was matched by if it has one.
+            Ports in exclude are not picked. '''
+        return self.__services[service_key].get_instance(route and route.strategy, exclude)
 
     def get_pools(self) -> dict:
         ''' Returns a dictionary representation of the service worker pools,
-            where the pool for each service is represented as a list.'''
+            where the pool for each service maps every port to the state of
+            its circuit breaker. Ports with an 'open' breaker are out of the pool.'''
 
         pools = {}
         for svc_key in self.__services:
-            pools[svc_key] = self.__services[svc_key].get_pool()
+            pools[svc_key] = self.__services[svc_key].get_instance_states()
         return pools
 
-    def get_service_type(self, endpoint) -> str:
+    def get_session(self, port: int):
+        ''' Get the keep-alive requests.Session for the worker with the given port. '''
+        return self.__sessions.get_session(port)
+
+    def get_worker_url(self, port: int) -> str:
+        ''' Get the base URL of the worker with the given port. '''
+        return self.__sessions.get_url(port)
+
+    def get_timeout(self, route: Route = None) -> tuple:
+        ''' Get the (connect, read) timeout to use for requests to workers,
+            or for requests matched by the given route. '''
+        connect_timeout, read_timeout = self.__sessions.get_timeout()
+        if route is None or route.timeout is None:
+            return connect_timeout, read_timeout
+        if isinstance(route.timeout, (tuple, list)):
+            return tuple(route.timeout)
+        return connect_timeout, route.timeout
+
+    def get_pool_stats(self) -> dict:
+        ''' Returns a dictionary of connection pool statistics for every worker,
+            including workers that were removed from their service pool. '''
+
+        stats = {}
+        for svc_key in self.__services:
+            svc = self.__services[svc_key]
+            stats[svc_key] = {
+                port: self.__sessions.get_stats(port) for port in svc.get_ports()
+            }
+        return stats
+
+    def get_route(self, endpoint: str, method: str = 'GET'):
+        ''' Returns the Route for the given endpoint and HTTP method, or None
+            if no service matches. '''
+        return self.__router.match(endpoint, method)
+
+    def get_service_type(self, endpoint: str, method: str = 'GET') -> str:
         ''' Returns the service key/type associated with the given endpoint.
             If no services match the endpoint, returns an empty string. '''
-        
-        for svc_key in self.__services:
-            prefix = self.__services[svc_key].get_prefix()
-            # If there's a match at index 0, return the service type/key
-            if endpoint.find(prefix) == 0:
-                return svc_key
-        
+
+        route = self.__router.match(endpoint, method)
         # No matches
-        return ""
\ No newline at end of file
+        if route is None:
+            return ""
+        return route.service_key
@@ -0,0 +1,260 @@
+# Standard Imports
+import contextvars
+import json
+import logging
+import random
+import re
+import time
+import uuid
+
+# Third-Party Imports
+from flask import g, request
+from sqlalchemy import event
+
+# Identifies a request across the gateway and the services. The gateway keeps
+# a valid one sent by the client, or makes one, and forwards it upstream.
+REQUEST_ID_HEADER = 'X-Request-ID'
+# Tells a service whether the gateway sampled the request for full tracing
+SAMPLED_HEADER = 'X-Trace-Sampled'
+SERVER_TIMING_HEADER = 'Server-Timing'
+TRACE_HEADERS = {REQUEST_ID_HEADER.casefold(), SAMPLED_HEADER.casefold()}
+
+# Request IDs taken from clients must look like one, to keep logs sane
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+
+# The trace of the request being handled. Each request thread of the WSGI
+# servers, and each task of the asyncio gateway, sees its own.
+_current = contextvars.ContextVar('trace', default=None)
+
+logger = logging.getLogger('api_pkg.trace')
+
+class RequestTrace:
+    def __init__(self, request_id: str, sampled: bool) -> None:
+        '''
+        Timings of one request. Phases are the steps every request goes
+        through, like auth or waiting on the upstream, and are timed whether
+        or not the request is sampled. Spans are individual calls, like SQL
+        statements, and are only recorded for sampled requests.
+        '''
+
+        self.request_id = request_id
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        # name -> [seconds, description], in the order first recorded
+        self.phases = {}
+        # (name, seconds, description)
+        self.spans = []
+        # Extra fields for the log line, like the status code
+        self.fields = {}
+
+    def add_phase(self, name: str, seconds: float, description: str = None) -> None:
+        ''' Add seconds to the named phase. '''
+        phase = self.phases.get(name)
+        if phase is None:
+            self.phases[name] = [seconds, description]
+        else:
+            phase[0] += seconds
+            if description is not None:
+                phase[1] = description
+
+    def get_phase(self, name: str) -> float:
+        phase = self.phases.get(name)
+        return phase[0] if phase else 0.0
+
+    def add_span(self, name: str, seconds: float, description: str) -> None:
+        self.spans.append((name, seconds, description))
+
+    def get_elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        ''' Returns the phases, and the spans added up by name, as the value
+            of a Server-Timing header, in milliseconds. '''
+        entries = [format_timing(name, seconds, description) for name, (seconds, description) in self.phases.items()]
+        totals = {}
+        for name, seconds, _ in self.spans:
+            total = totals.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        for name, (seconds, calls) in totals.items():
+            entries.append(format_timing(name, seconds, '%d call%s' % (calls, '' if calls == 1 else 's')))
+        return ', '.join(entries)
+
+    def to_dict(self) -> dict:
+        record = {'request_id': self.request_id, 'sampled': self.sampled}
+        record.update(self.fields)
+        record['duration_ms'] = round(self.get_elapsed() * 1000, 3)
+        record['phases'] = {
+            name: {'ms': round(seconds * 1000, 3), 'desc': description} if description else round(seconds * 1000, 3)
+            for name, (seconds, description) in self.phases.items()
+        }
+        if self.spans:
+            record['spans'] = [
+                {'name': name, 'ms': round(seconds * 1000, 3), 'desc': description}
+                for name, seconds, description in self.spans
+            ]
+        return record
+
+class Tracer:
+    def __init__(self, service_name: str, tracing_config: dict = None) -> None:
+        '''
+        Starts and finishes the trace of each request. Takes an optional
+        tracing config object defined as:
+
+        {
+            "SAMPLE_RATE": <fraction_of_requests_traced_in_full, 0_to_1>,
+            "SLOW_THRESHOLD": <seconds_after_which_requests_are_logged_even_if_not_sampled, or_None>,
+            "SERVER_TIMING": <whether_sampled_responses_get_a_Server-Timing_header>,
+            "LOG": <whether_to_log_sampled_and_slow_requests>
+        }
+
+        Logs are one JSON object per line on the "api_pkg.trace" logger,
+        which writes to stderr unless handlers were set up for it.
+        '''
+
+        tracing_config = tracing_config or {}
+        self.__service_name = service_name
+        self.__sample_rate = tracing_config.get("SAMPLE_RATE", 0.01)
+        self.__slow_threshold = tracing_config.get("SLOW_THRESHOLD", 1)
+        self.__server_timing = tracing_config.get("SERVER_TIMING", True)
+        self.__log = tracing_config.get("LOG", True)
+        if self.__log and not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+    def start(self, request_id: str = None, sampled: str = None) -> RequestTrace:
+        ''' Start the trace of the current request and make it current.
+            Takes the request ID and sampling decision sent along with the
+            request, if any; the gateway only passes the request ID. '''
+        if request_id is None or not REQUEST_ID_PATTERN.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        if sampled is None:
+            sampled = self.__sample_rate > 0 and random.random() < self.__sample_rate
+        else:
+            sampled = sampled == '1'
+        trace = RequestTrace(request_id, sampled)
+        _current.set(trace)
+        return trace
+
+    def finish(self, trace: RequestTrace) -> None:
+        ''' Log the trace if it was sampled or slow, and stop it being current. '''
+        if _current.get() is trace:
+            _current.set(None)
+        if not self.__log:
+            return
+        slow = self.__slow_threshold is not None and trace.get_elapsed() >= self.__slow_threshold
+        if trace.sampled or slow:
+            record = {'service': self.__service_name}
+            record.update(trace.to_dict())
+            if slow:
+                record['slow'] = True
+            logger.info(json.dumps(record))
+
+    def get_server_timing(self, trace: RequestTrace, upstream: str = None) -> str:
+        ''' Returns the Server-Timing header for the response, followed by
+            the one the upstream sent, or None if it should have none. '''
+        if not (self.__server_timing and trace.sampled):
+            return None
+        timing = trace.server_timing()
+        if upstream:
+            timing = timing + ', ' + upstream if timing else upstream
+        return timing
+
+def forward_headers(headers: dict, trace: RequestTrace) -> dict:
+    ''' Returns a copy of the headers of a request to a service, carrying the
+        trace instead of any trace headers the client sent. '''
+    forwarded = {k: v for k, v in headers.items() if k.casefold() not in TRACE_HEADERS}
+    if trace is not None:
+        forwarded[REQUEST_ID_HEADER] = trace.request_id
+        forwarded[SAMPLED_HEADER] = '1' if trace.sampled else '0'
+    return forwarded
+
+def get_current() -> RequestTrace:
+    return _current.get()
+
+def record_phase(name: str, seconds: float, description: str = None) -> None:
+    ''' Add to a phase of the current request's trace, if there is one. '''
+    trace = _current.get()
+    if trace is not None:
+        trace.add_phase(name, seconds, description)
+
+def trace_flask_service(app, tracer: Tracer) -> None:
+    ''' Trace every request to a service's Flask app. Responses carry the
+        request ID back, and Server-Timing when sampled. '''
+
+    @app.before_request
+    def start_trace():
+        g.trace = tracer.start(request.headers.get(REQUEST_ID_HEADER), request.headers.get(SAMPLED_HEADER))
+
+    @app.after_request
+    def add_trace_headers(response):
+        trace = g.get('trace')
+        if trace is not None:
+            trace.fields.update(method=request.method, path=request.path, status=response.status_code)
+            response.headers[REQUEST_ID_HEADER] = trace.request_id
+            trace.add_phase('app', trace.get_elapsed())
+            timing = tracer.get_server_timing(trace)
+            if timing:
+                response.headers[SERVER_TIMING_HEADER] = timing
+        return response
+
+    # Streamed responses are torn down once their body has been sent
+    @app.teardown_request
+    def finish_trace(exception):
+        trace = g.get('trace')
+        if trace is not None:
+            if exception is not None:
+                trace.fields['error'] = type(exception).__name__
+            tracer.finish(trace)
+
+def trace_engine(engine) -> None:
+    ''' Record every statement run on the SQLAlchemy engine as a "db" span of
+        sampled requests. pugsql runs its queries through the engine. '''
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        trace = _current.get()
+        if trace is not None and trace.sampled:
+            conn.info.setdefault('trace_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('trace_started')
+        if started:
+            seconds = time.perf_counter() - started.pop()
+            trace = _current.get()
+            if trace is not None:
+                trace.add_span('db', seconds, describe_statement(statement))
+
+def trace_boto_client(client) -> None:
+    ''' Record every API call of a botocore client as a span of sampled
+        requests, named after the service, e.g. "dynamodb". '''
+
+    def start_call(context, **kwargs):
+        trace = _current.get()
+        if trace is not None and trace.sampled:
+            context['trace_started'] = time.perf_counter()
+
+    def end_call(context, model, **kwargs):
+        started = context.pop('trace_started', None)
+        trace = _current.get()
+        if started is not None and trace is not None:
+            trace.add_span(model.service_model.endpoint_prefix, time.perf_counter() - started, model.name)
+
+    # Handlers of an event also get the events below it, like before-call.dynamodb.Query
+    client.meta.events.register('before-call', start_call)
+    client.meta.events.register('after-call', end_call)
+
+def describe_statement(statement: str) -> str:
+    ''' Returns the statement on one line, cut short. '''
+    text = ' '.join(statement.split())
+    return text if len(text) <= 80 else text[:77] + '...'
+
+def format_timing(name: str, seconds: float, description: str = None) -> str:
+    entry = '%s;dur=%.3f' % (name, seconds * 1000)
+    if description:
+        entry += ';desc="%s"' % description.replace('\\', '\\\\').replace('"', '\\"')
+    return entry
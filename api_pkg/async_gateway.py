@@ -0,0 +1,509 @@
+# An asyncio version of gateway.py for proxying many concurrent requests from
+# a single process. Routing, authentication and worker eviction behave as in
+# gateway.py, and it reads the same routes.cfg.
+#
+# Usage: GATEWAY_APP_CONFIG=routes.cfg python -m api_pkg.async_gateway -p 5000
+
+# Standard Imports
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import time
+
+# Third-Party Imports
+import aiohttp
+from aiohttp import web
+from flask import Config
+from flask_api import status
+from multidict import CIMultiDict
+
+# Local Imports
+from .api_utils.svc_mgr import MicroServiceManager
+from .api_utils.gw_asyncauth import AsyncGatewayBasicAuth, AuthUnavailable, get_authorization
+from .api_utils.health import HealthChecker
+from .api_utils.metrics import GatewayMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .api_utils.shared_state import SharedStateSync
+from .api_utils.request_utils import HOP_BY_HOP_HEADERS
+from .api_utils.retries import RetryPolicies
+from .api_utils.tracing import (
+    Tracer, forward_headers, get_current, record_phase, REQUEST_ID_HEADER, SAMPLED_HEADER, SERVER_TIMING_HEADER
+)
+
+logger = logging.getLogger(__name__)
+
+# Load routes.cfg the same way Flask does for gateway.py, relative to this package
+config = Config(os.path.dirname(os.path.abspath(__file__)))
+config.from_envvar('GATEWAY_APP_CONFIG')
+
+svc_mgr = MicroServiceManager(
+    config['SVC_CONFIG'],
+    config['UPSTREAM'],
+    config.get('POOL_CONFIG'),
+    config.get('HEALTH_CONFIG'),
+    config.get('STATE_CONFIG'),
+)
+# Health checks block, so they run on their own thread as in gateway.py
+health_checker = HealthChecker(svc_mgr, config.get('HEALTH_CONFIG'))
+state_sync = SharedStateSync(svc_mgr, config.get('STATE_CONFIG'))
+
+# Request counts and latencies by route and instance, served on METRICS_CONFIG["PATH"]
+metrics = GatewayMetrics(svc_mgr, config.get('METRICS_CONFIG'))
+
+# Request IDs, and timings of where each request's time went, see tracing.py
+tracer = Tracer('gateway', config.get('TRACING_CONFIG'))
+
+gateway_bauth = AsyncGatewayBasicAuth(
+    config['AUTH_CONFIG'], svc_mgr, config.get('BASIC_AUTH_REALM', ''), metrics, config.get('STATE_CONFIG')
+)
+
+# Failed requests are retried on other workers, and slow GETs hedged, within a shared budget
+retries = RetryPolicies(config['SVC_CONFIG'], config.get('RETRY_CONFIG'))
+
+proxy_config = config.get('PROXY_CONFIG', {})
+CHUNK_SIZE = proxy_config.get('CHUNK_SIZE', 64 * 1024)
+MAX_REQUEST_BODY = proxy_config.get('MAX_REQUEST_BODY', 10 * 1024 * 1024)
+MAX_RESPONSE_BODY = proxy_config.get('MAX_RESPONSE_BODY', 0)
+
+CLIENT_KEY = web.AppKey('client', aiohttp.ClientSession) if hasattr(web, 'AppKey') else 'client'
+
+# Errors raised before a request reached the worker. Older aiohttp versions
+# raise a plain ServerTimeoutError for connect timeouts too.
+CONNECT_ERRORS = (aiohttp.ClientConnectorError,) + (
+    (aiohttp.ConnectionTimeoutError,) if hasattr(aiohttp, 'ConnectionTimeoutError') else ()
+)
+
+def handle_empty_process_pool(request: web.Request, service_type: str) -> web.Response:
+    return web.json_response({
+        'message': service_type.casefold() + " service unavailable.",
+        'method': request.method,
+        'url': str(request.url),
+    }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+@web.middleware
+async def trace_request(request: web.Request, handler) -> web.StreamResponse:
+    ''' Trace every request as gateway.py does. Streamed responses get
+        their trace headers in stream_body, before the headers are sent. '''
+
+    # The client may name the request, the gateway decides whether to sample it
+    trace = request['trace'] = tracer.start(request.headers.get(REQUEST_ID_HEADER))
+    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    try:
+        response = await handler(request)
+        status_code = response.status
+        if not response.prepared:
+            add_trace_headers(trace, response.headers)
+        return response
+    except web.HTTPException as e:
+        status_code = e.status
+        add_trace_headers(trace, e.headers)
+        raise
+    finally:
+        trace.fields.update(method=request.method, path=request.path, status=status_code)
+        tracer.finish(trace)
+
+def add_trace_headers(trace, headers: CIMultiDict) -> None:
+    ''' Add the request ID and, if sampled, the gateway's phases followed by
+        the service's own Server-Timing to the response headers. '''
+    trace.add_phase('total', trace.get_elapsed())
+    headers[REQUEST_ID_HEADER] = trace.request_id
+    timing = tracer.get_server_timing(trace, headers.get(SERVER_TIMING_HEADER))
+    if timing:
+        headers[SERVER_TIMING_HEADER] = timing
+
+@web.middleware
+async def record_request(request: web.Request, handler) -> web.StreamResponse:
+    ''' Record every proxied request in the metrics, timed until its
+        response headers were ready as in gateway.py. '''
+
+    started = time.perf_counter()
+    # Unless the handler returns or raises an HTTP error, aiohttp answers 500
+    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    try:
+        response = await handler(request)
+        status_code = response.status
+        return response
+    except web.HTTPException as e:
+        status_code = e.status
+        raise
+    finally:
+        if request.path != metrics.get_path():
+            route = request.get('route') or svc_mgr.get_route(request.path, request.method)
+            metrics.observe_request(
+                route.service_key if route else '',
+                route.prefix if route else '',
+                request.method,
+                status_code,
+                request.get('headers_ready', time.perf_counter()) - started,
+            )
+
+async def serve_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+async def route_page(request: web.Request) -> web.StreamResponse:
+    client = request.app[CLIENT_KEY]
+    try:
+        if not await gateway_bauth.authenticate(request, client):
+            return gateway_bauth.challenge()
+    except AuthUnavailable as e:
+        return gateway_bauth.unavailable(e)
+
+    trace = request['trace']
+    started = time.perf_counter()
+    route = svc_mgr.get_route(request.path, request.method)
+    request['route'] = route
+
+    # If no matching service was found
+    if route is None:
+        return web.json_response({
+            'url': str(request.url)
+        }, status=status.HTTP_404_NOT_FOUND)
+
+    service_type = route.service_key
+    port = svc_mgr.get_worker(service_type, route)
+    record_phase('route', time.perf_counter() - started)
+
+    # If no instances are left for this service type
+    if port == -1:
+        return handle_empty_process_pool(request, service_type)
+
+    trace.fields.update(upstream=service_type, instance=port)
+
+    # In the API contract, authentication still uses json data
+    # If our current URL is the authentication URL, we need to grab auth data
+    # and put it into the json
+    if request.path == config['AUTH_CONFIG']['AUTH_URL']:
+        auth = get_authorization(request)
+        if auth is None:
+            return gateway_bauth.challenge()
+        request_data = {'username': auth.login, 'password': auth.password}
+    elif MAX_REQUEST_BODY and (request.content_length or 0) > MAX_REQUEST_BODY:
+        return web.json_response({
+            'message': 'Request body exceeds ' + str(MAX_REQUEST_BODY) + ' bytes.',
+            'method': request.method,
+            'url': str(request.url),
+        }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    elif request.body_exists:
+        # Forward the body as it arrives instead of reading it all into memory
+        request_data = request.content
+    else:
+        request_data = None
+
+    request_headers = remove_hop_by_hop(request.headers)
+    if isinstance(request_data, dict):
+        # aiohttp sets the length and type of the form it encodes
+        request_headers.popall('Content-Length', None)
+        request_headers.popall('Content-Type', None)
+    # Carry the gateway's trace instead of any the client sent
+    request_headers.popall(REQUEST_ID_HEADER, None)
+    request_headers.popall(SAMPLED_HEADER, None)
+    request_headers.update(forward_headers({}, trace))
+
+    connect_before = trace.get_phase('connect')
+    attempt = await send_upstream(
+        client, service_type, route, port, request.method, request.path_qs, request_data, request_headers
+    )
+    # A retry or hedge may have been answered by another worker
+    port = attempt.port
+    trace.fields['instance'] = port
+    if attempt.error is not None:
+        return web.json_response({
+            'method': request.method,
+            'url': svc_mgr.get_worker_url(port) + request.path_qs,
+            'exception': type(attempt.error).__name__,
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    # Time until the worker's response headers arrived
+    response = attempt.response
+    latency = attempt.latency
+    # Opening a connection, if one was opened, is part of the latency
+    trace.add_phase('ttfb', max(0.0, latency - (trace.get_phase('connect') - connect_before)))
+
+    try:
+        headers = remove_hop_by_hop(response.headers)
+
+        # The auth service can ask for cached credentials to be dropped
+        gateway_bauth.handle_upstream_headers(service_type, headers)
+
+        # Refuse to relay bodies we already know are too large
+        if MAX_RESPONSE_BODY and (response.content_length or 0) > MAX_RESPONSE_BODY:
+            return web.json_response({
+                'message': 'Upstream response exceeds ' + str(MAX_RESPONSE_BODY) + ' bytes.',
+                'method': request.method,
+                'url': str(request.url),
+            }, status=status.HTTP_502_BAD_GATEWAY)
+
+        # If the response was still a server error response (500+) after any
+        # retries, its worker's breaker counted the failure, see send_attempt
+        if response.status >= 500:
+            response_dict = {
+                'method': request.method,
+                'url': str(request.url),
+            }
+            # If we're in development environment, include information on which
+            # worker was removed, and what's left in the pools
+            if os.environ.get('FLASK_ENV') == 'development':
+                response_dict['status'] = response.status
+                response_dict['pools'] = svc_mgr.get_pools()
+                if attempt.removed:
+                    response_dict['removed'] = service_type + " " + str(port)
+            return web.json_response(response_dict, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return await stream_body(request, response, headers)
+    finally:
+        # Returns the connection to the pool once the body has been read,
+        # or drops it if the client went away part way through
+        attempt.discard(service_type)
+
+class Attempt:
+    ''' One request sent to a worker: its response, or the error it failed with. '''
+
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.response = None
+        self.error = None
+        # Seconds until the response headers arrived
+        self.latency = None
+        # Whether its failure took the worker out of its pool
+        self.removed = False
+
+    def failed(self) -> bool:
+        return self.error is not None or self.response.status >= 500
+
+    def get_status(self) -> int:
+        return self.response.status if self.response is not None else None
+
+    def discard(self, service_type: str) -> None:
+        ''' Release a response once it is relayed or will not be, and count its request as finished. '''
+        if self.response is not None:
+            self.response.release()
+            svc_mgr.end_request(service_type, self.port, self.latency)
+
+async def send_upstream(client: aiohttp.ClientSession, service_type: str, route, port: int, method: str,
+                        path_qs: str, data, headers: CIMultiDict) -> Attempt:
+    ''' Send a request to the worker on port, hedging and retrying it on
+        other workers as send_upstream in gateway.py does. Returns the
+        attempt to relay: the first to succeed, or the last to fail. '''
+
+    policy = retries.get_policy(service_type)
+    retries.budget.deposit()
+    def send(port: int):
+        return send_attempt(client, service_type, route, policy, port, method, path_qs, data, headers)
+    tried = [port]
+
+    delay = policy.get_hedge_delay(route) if method == 'GET' and data is None else None
+    attempt = await (send(port) if delay is None else send_hedged(send, service_type, route, port, delay, tried))
+
+    while attempt.failed() and len(tried) < policy.get_attempts():
+        if not policy.can_retry(
+            method, attempt.get_status(), isinstance(attempt.error, CONNECT_ERRORS), isinstance(data, aiohttp.StreamReader)
+        ):
+            break
+        next_port = svc_mgr.get_worker(service_type, route, exclude=tried)
+        if next_port == -1:
+            break
+        if not retries.budget.withdraw():
+            metrics.observe_retry(service_type, 'retry', sent=False)
+            break
+        metrics.observe_retry(service_type, 'retry')
+        attempt.discard(service_type)
+        tried.append(next_port)
+        attempt = await send(next_port)
+
+    trace = get_current()
+    if trace is not None and len(tried) > 1:
+        trace.fields['tried'] = tried
+    return attempt
+
+async def send_attempt(client: aiohttp.ClientSession, service_type: str, route, policy, port: int, method: str,
+                       path_qs: str, data, headers: CIMultiDict) -> Attempt:
+    ''' Send a request to the worker on port and report how it went to the
+        worker's breaker, the metrics, and the GET latencies hedging uses. '''
+
+    attempt = Attempt(port)
+    url = svc_mgr.get_worker_url(port) + path_qs
+    connect_timeout, read_timeout = svc_mgr.get_timeout(route)
+    # The worker counts as busy with this request until its body has been relayed
+    svc_mgr.begin_request(service_type, port)
+    started = time.perf_counter()
+    try:
+        attempt.response = await client.request(
+            method,
+            url,
+            data=data,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning('%s %s failed: %r', method, url, e)
+        attempt.error = e
+        svc_mgr.end_request(service_type, port)
+        attempt.removed = svc_mgr.report_failure(service_type, port)
+        metrics.observe_upstream(service_type, port)
+        return attempt
+    except asyncio.CancelledError:
+        # The client went away, or a hedge made this request unnecessary
+        svc_mgr.end_request(service_type, port)
+        raise
+
+    # Time until the worker's response headers arrived, for latency-aware strategies
+    attempt.latency = time.perf_counter() - started
+    metrics.observe_upstream(service_type, port, attempt.response.status, attempt.latency)
+    # A server error response (500+) counts against the worker's breaker, which
+    # takes it out of the pool until a health check finds it has recovered
+    if attempt.response.status >= 500:
+        attempt.removed = svc_mgr.report_failure(service_type, port)
+    else:
+        svc_mgr.report_success(service_type, port)
+        if method == 'GET':
+            policy.record_latency(route, attempt.latency)
+    return attempt
+
+async def send_hedged(send, service_type: str, route, port: int, delay: float, tried: list) -> Attempt:
+    ''' Send a GET to the worker on port and, if it has not answered within
+        delay seconds, to another worker as well. Returns the first attempt
+        to succeed, or the last to fail. The other is discarded once done. '''
+
+    remaining = {asyncio.ensure_future(send(port))}
+    attempt = None
+    try:
+        done, remaining = await asyncio.wait(remaining, timeout=delay)
+        if not done:
+            hedge_port = svc_mgr.get_worker(service_type, route, exclude=tried)
+            if hedge_port != -1 and retries.budget.withdraw():
+                metrics.observe_retry(service_type, 'hedge')
+                tried.append(hedge_port)
+                remaining.add(asyncio.ensure_future(send(hedge_port)))
+            elif hedge_port != -1:
+                metrics.observe_retry(service_type, 'hedge', sent=False)
+
+        while True:
+            for task in done:
+                finished = task.result()
+                # Keep the first to succeed, or else the last to fail
+                if attempt is None or attempt.failed():
+                    if attempt is not None:
+                        attempt.discard(service_type)
+                    attempt = finished
+                else:
+                    finished.discard(service_type)
+            if (attempt is not None and not attempt.failed()) or not remaining:
+                return attempt
+            done, remaining = await asyncio.wait(remaining, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        if attempt is not None:
+            attempt.discard(service_type)
+        raise
+    finally:
+        # The slower request is left to finish on its own, as is every
+        # request if the client went away
+        for task in remaining:
+            task.add_done_callback(functools.partial(discard_task, service_type=service_type))
+
+def discard_task(task: asyncio.Task, service_type: str) -> None:
+    if not task.cancelled() and task.exception() is None:
+        task.result().discard(service_type)
+
+async def stream_body(request: web.Request, response: aiohttp.ClientResponse, headers: CIMultiDict) -> web.StreamResponse:
+    ''' Relay the upstream body to the client chunk by chunk. The body is
+        passed through still encoded, so Content-Length and Content-Encoding
+        from the worker stay valid. '''
+
+    client_response = web.StreamResponse(status=response.status, reason=response.reason, headers=headers)
+    add_trace_headers(request['trace'], client_response.headers)
+    request['headers_ready'] = time.perf_counter()
+    await client_response.prepare(request)
+
+    relayed = 0
+    try:
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            relayed += len(chunk)
+            # Bodies without a Content-Length can only be cut short
+            if MAX_RESPONSE_BODY and relayed > MAX_RESPONSE_BODY:
+                logger.warning('Truncated response from %s after %d bytes', response.url, relayed - len(chunk))
+                break
+            await client_response.write(chunk)
+
+        await client_response.write_eof()
+    finally:
+        request['trace'].add_phase('transfer', time.perf_counter() - request['headers_ready'], '%d bytes' % relayed)
+    return client_response
+
+def remove_hop_by_hop(headers) -> CIMultiDict:
+    ''' Returns a copy of the headers without hop-by-hop headers. Repeated
+        headers such as Set-Cookie are kept. '''
+
+    return CIMultiDict(
+        (k, v) for k, v in headers.items() if k.casefold() not in HOP_BY_HOP_HEADERS
+    )
+
+async def open_client(app: web.Application) -> None:
+    ''' Create the shared non-blocking HTTP client with one keep-alive pool per worker. '''
+    pool_config = config.get('POOL_CONFIG', {})
+    connect_timeout, read_timeout = svc_mgr.get_timeout()
+    # As with the requests pools, POOL_SIZE connections are kept per worker and
+    # POOL_BLOCK decides whether requests wait for one or open extra connections
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=pool_config.get('POOL_SIZE', 10) if pool_config.get('POOL_BLOCK', False) else 0,
+    )
+    app[CLIENT_KEY] = aiohttp.ClientSession(
+        connector=connector,
+        trace_configs=[make_connect_timing()],
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+        # Bodies are relayed as-is, and cookies belong to the client, not the gateway
+        auto_decompress=False,
+        cookie_jar=aiohttp.DummyCookieJar(),
+    )
+
+def make_connect_timing() -> aiohttp.TraceConfig:
+    ''' Adds the time taken to open each new connection to the "connect"
+        phase of the request being traced. '''
+
+    async def on_start(session, context, params):
+        context.connect_started = time.perf_counter()
+
+    async def on_end(session, context, params):
+        record_phase('connect', time.perf_counter() - context.connect_started)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_start)
+    trace_config.on_connection_create_end.append(on_end)
+    return trace_config
+
+async def close_client(app: web.Application) -> None:
+    await app[CLIENT_KEY].close()
+
+async def start_health_checker(app: web.Application) -> None:
+    health_checker.start()
+    state_sync.start()
+
+async def stop_health_checker(app: web.Application) -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, health_checker.stop)
+    await loop.run_in_executor(None, state_sync.stop)
+
+def make_app() -> web.Application:
+    ''' Build the aiohttp application. Every path is proxied, like the 404
+        handler of gateway.py. '''
+
+    app = web.Application(client_max_size=MAX_REQUEST_BODY or 1024 ** 2, middlewares=[trace_request, record_request])
+    app.on_startup.append(open_client)
+    app.on_startup.append(start_health_checker)
+    app.on_cleanup.append(close_client)
+    app.on_cleanup.append(stop_health_checker)
+    # Registered before the catch-all route, which is the one that checks auth
+    if metrics.get_path():
+        app.router.add_get(metrics.get_path(), serve_metrics)
+    app.router.add_route('*', '/{tail:.*}', route_page)
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the asyncio gateway.')
+    parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(make_app(), host=args.host, port=args.port)
@@ -1,23 +1,117 @@
 # Inspired by <https://github.com/vishnuvardhan-kumar/loadbalancer.py>
 
 # Standard Imports
-import os
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import contextvars
+import json
 import sys
+import threading
+import time
 
 # Third-Party Imports
-from flask import Flask, request, Response
+from flask import Flask, request, Response, g
 from flask_api import status, exceptions
 import requests
+from urllib3.exceptions import NewConnectionError
+from werkzeug.wsgi import ClosingIterator
 
 # Local Imports
 from .api_utils.svc_mgr import MicroServiceManager
 from .api_utils.gw_basicauth import GatewayBasicAuth
+from .api_utils.health import HealthChecker
+from .api_utils.metrics import GatewayMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .api_utils.shared_state import SharedStateSync
+from .api_utils.request_utils import remove_hop_by_hop
+from .api_utils.response_cache import ResponseCache, CachedResponse, FRESH, STALE
+from .api_utils.retries import RetryPolicies
+from .api_utils.tracing import (
+    Tracer, forward_headers, get_current, record_phase, REQUEST_ID_HEADER, SERVER_TIMING_HEADER
+)
 
 app = Flask(__name__)
 app.config.from_envvar('GATEWAY_APP_CONFIG')
 
-svc_mgr = MicroServiceManager(app.config['SVC_CONFIG'])
-gateway_bauth = GatewayBasicAuth(app, app.config['AUTH_CONFIG'], app.config['UPSTREAM'], svc_mgr)
+svc_mgr = MicroServiceManager(
+    app.config['SVC_CONFIG'],
+    app.config['UPSTREAM'],
+    app.config.get('POOL_CONFIG'),
+    app.config.get('HEALTH_CONFIG'),
+    app.config.get('STATE_CONFIG'),
+)
+# Re-admits workers that were removed from their pool once they recover
+health_checker = HealthChecker(svc_mgr, app.config.get('HEALTH_CONFIG'))
+health_checker.start()
+# Picks up evictions made by other gateway processes, see gunicorn_conf.py
+state_sync = SharedStateSync(svc_mgr, app.config.get('STATE_CONFIG'))
+state_sync.start()
+
+# Request counts and latencies by route and instance, served on METRICS_CONFIG["PATH"]
+metrics = GatewayMetrics(svc_mgr, app.config.get('METRICS_CONFIG'))
+
+# Request IDs, and timings of where each request's time went, see tracing.py
+tracer = Tracer('gateway', app.config.get('TRACING_CONFIG'))
+
+gateway_bauth = GatewayBasicAuth(
+    app, app.config['AUTH_CONFIG'], app.config['UPSTREAM'], svc_mgr, metrics, app.config.get('STATE_CONFIG')
+)
+
+proxy_config = app.config.get('PROXY_CONFIG', {})
+CHUNK_SIZE = proxy_config.get('CHUNK_SIZE', 64 * 1024)
+MAX_REQUEST_BODY = proxy_config.get('MAX_REQUEST_BODY', 10 * 1024 * 1024)
+MAX_RESPONSE_BODY = proxy_config.get('MAX_RESPONSE_BODY', 0)
+
+response_cache = ResponseCache(app.config.get('CACHE_CONFIG'))
+
+# Failed requests are retried on other workers, and slow GETs hedged, within a shared budget
+retries = RetryPolicies(app.config['SVC_CONFIG'], app.config.get('RETRY_CONFIG'))
+# A hedged GET waits for whichever of its requests answers first, so both are
+# sent from these threads. Once they are all busy, GETs are sent unhedged.
+HEDGE_WORKERS = app.config.get('RETRY_CONFIG', {}).get('HEDGE_WORKERS', 32)
+hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+# Methods that never change what a GET returns
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+@app.before_request
+def start_trace():
+    # The client may name the request, the gateway decides whether to sample it
+    g.trace = tracer.start(request.headers.get(REQUEST_ID_HEADER))
+
+@app.after_request
+def record_request(response):
+    if request.path != metrics.get_path():
+        # Requests turned away before routing, e.g. by auth, are routed here
+        route = getattr(g, 'route', None) or svc_mgr.get_route(request.path, request.method)
+        metrics.observe_request(
+            route.service_key if route else '',
+            route.prefix if route else '',
+            request.method,
+            response.status_code,
+            g.trace.get_elapsed(),
+        )
+    return response
+
+@app.after_request
+def add_trace_headers(response):
+    trace = g.trace
+    trace.fields.update(method=request.method, path=request.path, status=response.status_code)
+    trace.add_phase('total', trace.get_elapsed())
+    response.headers[REQUEST_ID_HEADER] = trace.request_id
+    # The gateway's phases come first, then the service's own spans
+    timing = tracer.get_server_timing(trace, response.headers.get(SERVER_TIMING_HEADER))
+    if timing:
+        response.headers[SERVER_TIMING_HEADER] = timing
+    # Proxied bodies finish their trace once relayed, see route_page
+    if not response.direct_passthrough:
+        response.call_on_close(lambda: tracer.finish(trace))
+    return response
+
+# Outside the 404 handler that proxies requests, so it needs no auth
+if metrics.get_path():
+    @app.route(metrics.get_path())
+    def serve_metrics():
+        return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
 
 def handle_empty_process_pool(service_type: str):
     return {
@@ -29,21 +123,39 @@ def handle_empty_process_pool(service_type: str):
 @app.errorhandler(404)
 @gateway_bauth.required
 def route_page(err):
-    service_type = svc_mgr.get_service_type(request.full_path)
+    trace = g.trace
+    started = time.perf_counter()
+    route = svc_mgr.get_route(request.path, request.method)
+    record_phase('route', time.perf_counter() - started)
 
     # If no matching service was found
-    if service_type == "":
+    if route is None:
         return {
             'url': request.url
         }, exceptions.status.HTTP_404_NOT_FOUND
 
-    port = svc_mgr.get_worker(service_type)
+    service_type = route.service_key
+    g.route = route
+
+    # GETs under a cached prefix are answered from the response cache when possible
+    cache_rule = None if has_body() else response_cache.match(request.path, request.method)
+    if cache_rule is not None:
+        started = time.perf_counter()
+        client_response = serve_from_cache(service_type, route, cache_rule)
+        record_phase('cache', time.perf_counter() - started,
+                     client_response.headers['X-Cache'] if client_response is not None else 'BYPASS')
+        if client_response is not None:
+            return client_response
+
+    started = time.perf_counter()
+    port = svc_mgr.get_worker(service_type, route)
+    record_phase('route', time.perf_counter() - started)
     
     # If no instances are left for this service type
     if port == -1:
         return handle_empty_process_pool(service_type)
 
-    upstream = app.config['UPSTREAM'] + ':' + str(port)
+    trace.fields.update(upstream=service_type, instance=port)
 
     # In the API contract, authentication still uses json data
     # If our current URL is the authentication URL, we need to grab auth data
@@ -51,54 +163,494 @@ def route_page(err):
     if request.path == app.config['AUTH_CONFIG']['AUTH_URL']:
         auth = request.authorization
         request_data = {'username':auth.username, 'password':auth.password}
-    else:
-        request_data = request.get_data()
-    try:
-        response = requests.request(
-            request.method,
-            upstream + request.full_path,
-            data=request_data,
-            headers=request.headers,
-            cookies=request.cookies,
-            stream=True,
-        )
-    except requests.exceptions.RequestException as e:
-        app.log_exception(sys.exc_info())
+    elif MAX_REQUEST_BODY and (request.content_length or 0) > MAX_REQUEST_BODY:
         return {
-            'method': e.request.method,
-            'url': e.request.url,
-            'exception': type(e).__name__,
-        }, exceptions.status.HTTP_500_INTERNAL_SERVER_ERROR
+            'message': 'Request body exceeds ' + str(MAX_REQUEST_BODY) + ' bytes.',
+            'method': request.method,
+            'url': request.url,
+        }, exceptions.status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    elif request.content_length:
+        # Forward the body as it arrives instead of reading it all into memory
+        request_data = BodyStream(request.stream, request.content_length)
+    elif has_body():
+        # A chunked body has no length to forward it with, and only its end
+        # tells whether it is too large, so it is read first
+        request_data = read_chunked_body(request.stream, MAX_REQUEST_BODY)
+        if request_data is None:
+            return {
+                'message': 'Request body exceeds ' + str(MAX_REQUEST_BODY) + ' bytes.',
+                'method': request.method,
+                'url': request.url,
+            }, exceptions.status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    else:
+        request_data = None
 
-    headers = remove_item(
-        response.headers,
-        'Transfer-Encoding',
-        'chunked'
+    connect_before = trace.get_phase('connect')
+    attempt = send_upstream(
+        service_type, route, port, request.method, request.full_path, request_data,
+        forward_headers(remove_hop_by_hop(request.headers), trace), request.cookies,
     )
+    # A retry or hedge may have been answered by another worker
+    port = attempt.port
+    trace.fields['instance'] = port
+    if attempt.error is not None:
+        return upstream_error(attempt.error), exceptions.status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    # Time until the worker's response headers arrived
+    response = attempt.response
+    latency = attempt.latency
+    # Opening a connection, if one was opened, is part of the elapsed time
+    trace.add_phase('ttfb', max(0.0, latency - (trace.get_phase('connect') - connect_before)))
+
+    # The auth service can ask for cached credentials to be dropped
+    gateway_bauth.handle_upstream_headers(service_type, response.headers)
+
+    # Refuse to relay bodies we already know are too large
+    if is_too_large(response):
+        attempt.discard(service_type)
+        return too_large_error(request.method, request.url), exceptions.status.HTTP_502_BAD_GATEWAY
 
-    # If the response was a server error response (500+),
-    # Remove the process that exhibited the issue from the pool
+    # If the response was still a server error response (500+) after any
+    # retries, its worker's breaker counted the failure, see send_attempt
     if response.status_code >= 500:
-        svc_mgr.remove_worker(service_type, port)
-        response_dict = {
-            'method': request.method,
-            'url': request.url,
-        }
-        # If we're in development environment, include information on which
-        # worker was removed, and what's left in the pools
-        if os.environ['FLASK_ENV'] == 'development':
-            response_dict['status'] = response.status_code
-            response_dict['pools'] = svc_mgr.get_pools()
-            response_dict['removed'] = service_type + " " + str(port)
-        return response_dict, status.HTTP_500_INTERNAL_SERVER_ERROR
+        # Release the connection back to the worker's pool, the body is never sent
+        attempt.discard(service_type)
+        return (
+            upstream_failure(service_type, attempt, request.method, request.url),
+            status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
 
+    # A write may change what GETs under the route return
+    if request.method not in SAFE_METHODS:
+        response_cache.invalidate(route.prefix)
+
+    return relay_response(service_type, attempt, trace)
+
+def relay_response(service_type: str, attempt, trace, head: bytes = b'') -> Response:
+    ''' Build the client response that streams the attempt's response body,
+        after head if part of it was already read. '''
+
+    response = attempt.response
+    headers = remove_hop_by_hop(remove_item(
+        response.headers,
+        'Transfer-Encoding',
+        'chunked'
+    ))
+    # The WSGI server closes the body once it is done with the response, even
+    # if the client went away before it was relayed. With direct_passthrough
+    # werkzeug hands it the body as-is, so callbacks registered with
+    # Response.call_on_close would never run; the body has to carry them.
     return Response(
-        response=response.content,
+        response=ClosingIterator(stream_body(response, trace, head), [
+            lambda: svc_mgr.end_request(service_type, attempt.port, attempt.latency),
+            lambda: tracer.finish(trace),
+        ]),
         status=response.status_code,
         headers=headers,
         direct_passthrough=True,
     )
 
+def is_too_large(response) -> bool:
+    ''' Returns True if the response has a Content-Length over MAX_RESPONSE_BODY. '''
+    return bool(MAX_RESPONSE_BODY) and int(response.headers.get('Content-Length') or 0) > MAX_RESPONSE_BODY
+
+def too_large_error(method: str, url: str) -> dict:
+    return {
+        'message': 'Upstream response exceeds ' + str(MAX_RESPONSE_BODY) + ' bytes.',
+        'method': method,
+        'url': url,
+    }
+
+def upstream_error(e) -> dict:
+    ''' The body of the 500 response to a request that failed with an error. '''
+    return {
+        'method': e.request.method,
+        'url': e.request.url,
+        'exception': type(e).__name__,
+    }
+
+def upstream_failure(service_type: str, attempt, method: str, url: str) -> dict:
+    ''' The body of the 500 response to a request a worker answered with a server error. '''
+    response_dict = {
+        'method': method,
+        'url': url,
+    }
+    # If we're in development environment, include information on which
+    # worker was removed, and what's left in the pools
+    if app.env == 'development':
+        response_dict['status'] = attempt.get_status()
+        response_dict['pools'] = svc_mgr.get_pools()
+        if attempt.removed:
+            response_dict['removed'] = service_type + " " + str(attempt.port)
+    return response_dict
+
+class Attempt:
+    ''' One request sent to a worker: its response, or the error it failed with. '''
+
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.response = None
+        self.error = None
+        # Seconds until the response headers arrived
+        self.latency = None
+        # Whether its failure took the worker out of its pool
+        self.removed = False
+
+    def failed(self) -> bool:
+        return self.error is not None or self.response.status_code >= 500
+
+    def get_status(self) -> int:
+        return self.response.status_code if self.response is not None else None
+
+    def discard(self, service_type: str) -> None:
+        ''' Drop a response that will not be relayed, and count its request as finished. '''
+        if self.response is not None:
+            self.response.close()
+            svc_mgr.end_request(service_type, self.port, self.latency)
+
+def send_upstream(service_type: str, route, port: int, method: str, full_path: str, data, headers: dict, cookies) -> Attempt:
+    ''' Send a request to the worker on port. As the service's retry policy
+        and the retry budget allow, a GET that is slow to answer is hedged by
+        sending it to a second worker too, and a failed request is retried
+        on a worker it was not sent to yet. Returns the attempt to relay to
+        the client: the first to succeed, or the last to fail. Its worker
+        counts the request as in flight until the attempt is discarded or
+        its body relayed; every other attempt has been discarded already. '''
+
+    policy = retries.get_policy(service_type)
+    retries.budget.deposit()
+    # Runs on hedging threads too, so it is given everything it needs from the request
+    def send(port: int) -> Attempt:
+        return send_attempt(service_type, route, policy, port, method, full_path, data, headers, cookies)
+    tried = [port]
+
+    delay = policy.get_hedge_delay(route) if method == 'GET' and data is None else None
+    attempt = send(port) if delay is None else send_hedged(send, service_type, route, port, delay, tried)
+
+    while attempt.failed() and len(tried) < policy.get_attempts():
+        if not policy.can_retry(
+            method, attempt.get_status(), is_connect_failure(attempt.error), isinstance(data, BodyStream)
+        ):
+            break
+        next_port = svc_mgr.get_worker(service_type, route, exclude=tried)
+        if next_port == -1:
+            break
+        if not retries.budget.withdraw():
+            metrics.observe_retry(service_type, 'retry', sent=False)
+            break
+        metrics.observe_retry(service_type, 'retry')
+        attempt.discard(service_type)
+        tried.append(next_port)
+        attempt = send(next_port)
+
+    trace = get_current()
+    if trace is not None and len(tried) > 1:
+        trace.fields['tried'] = tried
+    return attempt
+
+def send_attempt(service_type: str, route, policy, port: int, method: str, full_path: str, data, headers: dict, cookies) -> Attempt:
+    ''' Send a request to the worker on port and report how it went to the
+        worker's breaker, the metrics, and the GET latencies hedging uses. '''
+
+    attempt = Attempt(port)
+    url = svc_mgr.get_worker_url(port) + full_path
+    svc_mgr.begin_request(service_type, port)
+    try:
+        attempt.response = svc_mgr.get_session(port).request(
+            method,
+            url,
+            data=data,
+            headers=headers,
+            cookies=cookies,
+            stream=True,
+            timeout=svc_mgr.get_timeout(route),
+        )
+    except requests.exceptions.RequestException as e:
+        # Not app.log_exception, which needs the request context hedging threads lack
+        app.logger.warning('%s %s failed: %r', method, url, e)
+        attempt.error = e
+        svc_mgr.end_request(service_type, port)
+        attempt.removed = svc_mgr.report_failure(service_type, port)
+        metrics.observe_upstream(service_type, port)
+        return attempt
+
+    # Time until the worker's response headers arrived, for latency-aware strategies
+    attempt.latency = attempt.response.elapsed.total_seconds()
+    metrics.observe_upstream(service_type, port, attempt.response.status_code, attempt.latency)
+    # A server error response (500+) counts against the worker's breaker, which
+    # takes it out of the pool until a health check finds it has recovered
+    if attempt.response.status_code >= 500:
+        attempt.removed = svc_mgr.report_failure(service_type, port)
+    else:
+        svc_mgr.report_success(service_type, port)
+        if method == 'GET':
+            policy.record_latency(route, attempt.latency)
+    return attempt
+
+def send_hedged(send, service_type: str, route, port: int, delay: float, tried: list) -> Attempt:
+    ''' Send a GET to the worker on port and, if it has not answered within
+        delay seconds, to another worker as well. Returns the first attempt
+        to succeed, or the last to fail. The other is discarded once done. '''
+
+    first = submit_attempt(send, port)
+    if first is None:
+        return send(port)
+    if wait([first], timeout=delay).done:
+        return first.result()
+
+    second = None
+    hedge_port = svc_mgr.get_worker(service_type, route, exclude=tried)
+    if hedge_port != -1:
+        if retries.budget.withdraw():
+            second = submit_attempt(send, hedge_port)
+        else:
+            metrics.observe_retry(service_type, 'hedge', sent=False)
+    if second is None:
+        return first.result()
+    metrics.observe_retry(service_type, 'hedge')
+    tried.append(hedge_port)
+
+    pending = [first, second]
+    for future in as_completed(pending):
+        pending.remove(future)
+        attempt = future.result()
+        if not attempt.failed() or not pending:
+            break
+        attempt.discard(service_type)
+    # The slower request is left to finish on its own
+    for future in pending:
+        future.add_done_callback(lambda future: future.result().discard(service_type))
+    return attempt
+
+def submit_attempt(send, port: int):
+    ''' Send a request from a hedging thread, in the context of the current
+        request so that its trace is recorded. Returns its Future, or None if
+        every hedging thread is busy. '''
+
+    if not hedge_slots.acquire(blocking=False):
+        return None
+    future = hedge_pool.submit(contextvars.copy_context().run, send, port)
+    future.add_done_callback(lambda future: hedge_slots.release())
+    return future
+
+def is_connect_failure(error) -> bool:
+    ''' Returns True if the request failed before it reached the worker. '''
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+def stream_body(response, trace=None, head: bytes = b''):
+    ''' Relay the upstream body to the client chunk by chunk, starting with
+        head if the start of it was already read. The body is passed through
+        still encoded, so Content-Length and Content-Encoding from the worker
+        stay valid. The time taken is the "transfer" phase of the trace. '''
+
+    relayed = len(head)
+    started = time.perf_counter()
+    try:
+        if head:
+            yield head
+        for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+            relayed += len(chunk)
+            # Bodies without a Content-Length can only be cut short
+            if MAX_RESPONSE_BODY and relayed > MAX_RESPONSE_BODY:
+                app.logger.warning(
+                    'Truncated response from %s after %d bytes', response.url, relayed - len(chunk)
+                )
+                break
+            yield chunk
+    finally:
+        # Returns the connection to the worker's pool once the body has been
+        # read, or drops it if the client went away part way through
+        response.close()
+        if trace is not None:
+            trace.add_phase('transfer', time.perf_counter() - started, '%d bytes' % relayed)
+
+def serve_from_cache(service_type: str, route, cache_rule):
+    ''' Answer the current GET from the response cache, fetching the response
+        from a worker if it is missing or expired. Concurrent misses share one
+        fetch, and stale responses are served while one request refreshes
+        them in the background. Returns None if the request should be proxied
+        as usual instead. '''
+
+    username = request.authorization.username if request.authorization else None
+    key = response_cache.make_key(cache_rule, request.full_path, username, request.headers)
+    entry, state = response_cache.lookup(key)
+    if state == FRESH:
+        return cached_response(entry, 'HIT')
+
+    # The client's own conditional headers are answered here, not by the worker
+    headers = forward_headers(remove_hop_by_hop(request.headers), g.trace)
+    headers.pop('If-None-Match', None)
+    headers.pop('If-Modified-Since', None)
+    args = (key, cache_rule, service_type, route, request.full_path, headers, entry)
+
+    flight, leader = response_cache.join_flight(key)
+    if state == STALE:
+        if leader:
+            threading.Thread(target=refresh_cache, args=args, daemon=True).start()
+        return cached_response(entry, 'STALE')
+    if leader:
+        entry = refresh_cache(*args, relay=True)
+        if isinstance(entry, PartialResponse):
+            # Too large to cache, so relayed from the response in hand
+            client_response = relay_response(service_type, entry.attempt, g.trace, entry.head)
+            client_response.headers['X-Cache'] = 'MISS'
+            return client_response
+        return cached_response(entry, 'MISS') if entry is not None else None
+
+    # Another request is already fetching this response, wait for it
+    entry = flight.wait(sum(svc_mgr.get_timeout(route)))
+    return cached_response(entry, 'COALESCED') if entry is not None else None
+
+def refresh_cache(key: tuple, cache_rule, service_type: str, route, full_path: str, headers: dict, stale,
+                  relay: bool = False):
+    ''' Fetch a response for the cache, store it if it can be cached, and
+        hand it to requests waiting on the key. Returns what fetch_for_cache
+        returned, or None if it raised. A PartialResponse is returned for
+        the caller to relay if relay is True, and discarded otherwise; the
+        waiters get None for it and fetch the body themselves. '''
+
+    entry = None
+    try:
+        entry = fetch_for_cache(service_type, route, full_path, headers, stale)
+        if isinstance(entry, CachedResponse):
+            response_cache.store(key, cache_rule, entry)
+    except Exception:
+        app.log_exception(sys.exc_info())
+    finally:
+        response_cache.finish_flight(key, entry if isinstance(entry, CachedResponse) else None)
+        if isinstance(entry, PartialResponse) and not relay:
+            entry.attempt.discard(service_type)
+            entry = None
+    return entry
+
+def fetch_for_cache(service_type: str, route, full_path: str, headers: dict, stale=None):
+    ''' GET a complete response from a worker for the response cache,
+        revalidating the stale copy by its ETag if there is one. Returns a
+        CachedResponse, which is not cacheable if the request failed, a
+        PartialResponse if the body is too large to hold in memory, or None
+        if there is no worker to ask. '''
+
+    port = svc_mgr.get_worker(service_type, route)
+    if port == -1:
+        return None
+    if stale is not None and stale.etag:
+        headers = dict(headers, **{'If-None-Match': stale.etag})
+
+    attempt = send_upstream(service_type, route, port, 'GET', full_path, None, headers, None)
+    if attempt.error is not None:
+        return error_entry(status.HTTP_500_INTERNAL_SERVER_ERROR, upstream_error(attempt.error))
+
+    response = attempt.response
+    partial = None
+    try:
+        gateway_bauth.handle_upstream_headers(service_type, response.headers)
+        # Failures are handed to the requests waiting on the fetch as the
+        # responses route_page would give, rather than fetched again by each
+        if is_too_large(response):
+            return error_entry(status.HTTP_502_BAD_GATEWAY, too_large_error('GET', response.url))
+        if response.status_code >= 500:
+            return error_entry(
+                status.HTTP_500_INTERNAL_SERVER_ERROR, upstream_failure(service_type, attempt, 'GET', response.url)
+            )
+
+        # Still the same, so keep serving the copy we have
+        if response.status_code == 304 and stale is not None:
+            return stale
+
+        max_bytes = response_cache.get_max_entry_bytes()
+        if int(response.headers.get('Content-Length') or 0) > max_bytes:
+            partial = PartialResponse(attempt, b'')
+            return partial
+        body = response.raw.read(max_bytes + 1, decode_content=False)
+        if len(body) > max_bytes:
+            partial = PartialResponse(attempt, body)
+            return partial
+
+        cache_control = response.headers.get('Cache-Control', '').casefold()
+        cacheable = (
+            response.status_code == 200 and
+            'Set-Cookie' not in response.headers and
+            'no-store' not in cache_control and
+            'no-cache' not in cache_control
+        )
+        headers = remove_hop_by_hop(remove_item(
+            response.headers,
+            'Transfer-Encoding',
+            'chunked'
+        ))
+        return CachedResponse(response.status_code, headers, body, cacheable)
+    finally:
+        if partial is None:
+            attempt.discard(service_type)
+
+def error_entry(status_code: int, body: dict) -> CachedResponse:
+    ''' An error response for the requests waiting on a fetch, never cached. '''
+    return CachedResponse(
+        status_code, {'Content-Type': 'application/json'}, json.dumps(body).encode('utf-8'), cacheable=False
+    )
+
+class PartialResponse:
+    ''' A response fetched for the cache whose body is too large to hold in
+        memory, with the part of it already read. '''
+
+    def __init__(self, attempt, head: bytes) -> None:
+        self.attempt = attempt
+        self.head = head
+
+def cached_response(entry: CachedResponse, cache_status: str) -> Response:
+    ''' Build the client response for a cached upstream response, or a 304
+        if the client already has it. X-Cache tells how it was served. '''
+
+    if entry.cacheable and entry.etag and request.if_none_match.contains_raw(entry.etag):
+        return Response(
+            status=status.HTTP_304_NOT_MODIFIED,
+            headers={'ETag': entry.etag, 'X-Cache': cache_status},
+        )
+    headers = dict(entry.headers)
+    headers['X-Cache'] = cache_status
+    if entry.cacheable:
+        headers['Age'] = str(entry.get_age())
+    return Response(entry.body, status=entry.status, headers=headers)
+
+def has_body() -> bool:
+    ''' Returns True if the client sent a request body, with a length or chunked. '''
+    if request.content_length:
+        return True
+    return 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+
+def read_chunked_body(stream, limit: int) -> bytes:
+    ''' Read a request body of unknown length. Returns None if it is longer
+        than limit bytes, unless limit is 0. '''
+    chunks = []
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return b''.join(chunks)
+        size += len(chunk)
+        if limit and size > limit:
+            return None
+        chunks.append(chunk)
+
+class BodyStream:
+    ''' File-like view of the client's request body that requests can send
+        upstream in blocks. Knowing the length up front lets requests send a
+        Content-Length instead of switching to chunked encoding. '''
+
+    def __init__(self, stream, length: int) -> None:
+        self.__stream = stream
+        self.__length = length
+
+    def __len__(self) -> int:
+        return self.__length
+
+    def read(self, size: int = -1) -> bytes:
+        return self.__stream.read(size)
+
 def remove_item(d, k, v):
     if k in d:
         if d[k].casefold() == v.casefold():
@@ -0,0 +1,43 @@
+# Settings for running gateway.py in several processes with gunicorn:
+#
+#   GATEWAY_APP_CONFIG=routes.cfg gunicorn -c api_pkg/gunicorn_conf.py api_pkg.gateway:app
+#
+# GATEWAY_WORKERS and GATEWAY_THREADS set the number of processes and the
+# threads serving requests in each. The processes share worker evictions,
+# and credential invalidations, through the STATE_CONFIG file of routes.cfg.
+
+# Standard Imports
+import multiprocessing
+import os
+import uuid
+
+# Third-Party Imports
+from flask import Config
+
+# Local Imports
+from api_pkg.api_utils.shared_state import RUN_ID_ENVVAR
+
+bind = '127.0.0.1:' + os.environ.get('PORT', '5000')
+workers = int(os.environ.get('GATEWAY_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GATEWAY_THREADS', 8))
+worker_class = 'gthread'
+
+# Every process must import the gateway itself, since the threads it starts
+# for health checks and state sync would not survive a fork
+preload_app = False
+
+def on_starting(server):
+    ''' Give the processes about to start a run id of their own, so they
+        forget evictions left in the state file by a previous run. '''
+    config = Config(os.path.dirname(os.path.abspath(__file__)))
+    config.from_envvar('GATEWAY_APP_CONFIG')
+    path = config.get('STATE_CONFIG', {}).get('PATH')
+    # Without the state file a password change would only clear the
+    # credential cache of the process that proxied it
+    if workers > 1 and not path and config['AUTH_CONFIG'].get('CACHE', {}).get('TTL', 300) > 0:
+        raise RuntimeError(
+            'Several gateway processes need STATE_CONFIG["PATH"] to share credential '
+            'invalidations, or AUTH_CONFIG["CACHE"]["TTL"] set to 0'
+        )
+    # The workers are forked from this process and inherit it
+    os.environ[RUN_ID_ENVVAR] = uuid.uuid4().hex
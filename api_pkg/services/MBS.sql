@@ -34,6 +34,15 @@ CREATE TABLE tweets (
 	FOREIGN KEY(author_id) REFERENCES users(id)
 		ON DELETE CASCADE ON UPDATE CASCADE
 );
+--INDEXES-------------------------------------------------------------
+-- Followers of a user, for fanning tweets out to home timelines
+CREATE INDEX follows_following_id ON follows(following_id);
+-- Recent tweets of a user, by rowid
+CREATE INDEX tweets_author_id ON tweets(author_id);
+-- Pages of the public timeline, newest first. Each entry also holds the
+-- rowid, which breaks ties between tweets posted in the same second.
+CREATE INDEX tweets_timestamp ON tweets(timestamp);
+
 --TRIGGERS------------------------------------------------------------
 
 --SAMPLE INPUTS-------------------------------------------------------
@@ -1,26 +1,65 @@
 # Standard Imports
-from datetime import datetime
+import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import sys
+import threading
+import time
 
 # Third-Party Imports
-import boto3
-from boto3.dynamodb.conditions import Key
-from botocore.exceptions import ClientError
+import click
+from botocore.exceptions import BotoCoreError, ClientError
 from flask import request
 from flask_api import FlaskAPI, exceptions, status
 
 # Local Imports
-from api_pkg.services import dms_schema
+from api_pkg.services import dms_ids, dms_schema, dms_store
 # import request_utils
-from api_pkg.api_utils import request_utils
+from api_pkg.api_utils import request_utils, service_utils, tracing
 
 
 app = FlaskAPI(__name__)
 app.config.from_envvar('DIRECT_MESSAGES_APP_CONFIG')
+
+# Keep-alive connections and a health check for the gateway, see service_utils.py
+service_utils.serve_gateway(app, lambda: boto_client.describe_table(TableName=DM_TABLE_NAME), (BotoCoreError, ClientError))
 DM_TABLE_NAME = 'dms'
 
-boto_client = boto3.client('dynamodb', endpoint_url=app.config['DYNAMODB_URL'])
-dynamodb = boto3.resource('dynamodb', endpoint_url=app.config['DYNAMODB_URL'])
-dm_table = dynamodb.Table(DM_TABLE_NAME)
+# Clients shared by every request thread. DYNAMODB_CONFIG tunes their
+# connection pools, retries and timeouts, see dms_store.make_config and dms_store.MessageStore.
+message_store = dms_store.MessageStore(app.config['DYNAMODB_URL'], DM_TABLE_NAME, app.config.get('DYNAMODB_CONFIG'))
+boto_client = message_store.client
+dynamodb = message_store.resource
+dm_table = message_store.table
+
+# Requests carry the gateway's request ID, and their DynamoDB calls are timed
+# when the gateway sampled them, see tracing.py
+tracer = tracing.Tracer('dms', app.config.get('TRACING_CONFIG'))
+tracing.trace_flask_service(app, tracer)
+tracing.trace_boto_client(boto_client)
+tracing.trace_boto_client(dynamodb.meta.client)
+
+# Message IDs are time-ordered, see dms_ids. NODE_ID keeps instances apart.
+message_ids = dms_ids.MessageIdGenerator(app.config.get('NODE_ID'))
+
+# Attempts at writing a message under a fresh ID if the ID is somehow taken
+PUT_ATTEMPTS = 3
+
+# BatchWriteItem takes at most 25 items per call. Items DynamoDB leaves
+# unprocessed, e.g. when throttled, are retried with exponential backoff.
+BATCH_SIZE = 25
+BATCH_ATTEMPTS = 8
+BATCH_BACKOFF = 0.05
+BATCH_MAX_BACKOFF = 2
+
+# Most messages one bulk send may create
+MAX_BULK_MESSAGES = 1000
+
+# Page size of message listings when the client gives no limit, and the largest it may ask for
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 100
 
 @app.cli.command('init')
 def init_db():
@@ -55,16 +94,16 @@ def init_db():
 		't': 'user1',
 		'fr': 'user2',
 		'ts': '2020-11-27T12:54:59.540514',
-		'mId': '2020-11-27T12:54:59.540514user2',
+		'mId': message_ids.id_at('2020-11-27T12:54:59.540514', 'user1'),
 		'msg': 'Hey user1!',
 	}
 
 	item2 = {
 		't': 'user2',
 		'fr': 'user1',
-		'irt': '2020-11-27T12:54:59.540514user2',
+		'irt': item1['mId'],
 		'ts': '2020-11-27T12:55:39.410569',
-		'mId': '2020-11-27T12:55:39.410569user1',
+		'mId': message_ids.id_at('2020-11-27T12:55:39.410569', 'user2'),
 		'msg': 'hi'
 	}
 
@@ -72,18 +111,161 @@ def init_db():
 		't': 'user1',
 		'fr': 'user2',
 		'ts': '2020-11-27T12:56:13.848139',
-		'mId': '2020-11-27T12:56:13.848139user2',
+		'mId': message_ids.id_at('2020-11-27T12:56:13.848139', 'user1'),
 		'msg': 'Would you like to sign up to our website?',
 		'qro': ['Yes please, I\'m interested!', 'No, thank you!']
 	}
 
 	try:
-		response1 = dm_table.put_item(Item=item1)
-		response2 = dm_table.put_item(Item=item2)
-		response3 = dm_table.put_item(Item=item3)
+		if batch_put([item1, item2, item3]):
+			print("Uh oh, something went wrong!")
 	except ClientError: # If key somehow already exists or some other error occurs
 		print("Uh oh, something went wrong!")
 
+# Load messages from a file of newline-delimited JSON, or - for stdin, e.g.
+# for load testing. Each line is an object with "to", "from" and "message",
+# and optionally "timestamp", "quickreply" and "inReplyTo". Lines are read
+# as they are written, so the file can be of any size.
+@app.cli.command('import-messages')
+@click.argument('source', type=click.File('r'))
+@click.option('--workers', default=4, help='Batches written at the same time.')
+def import_messages(source, workers):
+	started = time.perf_counter()
+	counts = {'written': 0, 'failed': 0, 'skipped': 0}
+	counts_lock = threading.Lock()
+	# Bounds the batches read ahead of the writers, so memory use stays flat
+	slots = threading.BoundedSemaphore(workers * 2)
+
+	def write(batch):
+		try:
+			failed = len(batch_put(batch))
+		except (BotoCoreError, ClientError) as e:
+			print('Batch failed:', e, file=sys.stderr)
+			failed = len(batch)
+		finally:
+			slots.release()
+		with counts_lock:
+			counts['written'] += len(batch) - failed
+			counts['failed'] += failed
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		batch = []
+		for line_number, line in enumerate(source, 1):
+			if not line.strip():
+				continue
+			try:
+				batch.append(message_from_json(json.loads(line)))
+			except (ValueError, KeyError, TypeError) as e:
+				counts['skipped'] += 1
+				if counts['skipped'] <= 10:
+					print('Skipping line %d: %r' % (line_number, e), file=sys.stderr)
+				continue
+			if len(batch) == BATCH_SIZE:
+				slots.acquire()
+				executor.submit(write, batch)
+				batch = []
+			if line_number % 100000 == 0:
+				print('Read %d lines, %.0f messages/s' % (
+					line_number, counts['written'] / (time.perf_counter() - started)))
+		if batch:
+			slots.acquire()
+			executor.submit(write, batch)
+
+	elapsed = time.perf_counter() - started
+	print('Messages written: %d, failed: %d, lines skipped: %d in %.1fs (%.0f messages/s)' % (
+		counts['written'], counts['failed'], counts['skipped'], elapsed, counts['written'] / elapsed))
+
+def message_from_json(data):
+	''' Build a message item from an object in an import file. Raises
+		KeyError, TypeError or ValueError if the object is not valid. '''
+	for field in ('to', 'from', 'message'):
+		if not isinstance(data[field], str):
+			raise TypeError(field + ' must be a string')
+	if 'timestamp' in data:
+		message_id = message_ids.id_at(data['timestamp'], data['to'])
+	else:
+		message_id = message_ids.new_id(data['to'])
+	item = {
+		't': data['to'],
+		'fr': data['from'],
+		'ts': dms_ids.timestamp_of(message_id),
+		'mId': message_id,
+		'msg': data['message'],
+	}
+	if data.get('quickreply'):
+		item['qro'] = list(data['quickreply'])
+	if data.get('inReplyTo'):
+		item['irt'] = data['inReplyTo']
+	return item
+
+# Give messages with timestamp-and-sender IDs new time-ordered IDs, keeping
+# the old ID in lId so that links to them still work.
+@app.cli.command('migrate-ids')
+def migrate_ids():
+	create_legacy_ids_index()
+
+	# Re-key each message in one transaction, so a failed run can just be repeated
+	migrated = 0
+	for item in scan_messages():
+		if dms_ids.is_message_id(item['mId']):
+			continue
+		new_item = dict(item, mId=message_ids.id_at(item['ts'], item['t']), lId=item['mId'])
+		boto_client.transact_write_items(TransactItems=[
+			{'Put': {
+				'TableName': DM_TABLE_NAME,
+				'Item': message_store.serialize(new_item),
+				'ConditionExpression': 'attribute_not_exists(mId)',
+			}},
+			{'Delete': {
+				'TableName': DM_TABLE_NAME,
+				'Key': {'t': {'S': item['t']}, 'mId': {'S': item['mId']}},
+			}},
+		])
+		migrated += 1
+	print('Messages given new IDs:', migrated)
+
+	# Point replies at the new IDs of the messages they reply to
+	new_ids = {item['lId']: item['mId'] for item in scan_messages() if 'lId' in item}
+	relinked = 0
+	for item in scan_messages():
+		if item.get('irt') in new_ids:
+			dm_table.update_item(
+				Key={'t': item['t'], 'mId': item['mId']},
+				UpdateExpression='SET irt = :irt',
+				ExpressionAttributeValues={':irt': new_ids[item['irt']]},
+			)
+			relinked += 1
+	print('Replies relinked:', relinked)
+
+def create_legacy_ids_index():
+	''' Add the legacyIds index to a table created before it existed, and
+		wait for it to be usable. '''
+	description = boto_client.describe_table(TableName=DM_TABLE_NAME)['Table']
+	index_names = {index['IndexName'] for index in description.get('GlobalSecondaryIndexes', [])}
+	if dms_schema.legacy_ids_index['IndexName'] not in index_names:
+		print('Creating the legacyIds index...')
+		boto_client.update_table(
+			TableName=DM_TABLE_NAME,
+			AttributeDefinitions=[{'AttributeName': 'lId', 'AttributeType': 'S'}],
+			GlobalSecondaryIndexUpdates=[{'Create': dms_schema.legacy_ids_index}],
+		)
+	while True:
+		description = boto_client.describe_table(TableName=DM_TABLE_NAME)['Table']
+		statuses = [index['IndexStatus'] for index in description.get('GlobalSecondaryIndexes', [])]
+		if all(s == 'ACTIVE' for s in statuses):
+			return
+		time.sleep(1)
+
+def scan_messages():
+	''' Yields every message in the table, a page at a time. '''
+	scan_args = {}
+	while True:
+		response = dm_table.scan(**scan_args)
+		yield from response['Items']
+		if 'LastEvaluatedKey' not in response:
+			return
+		scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
 	
 @app.route('/api/v1/dms', methods=['GET', 'POST'])
 def handle_direct_message():
@@ -108,26 +290,21 @@ def send_direct_message():
 	# Ideally we would check that the other user exists, but for the purpose of this assignment no check.
 
 	data_to = request.data['to']
-	data_timestamp = datetime.utcnow().isoformat()
-	data_msg_id = data_timestamp + sender
 	data_message = request.data['message']
 	item = {
 		't': data_to,
 		'fr': sender,
-		'ts': data_timestamp,
-		'mId': data_msg_id,
 		'msg': data_message,
 	}
 	if 'quickreply' in posted_fields and len(request.data['quickreply']) > 0:
 		item['qro'] = request.data['quickreply']
 
 	try:
-		response = dm_table.put_item(
-			Item=item,
-			ConditionExpression='attribute_not_exists(mId)'
-		)
+		put_new_message(item)
 	except ClientError: # If key somehow already exists or some other error occurs
 		return {'message': 'Message not created.'}, exceptions.status.HTTP_500_INTERNAL_SERVER_ERROR
+	data_msg_id = item['mId']
+	data_timestamp = item['ts']
 
 
 	return {
@@ -149,27 +326,10 @@ def list_direct_messages_for():
 			'message': 'Cannot specify a \'to\' that is different from provided authorization.'
 		}, status.HTTP_401_UNAUTHORIZED
 
-	try:
-		if 'timestamp' in posted_fields: # timestamp given
-			response = dm_table.query(
-				Select='ALL_ATTRIBUTES',
-				Limit=100,
-				KeyConditionExpression=Key('t').eq(recipient),
-				FilterExpression=Key('ts').gte(request.data['timestamp'])
-			)
-		else: # No timestamp given
-			response = dm_table.query(
-				Select='ALL_ATTRIBUTES',
-				Limit=100,
-				KeyConditionExpression=Key('t').eq(recipient)
-			)
-	except ClientError:
-		return {'message': 'Error on query.'}, exceptions.status.HTTP_500_INTERNAL_SERVER_ERROR
-	
-	# Hide metadata and internal information from API user
-	metadata = response.pop('ResponseMetadata', None)
-	scanned_count = response.pop('ScannedCount', None)
-	return response, status.HTTP_200_OK
+	return query_page(
+		't', recipient,
+		lambda position: {'t': recipient, 'mId': position['mId']},
+	)
 
 @app.route('/api/v1/dms/<string:original>/replies', methods=['GET', 'POST'])
 def handle_replies(original):
@@ -179,35 +339,262 @@ def handle_replies(original):
 		return reply_to_direct_message(original)
 
 def list_replies_to(original):
-	global dm_table
-	username = request.authorization.username
+	original = resolve_message_id(original)
+	# A position in the index also needs the table key of the item
+	return query_page(
+		'irt', original,
+		lambda position: {'irt': original, 'mId': position['mId'], 't': position['t']},
+		index_name='replies',
+	)
+
+@app.route('/api/v1/dms/bulk', methods=['POST'])
+def send_bulk_direct_messages():
+	''' Send one message to many recipients, given a list as "to", or many
+		messages, given a list of {"to", "message", "quickreply"} objects as
+		"messages". '''
+	sender = request.authorization.username
 	posted_fields = {*request.data}
 
+	if 'from' in posted_fields and request.data['from'] != sender:
+		return {
+			'message': 'Cannot specify a \'from\' that is different from provided authorization.'
+		}, status.HTTP_401_UNAUTHORIZED
+
+	if 'messages' in posted_fields:
+		messages = request.data['messages']
+	elif {'to', 'message'} <= posted_fields and isinstance(request.data['to'], list):
+		messages = [
+			{'to': to, 'message': request.data['message'], 'quickreply': request.data.get('quickreply')}
+			for to in request.data['to']
+		]
+	else:
+		return {'missing-fields': ['messages']}, status.HTTP_400_BAD_REQUEST
+
+	if not isinstance(messages, list) or not 0 < len(messages) <= MAX_BULK_MESSAGES:
+		return {
+			'message': 'Send between 1 and ' + str(MAX_BULK_MESSAGES) + ' messages at a time.'
+		}, status.HTTP_400_BAD_REQUEST
+
+	items = []
+	for message in messages:
+		if (not isinstance(message, dict) or not isinstance(message.get('to'), str) or
+				not isinstance(message.get('message'), str)):
+			return {
+				'message': 'Every message needs a \'to\' and a \'message\'.'
+			}, status.HTTP_400_BAD_REQUEST
+		# IDs from one process never repeat, see dms_ids, so batches need no
+		# attribute_not_exists condition, which BatchWriteItem can't take anyway
+		message_id = message_ids.new_id(message['to'])
+		item = {
+			't': message['to'],
+			'fr': sender,
+			'ts': dms_ids.timestamp_of(message_id),
+			'mId': message_id,
+			'msg': message['message'],
+		}
+		if message.get('quickreply'):
+			item['qro'] = message['quickreply']
+		items.append(item)
+
 	try:
-		if 'timestamp' in posted_fields: # timestamp given
-			response = dm_table.query(
-				TableName=DM_TABLE_NAME,
-				IndexName='replies',
-				Select='ALL_ATTRIBUTES',
-				Limit=100,
-				KeyConditionExpression=Key('irt').eq(original),
-				FilterExpression=Key('ts').gte(request.data['timestamp'])
-			)
-		else: # No timestamp given
-			response = dm_table.query(
-				TableName=DM_TABLE_NAME,
-				IndexName='replies',
-				Select='ALL_ATTRIBUTES',
-				Limit=100,
-				KeyConditionExpression=Key('irt').eq(original)
+		unprocessed = batch_put(items)
+	except ClientError:
+		return {'message': 'Messages not created.'}, exceptions.status.HTTP_500_INTERNAL_SERVER_ERROR
+
+	unprocessed_ids = {item['mId'] for item in unprocessed}
+	created = [
+		{'to': item['t'], 'messageId': item['mId'], 'timestamp': item['ts']}
+		for item in items if item['mId'] not in unprocessed_ids
+	]
+	if unprocessed:
+		# Some batches went through, so say which messages did
+		return {
+			'message': 'Not all messages were created.',
+			'created': created,
+			'notCreated': [{'to': item['t']} for item in unprocessed],
+		}, status.HTTP_503_SERVICE_UNAVAILABLE
+	return {'from': sender, 'created': created, 'Count': len(created)}, status.HTTP_201_CREATED
+
+def batch_put(items):
+	''' Write the items with BatchWriteItem, BATCH_SIZE at a time. Items
+		DynamoDB leaves unprocessed are retried up to BATCH_ATTEMPTS times
+		with exponential backoff and jitter. Returns the items that could not
+		be written. Raises ClientError if a batch is rejected outright. '''
+	unwritten = []
+	for start in range(0, len(items), BATCH_SIZE):
+		batch = items[start:start + BATCH_SIZE]
+		pending = {DM_TABLE_NAME: [
+			{'PutRequest': {'Item': message_store.serialize(item)}}
+			for item in batch
+		]}
+		for attempt in range(BATCH_ATTEMPTS):
+			response = boto_client.batch_write_item(RequestItems=pending)
+			pending = response.get('UnprocessedItems') or {}
+			if not pending:
+				break
+			time.sleep(random.uniform(0, min(BATCH_MAX_BACKOFF, BATCH_BACKOFF * 2 ** attempt)))
+		else:
+			left = {request['PutRequest']['Item']['mId']['S'] for request in pending[DM_TABLE_NAME]}
+			unwritten.extend(item for item in batch if item['mId'] in left)
+	return unwritten
+
+def get_since_id():
+	''' Returns the smallest message ID at or after the client's timestamp,
+		or None if it gave none. Message IDs are time-ordered, so "since" is
+		a range on the mId sort key. Raises ValueError if the timestamp is
+		not valid. '''
+	timestamp = get_param('timestamp')
+	if timestamp is None:
+		return None
+	return dms_ids.lower_bound(timestamp)
+
+def resolve_message_id(message_id):
+	''' Returns the current ID of a message, given an ID it had before
+		migrating to time-ordered IDs. Other IDs are returned as they are. '''
+	if dms_ids.is_message_id(message_id):
+		return message_id
+	items, _ = message_store.query('lId', message_id, index_name=dms_schema.legacy_ids_index['IndexName'], limit=1)
+	if items:
+		return items[0]['mId']
+	return message_id
+
+def find_recipient(message_id):
+	''' Look up the recipient of a message through the messageIds index.
+		Returns None if there is no such message. '''
+	items, _ = message_store.query('mId', message_id, index_name='messageIds', limit=1)
+	if items:
+		return items[0]['t']
+	return None
+
+def put_new_message(item, replying_to=None):
+	''' Give the item a new message ID and timestamp, and write it without
+		overwriting any other message. If replying_to is given, it is the
+		table key of a message that must exist, checked in the same
+		transaction. Raises ClientError if it can't write the item. '''
+	for attempt in range(PUT_ATTEMPTS):
+		item['mId'] = message_ids.new_id(item['t'])
+		item['ts'] = dms_ids.timestamp_of(item['mId'])
+		try:
+			if replying_to is None:
+				message_store.put_new(item)
+			else:
+				boto_client.transact_write_items(TransactItems=[
+					{'ConditionCheck': {
+						'TableName': DM_TABLE_NAME,
+						'Key': message_store.serialize(replying_to),
+						'ConditionExpression': 'attribute_exists(mId)',
+					}},
+					{'Put': {
+						'TableName': DM_TABLE_NAME,
+						'Item': message_store.serialize(item),
+						'ConditionExpression': 'attribute_not_exists(mId)',
+					}},
+				])
+			return
+		except ClientError as e:
+			# Only a taken ID is worth another try
+			if not is_id_taken(e) or attempt == PUT_ATTEMPTS - 1:
+				raise
+
+def is_id_taken(error):
+	''' Returns True if the ClientError is from writing a message under an
+		ID that is already taken. '''
+	code = error.response['Error']['Code']
+	if code == 'ConditionalCheckFailedException':
+		return True
+	# The put is the last item of the transaction in put_new_message
+	reasons = error.response.get('CancellationReasons') or []
+	return (
+		code == 'TransactionCanceledException' and len(reasons) == 2 and
+		reasons[0].get('Code') == 'None' and reasons[1].get('Code') == 'ConditionalCheckFailed'
+	)
+
+def is_missing_original(error):
+	''' Returns True if the ClientError is from replying to a message that
+		does not exist. '''
+	reasons = error.response.get('CancellationReasons') or []
+	return (
+		error.response['Error']['Code'] == 'TransactionCanceledException' and
+		len(reasons) > 0 and reasons[0].get('Code') == 'ConditionalCheckFailed'
+	)
+
+def get_param(name):
+	''' Get a parameter from the query string, or from the request body
+		where older clients send it. Returns None if it is not given. '''
+	if name in request.args:
+		return request.args[name]
+	if name in {*request.data}:
+		return request.data[name]
+	return None
+
+def query_page(key_name, key_value, make_start_key, index_name=None):
+	''' Query one page of the messages whose key_name is key_value, from the
+		client's timestamp on, starting after the position in the client's
+		cursor. make_start_key turns a position into the ExclusiveStartKey of
+		the query. The response has a nextCursor when there are more messages. '''
+
+	try:
+		since_id = get_since_id()
+	except ValueError:
+		return {'message': 'timestamp must be an ISO 8601 timestamp.'}, status.HTTP_400_BAD_REQUEST
+
+	limit = get_param('limit')
+	try:
+		limit = DEFAULT_PAGE_SIZE if limit is None else int(limit)
+	except (TypeError, ValueError):
+		limit = 0
+	if not 0 < limit <= MAX_PAGE_SIZE:
+		return {
+			'message': 'limit must be between 1 and ' + str(MAX_PAGE_SIZE) + '.'
+		}, status.HTTP_400_BAD_REQUEST
+
+	start_key = None
+	cursor = get_param('cursor')
+	if cursor is not None:
+		position = decode_cursor(cursor)
+		if position is None:
+			return {'message': 'Invalid cursor.'}, status.HTTP_400_BAD_REQUEST
+		start_key = make_start_key(position)
+
+	# Read one message past the page, so the last page has no cursor
+	# and clients are not sent to an empty one. A query stops after 1 MB,
+	# so it can take several to get there.
+	found = []
+	try:
+		while True:
+			items, start_key = message_store.query(
+				key_name, key_value, since_id,
+				index_name=index_name, limit=limit + 1 - len(found), start_key=start_key
 			)
+			found.extend(items)
+			if len(found) > limit or start_key is None:
+				break
 	except ClientError:
 		return {'message': 'Error on query.'}, exceptions.status.HTTP_500_INTERNAL_SERVER_ERROR
-	
-	# Hide metadata and internal information from API user
-	metadata = response.pop('ResponseMetadata', None)
-	scanned_count = response.pop('ScannedCount', None)
-	return response, status.HTTP_200_OK
+
+	items = found[:limit]
+	page = {'Items': items, 'Count': len(items)}
+	if len(found) > limit:
+		page['nextCursor'] = encode_cursor(items[-1])
+	return page, status.HTTP_200_OK
+
+def encode_cursor(item):
+	''' Returns an opaque cursor for the position after the item. It only holds
+		the item's key, the user and message thread come from the request. '''
+	position = json.dumps({'t': item['t'], 'mId': item['mId']}, separators=(',', ':'))
+	return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+	''' Returns the position in a cursor, or None if it is not a valid cursor. '''
+	try:
+		padded = cursor + '=' * (-len(cursor) % 4)
+		position = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+	except (binascii.Error, UnicodeError, ValueError, AttributeError):
+		return None
+	if (not isinstance(position, dict) or set(position) != {'t', 'mId'} or
+			not all(isinstance(v, str) and v for v in position.values())):
+		return None
+	return position
 
 @request_utils.require_fields({'message'})
 def reply_to_direct_message(original):
@@ -221,40 +608,42 @@ def reply_to_direct_message(original):
 			'You do not need to specify \'from\' other than by providing authentication.'
 		}, status.HTTP_401_UNAUTHORIZED
 	
-	# Make sure a message with the origina messageId exists
-	response = dm_table.query(
-			TableName=DM_TABLE_NAME,
-			IndexName='messageIds',
-			Select='ALL_PROJECTED_ATTRIBUTES',
-			Limit=100,
-			KeyConditionExpression=Key('mId').eq(original)
-	)
+	# Newer IDs name their recipient, which with the ID is the table key of
+	# the message. Older ones have to be looked up in the messageIds index.
+	# A legacy ID can also contain the separator, so only an ID in the new
+	# format is decoded.
+	data_to = dms_ids.recipient_of(original) if dms_ids.is_message_id(original) else None
+	if data_to is None:
+		original = resolve_message_id(original)
+		if dms_ids.is_message_id(original):
+			data_to = dms_ids.recipient_of(original)
+		if data_to is None:
+			data_to = find_recipient(original)
+		if data_to is None:
+			return {
+				'message': 'The message you are trying to reply to does not exist.'
+			}, status.HTTP_404_NOT_FOUND
 
-	if response['Count'] == 0:
-		return {
-			'message': 'The message you are trying to reply to does not exist.'
-		}, status.HTTP_404_NOT_FOUND
-
-	data_to = response['Items'][0]['t']
-	data_timestamp = datetime.utcnow().isoformat()
-	data_msg_id = data_timestamp + sender
 	data_message = request.data['message']
 	item = {
 		't': data_to,
 		'fr': sender,
-		'ts': data_timestamp,
-		'mId': data_msg_id,
 		'msg': data_message,
 		'irt': original
 	}
 
+	# The write checks that the original exists, with a consistent read of
+	# its table key, so a message sent a moment ago can be replied to
 	try:
-		dm_table.put_item(
-			Item=item
-		)
-	except ClientError: # If key somehow already exists or some other error occurs
+		put_new_message(item, replying_to={'t': data_to, 'mId': original})
+	except ClientError as e: # If key somehow already exists or some other error occurs
+		if is_missing_original(e):
+			return {
+				'message': 'The message you are trying to reply to does not exist.'
+			}, status.HTTP_404_NOT_FOUND
 		return {'message': 'Reply not created.'}, exceptions.status.HTTP_500_INTERNAL_SERVER_ERROR
+	data_timestamp = item['ts']
 
-	return {'timestamp': data_timestamp}, status.HTTP_201_CREATED, {
+	return {'messageId': item['mId'], 'timestamp': data_timestamp}, status.HTTP_201_CREATED, {
 		'Location': '/api/v1/dms/' + original + '/replies'
 	}
\ No newline at end of file
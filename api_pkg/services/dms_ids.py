@@ -0,0 +1,129 @@
+# Message IDs are 26 characters of Crockford's base32, encoding 128 bits:
+#
+#   48 bits  milliseconds since the Unix epoch
+#   16 bits  node, so processes on different nodes never collide
+#   64 bits  sequence, random at the start of each millisecond and then
+#            incremented, so IDs from one generator are strictly increasing
+#
+# Like ULIDs, they sort as strings in the order they were made, so a range
+# of the mId sort key is a range of time.
+#
+# An ID can be followed by a dot and its recipient in unpadded base64url.
+# The recipient is the table's partition key, so with it the message can be
+# read or checked by its table key instead of through the messageIds index.
+
+# Standard Imports
+import base64
+import binascii
+from datetime import datetime, timedelta, timezone
+import os
+import secrets
+import socket
+import threading
+import time
+import zlib
+
+ENCODING = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+ID_LENGTH = 26
+RECIPIENT_SEPARATOR = '.'
+
+_SEQ_BITS = 64
+_NODE_BITS = 16
+_MAX_SEQ = (1 << _SEQ_BITS) - 1
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+class MessageIdGenerator:
+    def __init__(self, node: int = None) -> None:
+        '''
+        Makes message IDs for one process. node should be unique to the
+        process among those writing to the same table. By default it is
+        derived from the host name and process ID.
+        '''
+
+        if node is None:
+            node = zlib.crc32(('%s:%d' % (socket.gethostname(), os.getpid())).encode())
+        self.__node = node & ((1 << _NODE_BITS) - 1)
+        self.__last_ms = -1
+        self.__last_seq = 0
+        self.__lock = threading.Lock()
+
+    def new_id(self, recipient: str = None) -> str:
+        ''' Returns an ID greater than every ID this generator made before,
+            ending with the recipient if given. '''
+        with self.__lock:
+            ms = int(time.time() * 1000)
+            if ms > self.__last_ms:
+                # Leave headroom so the sequence can't overflow within the millisecond
+                seq = secrets.randbits(_SEQ_BITS - 1)
+            else:
+                # Same millisecond, or the clock went back: carry on from the last ID
+                ms = self.__last_ms
+                seq = self.__last_seq + 1
+                if seq > _MAX_SEQ:
+                    ms += 1
+                    seq = secrets.randbits(_SEQ_BITS - 1)
+            self.__last_ms = ms
+            self.__last_seq = seq
+        return with_recipient(encode(ms, self.__node, seq), recipient)
+
+    def id_at(self, timestamp: str, recipient: str = None) -> str:
+        ''' Returns a new ID for an ISO timestamp in the past, e.g. to migrate
+            a message. IDs made this way are not ordered within a millisecond. '''
+        return with_recipient(encode(to_millis(timestamp), self.__node, secrets.randbits(_SEQ_BITS - 1)), recipient)
+
+def encode(ms: int, node: int, seq: int) -> str:
+    value = (ms << (_NODE_BITS + _SEQ_BITS)) | (node << _SEQ_BITS) | seq
+    chars = []
+    for _ in range(ID_LENGTH):
+        chars.append(ENCODING[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+def with_recipient(message_id: str, recipient: str = None) -> str:
+    ''' Returns the ID followed by the recipient, or the ID as is if there
+        is no recipient. '''
+    if recipient is None:
+        return message_id
+    token = base64.urlsafe_b64encode(recipient.encode('utf-8')).decode('ascii').rstrip('=')
+    return message_id + RECIPIENT_SEPARATOR + token
+
+def recipient_of(message_id: str):
+    ''' Returns the recipient at the end of an ID, or None if it has none. '''
+    _, separator, token = message_id.partition(RECIPIENT_SEPARATOR)
+    if not separator or not token:
+        return None
+    try:
+        return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+
+def is_message_id(value: str) -> bool:
+    ''' Returns True if the value is an ID in this format, with or without a
+        recipient, rather than an older timestamp-and-sender ID. '''
+    core, separator, _ = value.partition(RECIPIENT_SEPARATOR)
+    return (
+        len(core) == ID_LENGTH and all(c in ENCODING for c in core) and
+        (not separator or recipient_of(value) is not None)
+    )
+
+def timestamp_of(message_id: str) -> str:
+    ''' Returns the ISO timestamp, in UTC, of when the ID was made. '''
+    value = 0
+    for c in message_id[:10]:
+        value = (value << 5) | ENCODING.index(c)
+    # The first 10 characters hold 50 bits, the top 2 of which are always 0
+    dt = datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    return dt.replace(tzinfo=None).isoformat(timespec='microseconds')
+
+def lower_bound(timestamp: str) -> str:
+    ''' Returns the smallest ID made at or after the ISO timestamp, for
+        "newer than" key conditions. Raises ValueError for a bad timestamp. '''
+    return encode(to_millis(timestamp), 0, 0)
+
+def to_millis(timestamp: str) -> int:
+    ''' Milliseconds since the epoch of an ISO timestamp, taken as UTC unless
+        it has an offset. Raises ValueError for a bad timestamp. '''
+    dt = datetime.fromisoformat(timestamp)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - _EPOCH) // timedelta(milliseconds=1)
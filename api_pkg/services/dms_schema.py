@@ -4,7 +4,27 @@
 # irt = in-reply-to
 # msg = message
 # qro = quick-reply-options
-# mId = messageId
+# mId = messageId, a time-ordered ID from dms_ids
+# lId = legacyId, the timestamp-and-sender ID a message had before migrating
+
+# Finds migrated messages by their old ID. Only messages that were migrated
+# have an lId, so the index stays small.
+legacy_ids_index = {
+    'IndexName': 'legacyIds',
+    'KeySchema': [
+        {
+            'AttributeName': 'lId',
+            'KeyType': 'HASH'
+        }
+    ],
+    'Projection': {
+        'ProjectionType': 'KEYS_ONLY'
+    },
+    'ProvisionedThroughput': {
+        'ReadCapacityUnits': 5,
+        'WriteCapacityUnits': 5
+    }
+}
 
 dm_table_schema = {
     'TableName': 'dms',
@@ -30,6 +50,10 @@ dm_table_schema = {
         {
             'AttributeName': 'irt',
             'AttributeType': 'S'
+        },
+        {
+            'AttributeName': 'lId',
+            'AttributeType': 'S'
         }
     ],
     'ProvisionedThroughput':{
@@ -73,5 +97,6 @@ dm_table_schema = {
             'ReadCapacityUnits': 10,
             'WriteCapacityUnits': 10
         }
-    }]
+    },
+    legacy_ids_index]
 }
\ No newline at end of file
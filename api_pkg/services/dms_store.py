@@ -0,0 +1,124 @@
+# DynamoDB access for the DMs service. The hot paths (reading a page of
+# messages, writing one) go through MessageStore, which can use the boto3
+# resource layer or talk to the low-level client directly.
+
+# Third-Party Imports
+import boto3
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
+
+def make_config(dynamo_config: dict = None) -> Config:
+    '''
+    Build the botocore config of the DynamoDB client from an optional
+    config object defined as:
+
+    {
+        "POOL_SIZE": <connections_kept_to_dynamodb>,
+        "RETRY_MODE": <"legacy", "standard" or "adaptive">,
+        "MAX_ATTEMPTS": <attempts_per_call_including_the_first>,
+        "CONNECT_TIMEOUT": <seconds>,
+        "READ_TIMEOUT": <seconds>
+    }
+
+    botocore keeps 10 connections by default, fewer than the threads of a
+    busy service, which then wait on the pool. Adaptive retries also slow
+    the client down when DynamoDB throttles it, instead of retrying at once.
+    '''
+
+    dynamo_config = dynamo_config or {}
+    return Config(
+        max_pool_connections=dynamo_config.get("POOL_SIZE", 50),
+        retries={
+            'mode': dynamo_config.get("RETRY_MODE", 'adaptive'),
+            'max_attempts': dynamo_config.get("MAX_ATTEMPTS", 5),
+        },
+        connect_timeout=dynamo_config.get("CONNECT_TIMEOUT", 1),
+        read_timeout=dynamo_config.get("READ_TIMEOUT", 5),
+    )
+
+class MessageStore:
+    def __init__(self, endpoint_url: str, table_name: str, dynamo_config: dict = None) -> None:
+        '''
+        The DynamoDB client and table handle shared by every request thread
+        of the service. Takes the same config object as make_config,
+        plus "LOW_LEVEL": whether query and put_new skip the resource layer
+        and call the client with expressions and typed values built here.
+        '''
+
+        dynamo_config = dynamo_config or {}
+        config = make_config(dynamo_config)
+        # Not the resource's own client: the resource hooks (de)serializing
+        # into that one, which would serialize typed values a second time
+        self.client = boto3.client('dynamodb', endpoint_url=endpoint_url, config=config)
+        self.resource = boto3.resource('dynamodb', endpoint_url=endpoint_url, config=config)
+        self.table = self.resource.Table(table_name)
+        self.__table_name = table_name
+        self.__low_level = dynamo_config.get("LOW_LEVEL", False)
+        self.__serializer = TypeSerializer()
+        self.__deserializer = TypeDeserializer()
+
+    def query(self, key_name: str, key_value: str, since_id: str = None, index_name: str = None,
+              limit: int = None, start_key: dict = None) -> tuple:
+        ''' Returns the messages whose key_name is key_value, in mId order,
+            from mId since_id on if given, and the LastEvaluatedKey to query
+            the rest from, or None if there are no more. index_name, limit and
+            start_key (an ExclusiveStartKey) are passed on to the query.
+            DynamoDB stops a query after 1 MB, so fewer than limit messages
+            can come back with more to read. '''
+
+        if not self.__low_level:
+            key_condition = Key(key_name).eq(key_value)
+            if since_id is not None:
+                key_condition = key_condition & Key('mId').gte(since_id)
+            query_args = {'KeyConditionExpression': key_condition}
+            if index_name is not None:
+                query_args['IndexName'] = index_name
+            if limit is not None:
+                query_args['Limit'] = limit
+            if start_key is not None:
+                query_args['ExclusiveStartKey'] = start_key
+            response = self.table.query(**query_args)
+            return response['Items'], response.get('LastEvaluatedKey')
+
+        query_args = {
+            'TableName': self.__table_name,
+            'KeyConditionExpression': '#k = :k',
+            'ExpressionAttributeNames': {'#k': key_name},
+            'ExpressionAttributeValues': {':k': {'S': key_value}},
+        }
+        if since_id is not None:
+            query_args['KeyConditionExpression'] += ' AND #m >= :m'
+            query_args['ExpressionAttributeNames']['#m'] = 'mId'
+            query_args['ExpressionAttributeValues'][':m'] = {'S': since_id}
+        if index_name is not None:
+            query_args['IndexName'] = index_name
+        if limit is not None:
+            query_args['Limit'] = limit
+        if start_key is not None:
+            query_args['ExclusiveStartKey'] = {k: {'S': v} for k, v in start_key.items()}
+        deserialize = self.__deserializer.deserialize
+        response = self.client.query(**query_args)
+        items = [{k: deserialize(v) for k, v in item.items()} for item in response['Items']]
+        last_key = response.get('LastEvaluatedKey')
+        if last_key is not None:
+            last_key = {k: deserialize(v) for k, v in last_key.items()}
+        return items, last_key
+
+    def put_new(self, item: dict) -> None:
+        ''' Write the message unless its mId is taken. Raises ClientError,
+            with code ConditionalCheckFailedException if it is taken. '''
+
+        if not self.__low_level:
+            self.table.put_item(Item=item, ConditionExpression='attribute_not_exists(mId)')
+            return
+        self.client.put_item(
+            TableName=self.__table_name,
+            Item=self.serialize(item),
+            ConditionExpression='attribute_not_exists(mId)',
+        )
+
+    def serialize(self, item: dict) -> dict:
+        ''' Returns the item in the typed form the low-level client takes. '''
+        serialize = self.__serializer.serialize
+        return {k: serialize(v) for k, v in item.items()}
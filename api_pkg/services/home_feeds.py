@@ -0,0 +1,166 @@
+# Home timelines materialized on write. When a user posts, the rowid of the
+# tweet is pushed onto a bounded list for each of their followers, so reading
+# a home timeline is a read of one list instead of a join over every followee.
+#
+# Authors with more than CELEBRITY_THRESHOLD followers are not fanned out,
+# that would be one write per follower for every tweet. Their tweets are
+# merged into the timeline when it is read instead, see timelines_api.py.
+
+# Standard Imports
+from collections import deque
+import sqlite3
+import threading
+
+class MemoryFeedStore:
+    def __init__(self, max_length: int) -> None:
+        '''
+        Home timelines kept in the memory of this process. Only suitable
+        for a single timelines instance, as other instances don't see it.
+        '''
+
+        self.__max_length = max_length
+        # user_id -> deque of tweet rowids, newest last
+        self.__feeds = {}
+        self.__celebrities = set()
+        self.__lock = threading.Lock()
+
+    def push(self, user_ids: list, tweet_rowid: int) -> None:
+        ''' Add the tweet to the home timeline of each user. '''
+        with self.__lock:
+            for user_id in user_ids:
+                feed = self.__feeds.get(user_id)
+                if feed is None:
+                    feed = self.__feeds[user_id] = deque(maxlen=self.__max_length)
+                feed.append(tweet_rowid)
+
+    def read(self, user_id: int, limit: int) -> list:
+        ''' Returns up to limit tweet rowids from the home timeline of the
+            user, newest first. '''
+        with self.__lock:
+            feed = self.__feeds.get(user_id, ())
+            return [feed[-i] for i in range(1, min(limit, len(feed)) + 1)]
+
+    def replace(self, user_id: int, tweet_rowids: list) -> None:
+        ''' Set the home timeline of the user, given tweet rowids in any order. '''
+        feed = deque(sorted(tweet_rowids)[-self.__max_length:], maxlen=self.__max_length)
+        with self.__lock:
+            self.__feeds[user_id] = feed
+
+    def get_celebrities(self) -> set:
+        with self.__lock:
+            return set(self.__celebrities)
+
+    def set_celebrity(self, author_id: int, is_celebrity: bool) -> None:
+        with self.__lock:
+            if is_celebrity:
+                self.__celebrities.add(author_id)
+            else:
+                self.__celebrities.discard(author_id)
+
+    def close(self) -> None:
+        pass
+
+class SqliteFeedStore:
+    def __init__(self, path: str, max_length: int) -> None:
+        '''
+        Home timelines kept in an SQLite file, which every timelines
+        instance on the host can share. Each thread gets its own connection.
+        '''
+
+        self.__path = path
+        self.__max_length = max_length
+        self.__local = threading.local()
+        db = self.__connect()
+        with db:
+            db.executescript('''
+                CREATE TABLE IF NOT EXISTS home_feed (
+                    user_id     INTEGER NOT NULL,
+                    tweet_rowid INTEGER NOT NULL,
+                    PRIMARY KEY(user_id, tweet_rowid)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS celebrities (
+                    author_id   INTEGER PRIMARY KEY
+                );
+            ''')
+
+    def __connect(self) -> sqlite3.Connection:
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = self.__local.db = sqlite3.connect(self.__path, timeout=10, isolation_level=None)
+            # Readers don't block the writer, nor the writer readers
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.isolation_level = 'IMMEDIATE'
+        return db
+
+    def push(self, user_ids: list, tweet_rowid: int) -> None:
+        ''' Add the tweet to the home timeline of each user, and trim each
+            timeline back to its newest max_length tweets. '''
+        db = self.__connect()
+        rows = [(user_id, tweet_rowid) for user_id in user_ids]
+        with db:
+            db.executemany('INSERT OR IGNORE INTO home_feed(user_id, tweet_rowid) VALUES (?, ?)', rows)
+            db.executemany('''
+                DELETE FROM home_feed WHERE user_id = ?1 AND tweet_rowid <= (
+                    SELECT tweet_rowid FROM home_feed WHERE user_id = ?1
+                    ORDER BY tweet_rowid DESC LIMIT 1 OFFSET ?2
+                )
+            ''', [(user_id, self.__max_length) for user_id in user_ids])
+
+    def read(self, user_id: int, limit: int) -> list:
+        ''' Returns up to limit tweet rowids from the home timeline of the
+            user, newest first. '''
+        rows = self.__connect().execute(
+            'SELECT tweet_rowid FROM home_feed WHERE user_id = ? ORDER BY tweet_rowid DESC LIMIT ?',
+            (user_id, limit)
+        )
+        return [row[0] for row in rows]
+
+    def replace(self, user_id: int, tweet_rowids: list) -> None:
+        ''' Set the home timeline of the user, given tweet rowids in any order. '''
+        db = self.__connect()
+        with db:
+            db.execute('DELETE FROM home_feed WHERE user_id = ?', (user_id,))
+            db.executemany(
+                'INSERT OR IGNORE INTO home_feed(user_id, tweet_rowid) VALUES (?, ?)',
+                [(user_id, rowid) for rowid in sorted(tweet_rowids)[-self.__max_length:]]
+            )
+
+    def get_celebrities(self) -> set:
+        return {row[0] for row in self.__connect().execute('SELECT author_id FROM celebrities')}
+
+    def set_celebrity(self, author_id: int, is_celebrity: bool) -> None:
+        db = self.__connect()
+        with db:
+            if is_celebrity:
+                db.execute('INSERT OR IGNORE INTO celebrities(author_id) VALUES (?)', (author_id,))
+            else:
+                db.execute('DELETE FROM celebrities WHERE author_id = ?', (author_id,))
+
+    def close(self) -> None:
+        ''' Close the connection of the calling thread. '''
+        db = getattr(self.__local, 'db', None)
+        if db is not None:
+            db.close()
+            self.__local.db = None
+
+def make_feed_store(feed_config: dict):
+    '''
+    Returns the store of home timelines given a home timeline config object
+    defined as:
+
+    {
+        "STORE": <"sqlite" or "memory">,
+        "PATH": <file_of_the_sqlite_store>,
+        "MAX_LENGTH": <tweets_kept_per_home_timeline>,
+        "CELEBRITY_THRESHOLD": <followers_above_which_tweets_are_not_fanned_out>
+    }
+    '''
+
+    max_length = feed_config.get("MAX_LENGTH", 800)
+    store = feed_config.get("STORE", 'sqlite')
+    if store == 'memory':
+        return MemoryFeedStore(max_length)
+    if store == 'sqlite':
+        return SqliteFeedStore(feed_config.get("PATH", 'api_pkg/services/home_feeds.db'), max_length)
+    raise ValueError('Unknown home timeline store: ' + str(store))
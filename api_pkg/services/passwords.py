@@ -0,0 +1,141 @@
+# Password hashing for the users service. Hashes are computed in a pool of
+# worker processes, so a slow key derivation function neither holds the GIL
+# of the service nor ties up its request threads beyond waiting.
+#
+# Hashes are stored as "<method>$<salt>$<hex digest>", the format werkzeug
+# uses, so hashes made with older settings can still be checked and are
+# replaced on the next successful login, see PasswordHasher.verify.
+
+# Standard Imports
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+
+# Third-Party Imports
+import werkzeug.security as wk_s
+
+class HashingBusy(Exception):
+    ''' Raised when every worker is busy and the queue of hashes is full. '''
+
+class PasswordHasher:
+    def __init__(self, password_config: dict = None) -> None:
+        '''
+        Takes an optional password config object defined as:
+
+        {
+            "METHOD": <"scrypt" or "pbkdf2">,
+            "SCRYPT_N": <cpu_and_memory_cost, a_power_of_2>,
+            "SCRYPT_R": <block_size>,
+            "SCRYPT_P": <parallelization>,
+            "PBKDF2_ITERATIONS": <iterations_of_pbkdf2_sha256>,
+            "SALT_LENGTH": <characters_of_salt>,
+            "WORKERS": <processes_that_hash, 0_to_hash_on_the_request_thread>,
+            "MAX_PENDING": <hashes_queued_or_running_before_HashingBusy>,
+            "TIMEOUT": <seconds_to_wait_for_a_hash>
+        }
+        '''
+
+        password_config = password_config or {}
+        method = password_config.get("METHOD", 'scrypt')
+        if method == 'scrypt':
+            self.__method = 'scrypt:%d:%d:%d' % (
+                password_config.get("SCRYPT_N", 2 ** 15),
+                password_config.get("SCRYPT_R", 8),
+                password_config.get("SCRYPT_P", 1),
+            )
+        elif method == 'pbkdf2':
+            self.__method = 'pbkdf2:sha256:%d' % password_config.get("PBKDF2_ITERATIONS", 260000)
+        else:
+            raise ValueError('Unknown password hashing method: ' + str(method))
+        self.__salt_length = password_config.get("SALT_LENGTH", 16)
+        self.__workers = password_config.get("WORKERS", os.cpu_count() or 1)
+        self.__timeout = password_config.get("TIMEOUT", 10)
+        self.__pending = threading.BoundedSemaphore(password_config.get("MAX_PENDING", 64))
+
+        # Started on first use, so flask commands that never hash don't start it
+        self.__pool = None
+        self.__pool_lock = threading.Lock()
+
+    def get_method(self) -> str:
+        return self.__method
+
+    def hash(self, password: str) -> str:
+        ''' Returns a new hash of the password with the configured method.
+            Raises HashingBusy if the pool is saturated. '''
+        return self.__run(hash_password, password, self.__method, self.__salt_length)
+
+    def verify(self, pw_hash: str, password: str) -> tuple:
+        ''' Returns (matches, needs_rehash): whether the password matches the
+            hash, and whether the hash was made with other settings than the
+            configured ones and should be replaced. Raises HashingBusy if the
+            pool is saturated. '''
+        matches = self.__run(check_password, pw_hash, password)
+        return matches, matches and pw_hash.split('$', 1)[0] != self.__method
+
+    def close(self) -> None:
+        with self.__pool_lock:
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=False)
+                self.__pool = None
+
+    def __run(self, fn, *args):
+        if self.__workers == 0:
+            return fn(*args)
+        if not self.__pending.acquire(timeout=self.__timeout):
+            raise HashingBusy()
+        pool = self.__get_pool()
+        try:
+            return pool.submit(fn, *args).result(timeout=self.__timeout)
+        except FutureTimeoutError:
+            raise HashingBusy()
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for memory. Start a new pool next time.
+            with self.__pool_lock:
+                if self.__pool is pool:
+                    self.__pool = None
+            pool.shutdown(wait=False)
+            raise HashingBusy()
+        finally:
+            self.__pending.release()
+
+    def __get_pool(self) -> ProcessPoolExecutor:
+        with self.__pool_lock:
+            if self.__pool is None:
+                # Forking a process that runs request threads can copy a lock
+                # some other thread holds, so start clean interpreters instead
+                self.__pool = ProcessPoolExecutor(
+                    max_workers=self.__workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            return self.__pool
+
+def hash_password(password: str, method: str, salt_length: int) -> str:
+    ''' Returns "<method>$<salt>$<hex digest>" of the password. '''
+    if not method.startswith('scrypt:'):
+        return wk_s.generate_password_hash(password, method, salt_length)
+    salt = wk_s.gen_salt(salt_length)
+    return '%s$%s$%s' % (method, salt, _scrypt(password, method, salt))
+
+def check_password(pw_hash: str, password: str) -> bool:
+    ''' Returns True if the password matches the hash. Hashes made by
+        werkzeug, such as the older salted sha3_512 ones, are checked by
+        werkzeug. '''
+    if not pw_hash.startswith('scrypt:'):
+        return wk_s.check_password_hash(pw_hash, password)
+    try:
+        method, salt, digest = pw_hash.split('$', 2)
+        return hmac.compare_digest(_scrypt(password, method, salt), digest)
+    except ValueError:
+        return False
+
+def _scrypt(password: str, method: str, salt: str) -> str:
+    n, r, p = (int(value) for value in method[len('scrypt:'):].split(':'))
+    return hashlib.scrypt(
+        password.encode('utf-8'), salt=salt.encode('utf-8'),
+        n=n, r=r, p=p, maxmem=132 * n * r * p, dklen=64
+    ).hex()
@@ -0,0 +1,2 @@
+-- :name all_user_ids :many
+SELECT id FROM users;
@@ -0,0 +1,4 @@
+-- :name celebrity_ids :many
+SELECT following_id AS id FROM follows
+GROUP BY following_id
+HAVING COUNT(*) > :threshold;
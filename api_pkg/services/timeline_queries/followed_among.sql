@@ -0,0 +1,3 @@
+-- :name followed_among :many
+SELECT following_id AS id FROM follows
+WHERE user_id = :user_id AND following_id IN :author_ids;
@@ -0,0 +1,3 @@
+-- :name follower_count :one
+SELECT COUNT(*) AS followers FROM follows
+WHERE following_id = :author_id;
@@ -0,0 +1,3 @@
+-- :name followers :many
+SELECT user_id FROM follows
+WHERE following_id = :author_id;
@@ -0,0 +1,7 @@
+-- :name home_tweet_rowids :many
+SELECT rowid FROM tweets
+WHERE author_id IN ( SELECT following_id FROM follows
+						WHERE :user_id = user_id)
+	AND author_id NOT IN :excluded_ids
+ORDER BY rowid DESC
+LIMIT :limit;
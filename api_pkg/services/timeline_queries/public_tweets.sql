@@ -0,0 +1,5 @@
+-- :name public_tweets :many
+SELECT tweets.rowid AS rowid, username, content_text, timestamp FROM tweets, users
+WHERE tweets.author_id = users.id AND (timestamp, tweets.rowid) < (:timestamp, :id)
+ORDER BY tweets.timestamp DESC, tweets.rowid DESC
+LIMIT :limit;
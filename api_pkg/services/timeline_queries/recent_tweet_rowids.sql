@@ -0,0 +1,5 @@
+-- :name recent_tweet_rowids :many
+SELECT rowid FROM tweets
+WHERE author_id IN :author_ids
+ORDER BY rowid DESC
+LIMIT :limit;
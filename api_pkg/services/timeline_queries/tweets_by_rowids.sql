@@ -0,0 +1,5 @@
+-- :name tweets_by_rowids :many
+SELECT tweets.rowid AS rowid, username, content_text, timestamp FROM tweets, users
+WHERE tweets.rowid IN :rowids AND users.id = tweets.author_id
+	AND tweets.author_id IN ( SELECT following_id FROM follows
+						WHERE :user_id = user_id);
@@ -1,16 +1,60 @@
+# Standard Imports
+import base64
+import binascii
+import json
+import threading
+
 # Third-Party Imports
 import pugsql
-from flask import request, g
+from flask import request, g, Response
 from flask_api import status, FlaskAPI
 
 # Local Imports
-from api_pkg.api_utils import request_utils
+from api_pkg.api_utils import request_utils, service_utils, sqlite_engine, tracing
+from api_pkg.services import home_feeds
 
 app = FlaskAPI(__name__)
 app.config.from_envvar('TIMELINES_APP_CONFIG')
 
+# Keep-alive connections and a health check for the gateway, see service_utils.py
+service_utils.serve_gateway(app, lambda: get_db().cursor().execute('SELECT 1'))
+
 queries = pugsql.module('api_pkg/services/timeline_queries/')
-queries.connect(app.config['DATABASE_URL'])
+# Pooled connections set up for several processes sharing the database
+# file, see sqlite_engine.py. Fail now if the settings don't take effect.
+queries.setengine(sqlite_engine.make_engine(app.config['DATABASE_URL'], app.config.get('SQLITE_CONFIG')))
+sqlite_engine.check_pragmas(queries.engine, app.config.get('SQLITE_CONFIG'))
+
+# Requests carry the gateway's request ID, and their queries are timed when
+# the gateway sampled them, see tracing.py
+tracer = tracing.Tracer('timelines', app.config.get('TRACING_CONFIG'))
+tracing.trace_flask_service(app, tracer)
+tracing.trace_engine(queries.engine)
+
+# Tweets on a home timeline page
+HOME_PAGE_SIZE = 25
+
+# Tweets on a public timeline page when the client gives no limit, and the most it may ask for
+PUBLIC_PAGE_SIZE = 25
+MAX_PUBLIC_PAGE_SIZE = 100
+
+# Position before every tweet. SQLite timestamps are 'YYYY-MM-DD HH:MM:SS'.
+NEWEST_POSITION = {'timestamp': '9999-12-31 23:59:59', 'rowid': 0}
+
+# With FANOUT in HOME_TIMELINE_CONFIG, tweets are pushed to their author's
+# followers when posted and home timelines are read from those lists, see
+# home_feeds.py. Otherwise every read joins the tweets of every followee.
+home_timeline_config = app.config.get('HOME_TIMELINE_CONFIG', {})
+feed_store = None
+if home_timeline_config.get("FANOUT", False):
+	feed_store = home_feeds.make_feed_store(home_timeline_config)
+CELEBRITY_THRESHOLD = home_timeline_config.get("CELEBRITY_THRESHOLD", 10000)
+FEED_LENGTH = home_timeline_config.get("MAX_LENGTH", 800)
+
+# A store in this process's memory starts out empty, so it is backfilled
+# before the first read
+backfill_lock = threading.Lock()
+needs_backfill = isinstance(feed_store, home_feeds.MemoryFeedStore)
 
 # Get a database Engine object
 def get_db():
@@ -36,6 +80,8 @@ def init_db():
 			print('Creating new users, follows, and tweets tables...')
 			db.cursor().executescript(f.read())
 		db.commit()
+		if feed_store is not None:
+			backfill_home_timelines()
 		try:
 			sqlite_prefix = 'sqlite:///'
 			i = app.config['DATABASE_URL'].index(sqlite_prefix) + len(sqlite_prefix)
@@ -43,6 +89,45 @@ def init_db():
 		except:
 			pass
 
+# Rebuild every home timeline from the follows and tweets tables, e.g. after
+# turning FANOUT on, or after follows changed: a new followee's older tweets
+# only reach a home timeline this way.
+@app.cli.command('backfill-home')
+def backfill_home():
+	if feed_store is None:
+		print('Set FANOUT in HOME_TIMELINE_CONFIG to keep home timelines.')
+		return
+	users, celebrities = backfill_home_timelines()
+	print('Home timelines rebuilt:', users)
+	print('Authors read on demand:', celebrities)
+
+def backfill_home_timelines():
+	''' Refill the store from the database. Returns the number of home
+		timelines rebuilt and the number of authors too widely followed to
+		fan out. '''
+	celebrities = {row['id'] for row in queries.celebrity_ids(threshold=CELEBRITY_THRESHOLD)}
+	for author_id in feed_store.get_celebrities() - celebrities:
+		feed_store.set_celebrity(author_id, False)
+	for author_id in celebrities:
+		feed_store.set_celebrity(author_id, True)
+
+	users = 0
+	for user in queries.all_user_ids():
+		rowids = queries.home_tweet_rowids(user_id=user['id'], excluded_ids=list(celebrities), limit=FEED_LENGTH)
+		feed_store.replace(user['id'], [row['rowid'] for row in rowids])
+		users += 1
+	return users, len(celebrities)
+
+# Tag GET responses so the gateway's response cache can revalidate them
+# with If-None-Match instead of fetching them again
+@app.after_request
+def add_etag(response):
+	if (request.method == 'GET' and response.status_code == 200 and
+			not response.direct_passthrough and not response.is_streamed):
+		response.add_etag()
+		response = response.make_conditional(request)
+	return response
+
 # Trigger a server error response
 @app.route('/api/v1/timelines/error')
 def trigger_error():
@@ -59,11 +144,67 @@ def trigger_error():
 def home():
 	return getPublicTimeline()
 
-# Get a public timeline. This contains all the tweets in the database.
+# Get a page of the public timeline, which has every tweet, newest first.
+# The next page, if any, is given in a Link header. Its cursor is an opaque
+# position in the timeline: tweet IDs are only unique per author, so they
+# can't name one.
 @app.route('/api/v1/timelines/public', methods=['GET'])
 def getPublicTimeline():
-	all_tweets=queries.all_tweets()
-	return list(all_tweets)
+	try:
+		limit = int(request.args.get('limit', PUBLIC_PAGE_SIZE))
+	except ValueError:
+		limit = 0
+	if not 0 < limit <= MAX_PUBLIC_PAGE_SIZE:
+		return {
+			'error': 'limit must be between 1 and ' + str(MAX_PUBLIC_PAGE_SIZE) + '.'
+		}, status.HTTP_400_BAD_REQUEST
+
+	position = NEWEST_POSITION
+	if 'cursor' in request.args:
+		position = decode_cursor(request.args['cursor'])
+		if position is None:
+			return {'error': 'Invalid cursor.'}, status.HTTP_400_BAD_REQUEST
+
+	# One tweet past the page tells whether there is a next one. Reading the
+	# page in one statement keeps the cursor at the last tweet actually sent,
+	# even if tweets are posted meanwhile.
+	tweets = list(queries.public_tweets(timestamp=position['timestamp'], id=position['rowid'], limit=limit + 1))
+	headers = {}
+	if len(tweets) > limit:
+		del tweets[limit:]
+		next_page = '%s?cursor=%s&limit=%d' % (request.path, encode_cursor(tweets[-1]), limit)
+		headers['Link'] = '<' + next_page + '>; rel="next"'
+	for tweet in tweets:
+		del tweet['rowid']
+	return Response(stream_json_list(tweets), mimetype='application/json', headers=headers)
+
+# Returns an opaque cursor for the position after the tweet, given its
+# timestamp and rowid
+def encode_cursor(row):
+	position = json.dumps([row['timestamp'], row['rowid']], separators=(',', ':'))
+	return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii').rstrip('=')
+
+# Returns the position in a cursor, or None if it is not a valid cursor
+def decode_cursor(cursor):
+	try:
+		padded = cursor + '=' * (-len(cursor) % 4)
+		position = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+	except (binascii.Error, UnicodeError, ValueError):
+		return None
+	if (not isinstance(position, list) or len(position) != 2 or
+			not isinstance(position[0], str) or type(position[1]) is not int):
+		return None
+	return {'timestamp': position[0], 'rowid': position[1]}
+
+# Encode the rows as a JSON list one at a time, so a response only ever
+# holds one row's JSON in memory
+def stream_json_list(rows):
+	yield '['
+	separator = ''
+	for row in rows:
+		yield separator + json.dumps(row)
+		separator = ','
+	yield ']'
 	
 # Handle the endpoint for a user's home timeline. This includes getting
 # up to 25 tweets by people this user is following, and making posts.
@@ -95,25 +236,85 @@ def getUserTimeline(username):
 # posts made by users this user is following.
 def getHomeTimeline(auth_id):
 	try:
+		if feed_store is not None:
+			return getStoredHomeTimeline(auth_id)
 		home_timeline = queries.home_timeline(author_id=auth_id)
 		return list(home_timeline)
 	except Exception as e:
 		return {'error':str('Could not find home timeline.')}, status.HTTP_404_NOT_FOUND
 
+# Read a home timeline from the store, merging in the recent tweets of any
+# followees too widely followed to fan out. Tweets of users no longer followed
+# are left out, so unfollowing takes effect before the next backfill; the feed
+# is read further back, up to FEED_LENGTH, to still fill the page.
+def getStoredHomeTimeline(auth_id):
+	global needs_backfill
+	if needs_backfill:
+		with backfill_lock:
+			if needs_backfill:
+				backfill_home_timelines()
+				needs_backfill = False
+
+	recent = set()
+	celebrities = feed_store.get_celebrities()
+	if celebrities:
+		followed = [row['id'] for row in queries.followed_among(user_id=auth_id, author_ids=list(celebrities))]
+		if followed:
+			recent.update(row['rowid'] for row in queries.recent_tweet_rowids(author_ids=followed, limit=HOME_PAGE_SIZE))
+
+	limit = HOME_PAGE_SIZE
+	while True:
+		feed = feed_store.read(auth_id, limit)
+		# Rowids grow with each tweet, so the largest are the newest
+		newest = sorted(set(feed) | recent, reverse=True)[:limit]
+		if not newest:
+			return []
+		tweets = list(queries.tweets_by_rowids(rowids=newest, user_id=auth_id))
+		if len(tweets) >= HOME_PAGE_SIZE or len(feed) < limit or limit >= FEED_LENGTH:
+			break
+		limit = min(limit * 4, FEED_LENGTH)
+
+	tweets = sorted(tweets, key=lambda t: t['rowid'], reverse=True)[:HOME_PAGE_SIZE]
+	return [
+		{'username': t['username'], 'content_text': t['content_text'], 'timestamp': t['timestamp']}
+		for t in tweets
+	]
+
+# Push a new tweet onto the home timelines of its author's followers, unless
+# there are too many of them. Tweets of such authors are read on demand.
+def fanOutTweet(auth_id, tweet_rowid):
+	followers = queries.follower_count(author_id=auth_id)['followers']
+	is_celebrity = followers > CELEBRITY_THRESHOLD
+	if is_celebrity != (auth_id in feed_store.get_celebrities()):
+		feed_store.set_celebrity(auth_id, is_celebrity)
+	if not is_celebrity:
+		feed_store.push([row['user_id'] for row in queries.followers(author_id=auth_id)], tweet_rowid)
+
 # Have a user post a tweet. This can show up on their timeline, as well as timelines
 # of people who follow this user.
 @request_utils.require_fields({'content_text'})
 def postTweet(username, auth_id):
 
 	try:
-		inserted = queries.create_tweet(author_id=auth_id, content_text=request.data['content_text'])
+		# The insert returns the new row. SQLite only lets the row be read
+		# before the statement is committed, hence the explicit transaction.
+		with queries.transaction():
+			inserted = queries.create_tweet(author_id=auth_id, content_text=request.data['content_text'])
 		tweet = {
 			'author_id': auth_id,
 			'content_text': request.data['content_text'],
-			'id': queries.recent_tweet_id(author_id=auth_id)["id"]
+			'id': inserted['id'],
+			'timestamp': inserted['timestamp']
 		}
 	except Exception as e:
 		return {'error':str(e)}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+	if feed_store is not None:
+		# The tweet is posted either way, a backfill repairs missed timelines
+		try:
+			fanOutTweet(auth_id, inserted['rowid'])
+		except Exception:
+			app.logger.exception('Could not fan out tweet %s', inserted['rowid'])
 		
 	return tweet, status.HTTP_201_CREATED, {
 		'Location': f'/api/v1/timelines/{username}'
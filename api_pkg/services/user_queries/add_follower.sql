@@ -1,4 +1,5 @@
 -- :name add_follower :affected
-INSERT INTO follows (user_id, following_id) VALUES (
-	(SELECT id FROM users WHERE username = :user_name), 
-	(SELECT id FROM users WHERE username = :followed_name))
\ No newline at end of file
+INSERT INTO follows (user_id, following_id)
+SELECT follower.id, followed.id FROM users AS follower, users AS followed
+WHERE follower.username = :user_name AND followed.username = :followed_name
+ON CONFLICT DO NOTHING
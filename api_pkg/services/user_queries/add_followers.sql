@@ -0,0 +1,6 @@
+-- :name add_followers :many
+INSERT INTO follows (user_id, following_id)
+SELECT :user_id, id FROM users
+WHERE username IN :followed_names
+ON CONFLICT DO NOTHING
+RETURNING following_id
@@ -0,0 +1,3 @@
+-- :name rehash_password :affected
+UPDATE users SET pw_hash = :new_hash
+WHERE username = :user_name AND pw_hash = :old_hash;
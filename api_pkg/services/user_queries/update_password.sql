@@ -0,0 +1,3 @@
+-- :name update_password :affected
+UPDATE users SET pw_hash = :pw_hash
+WHERE username = :user_name;
\ No newline at end of file
@@ -0,0 +1,3 @@
+-- :name user_ids :many
+SELECT id, username FROM users
+WHERE username IN :user_names
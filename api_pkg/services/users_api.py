@@ -2,19 +2,44 @@
 import pugsql
 from flask import request, g
 from flask_api import status, exceptions, FlaskAPI
-import werkzeug.security as wk_s
 
 # Local Imports
-from api_pkg.api_utils import request_utils 
+from api_pkg.api_utils import request_utils, service_utils, sqlite_engine, tracing
+from api_pkg.services import passwords
 
-CRYPT_HASH_ALGORITHM = 'sha3_512'
-PASSWORD_SALT_LENGTH = 64
+# Tells the gateway to drop any credentials it has cached for a username
+INVALIDATE_CREDENTIALS_HEADER = 'X-Invalidate-Credentials'
 
 app = FlaskAPI(__name__)
 app.config.from_envvar('USERS_APP_CONFIG')
 
+# Keep-alive connections and a health check for the gateway, see service_utils.py
+service_utils.serve_gateway(app, lambda: get_db().cursor().execute('SELECT 1'))
+
 queries = pugsql.module('api_pkg/services/user_queries/')
-queries.connect(app.config['DATABASE_URL'])
+# Pooled connections set up for several processes sharing the database
+# file, see sqlite_engine.py. Fail now if the settings don't take effect.
+queries.setengine(sqlite_engine.make_engine(app.config['DATABASE_URL'], app.config.get('SQLITE_CONFIG')))
+sqlite_engine.check_pragmas(queries.engine, app.config.get('SQLITE_CONFIG'))
+
+# Requests carry the gateway's request ID, and their queries are timed when
+# the gateway sampled them, see tracing.py
+tracer = tracing.Tracer('users', app.config.get('TRACING_CONFIG'))
+tracing.trace_flask_service(app, tracer)
+tracing.trace_engine(queries.engine)
+
+# Hashes passwords in worker processes with the KDF set by PASSWORD_CONFIG
+hasher = passwords.PasswordHasher(app.config.get('PASSWORD_CONFIG'))
+
+# Most users one bulk follow may name, and how many go into each statement,
+# staying well under SQLite's limit on bound variables
+MAX_BULK_FOLLOWS = 10000
+FOLLOW_CHUNK_SIZE = 500
+
+# Every hashing worker is busy, so the client should come back shortly. Not
+# a 503: the gateway counts 5xx against the instance's breaker, and a burst
+# of logins would take healthy instances out of the pool one after another.
+HASHING_BUSY = {'message': 'Too many logins at once, try again shortly.'}, status.HTTP_429_TOO_MANY_REQUESTS, {'Retry-After': '1'}
 
 # Get a database Engine object
 def get_db():
@@ -72,6 +97,12 @@ def createUser():
 	email = request.data['email']
 	password = request.data['password']
 
+	# Hash before taking the write lock, which the other instances wait on
+	try:
+		hashed_pw = hasher.hash(password)
+	except passwords.HashingBusy:
+		return HASHING_BUSY
+
 	# Check if username and email are already in use
 	with queries.transaction():
 		if queries.user_exists(user_name=username): # See if username exists
@@ -79,13 +110,14 @@ def createUser():
 		if queries.email_exists(user_email=email): # See if email is already in use
 			return {'message': "Email is already in use."}, status.HTTP_409_CONFLICT
 		try:
-			hashed_pw = wk_s.generate_password_hash(password, CRYPT_HASH_ALGORITHM, PASSWORD_SALT_LENGTH)
 			queries.create_user(user_name=username, user_email=email, pw_hash=hashed_pw)
 		except Exception as e: # Unknown conflict error
 			return {'message':str(e)}, status.HTTP_409_CONFLICT
 		
+	# A failed login before the account existed may still be cached by the gateway
 	return request.data, status.HTTP_201_CREATED, {
-		'Location': f'/api/v1/users/{request.args.get("username")}'
+		'Location': f'/api/v1/users/{request.args.get("username")}',
+		INVALIDATE_CREDENTIALS_HEADER: username
 	}
 
 # Authenticate a user
@@ -97,7 +129,19 @@ def authenticateUser():
 
 	pw_hash = queries.find_hash(user_name=username)
 
-	if pw_hash != None and wk_s.check_password_hash(pw_hash, password):
+	matches = False
+	if isinstance(pw_hash, str):
+		try:
+			matches, needs_rehash = hasher.verify(pw_hash, password)
+			if needs_rehash:
+				# Only replaces the hash if the password wasn't changed meanwhile
+				queries.rehash_password(user_name=username, old_hash=pw_hash, new_hash=hasher.hash(password))
+		except passwords.HashingBusy:
+			if not matches:
+				return HASHING_BUSY
+			# Logged in all the same, the hash is replaced on a later login
+
+	if matches:
 		return {
 			'message': 'Authentication successful.'
 		}, status.HTTP_200_OK, {
@@ -107,13 +151,30 @@ def authenticateUser():
 		msg = "Username or password was incorrect."
 		raise exceptions.AuthenticationFailed(detail=msg)
 
+# Change the password of the authenticated user
+@app.route('/api/v1/users/<string:username>/password', methods=['PUT'])
+@request_utils.require_fields({'password'})
+def changePassword(username):
+	if request.authorization is None or request.authorization.username != username:
+		raise exceptions.PermissionDenied("Cannot change the password of another user.")
+
+	try:
+		hashed_pw = hasher.hash(request.data['password'])
+	except passwords.HashingBusy:
+		return HASHING_BUSY
+	if not queries.update_password(user_name=username, pw_hash=hashed_pw):
+		raise exceptions.NotFound("Current user not found.")
+
+	# The old password must stop working at the gateway right away
+	return {
+		'message': 'Password changed.'
+	}, status.HTTP_200_OK, {
+		INVALIDATE_CREDENTIALS_HEADER: username
+	}
+
 # Handle API endpoint for addFollower and removeFollower
 @app.route('/api/v1/users/<string:username>/follows', methods=['POST', 'DELETE'])
 def followers(username):
-	# Check if user exists
-	if not queries.user_exists(user_name=username):
-		raise exceptions.NotFound("Current user not found.")
-
 	if request.method == 'POST':
 		return addFollower(username)
 	elif request.method == 'DELETE':
@@ -123,16 +184,12 @@ def followers(username):
 @request_utils.require_fields({'follow'})
 def addFollower(username):
 	username_to_follow = request.data['follow']
-	with queries.transaction():
-		if not queries.user_exists(user_name=username):
-			raise exceptions.NotFound("The current user does not exist.")
-		if not queries.user_exists(user_name=username_to_follow):
-			raise exceptions.NotFound("The user you are trying to follow does not exist.")
-		try:
-			queries.add_follower(user_name=username, followed_name=username_to_follow)
-		except Exception as e:
-			return {'message': 'You are already following this user.'}, status.HTTP_409_CONFLICT
-		
+	# One statement when the follow is new. Only a follow that wasn't made
+	# needs the existence checks, to say why.
+	if not queries.add_follower(user_name=username, followed_name=username_to_follow):
+		check_users_exist(username, username_to_follow, "The user you are trying to follow does not exist.")
+		return {'message': 'You are already following this user.'}, status.HTTP_409_CONFLICT
+
 	return {
 		"followed": request.data['follow']
 	}, status.HTTP_201_CREATED
@@ -141,14 +198,63 @@ def addFollower(username):
 @request_utils.require_fields({'follow'})
 def removeFollower(username):
 	username_to_remove = request.data['follow']
+	if not queries.remove_follower(user_name=username, followed_name=username_to_remove):
+		check_users_exist(username, username_to_remove, "The user you are trying to unfollow does not exist.")
+		raise exceptions.NotFound("Could not unfollow: relationship does not exist.")
+
+	return {
+		"unfollowed": request.data['follow']
+	}, status.HTTP_200_OK
+
+# Raise NotFound if either user does not exist, with one query for both
+def check_users_exist(username, other_username, other_missing):
+	found = {user['username'] for user in queries.user_ids(user_names=[username, other_username])}
+	if username not in found:
+		raise exceptions.NotFound("The current user does not exist.")
+	if other_username not in found:
+		raise exceptions.NotFound(other_missing)
+
+# Follow many users at once, e.g. when importing a new user's contacts. All
+# follows are made in one transaction, and each user named gets a result:
+# "followed", "already-following" or "not-found".
+@app.route('/api/v1/users/<string:username>/follows/bulk', methods=['POST'])
+@request_utils.require_fields({'follow'})
+def addFollowers(username):
+	names = request.data['follow']
+	if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+		return {'message': 'follow must be a list of usernames.'}, status.HTTP_400_BAD_REQUEST
+	if not 0 < len(names) <= MAX_BULK_FOLLOWS:
+		return {
+			'message': 'Follow between 1 and ' + str(MAX_BULK_FOLLOWS) + ' users at a time.'
+		}, status.HTTP_400_BAD_REQUEST
+	names = list(dict.fromkeys(names))
+
+	found = {}
+	followed = set()
 	with queries.transaction():
-		if not queries.user_exists(user_name=username):
-			raise exceptions.NotFound("The current user does not exist.")
-		if not queries.user_exists(user_name=username_to_remove):
-			raise exceptions.NotFound("The user you are trying to unfollow does not exist.")
-		if queries.remove_follower(user_name=username, followed_name=username_to_remove):
-			return {
-				"unfollowed": request.data['follow']
-			}, status.HTTP_200_OK
+		for start in range(0, len(names), FOLLOW_CHUNK_SIZE):
+			chunk = names[start:start + FOLLOW_CHUNK_SIZE]
+			# The current user is looked up with the first chunk
+			lookup = chunk + [username] if start == 0 else chunk
+			found.update((user['username'], user['id']) for user in queries.user_ids(user_names=lookup))
+			if username not in found:
+				raise exceptions.NotFound("The current user does not exist.")
+			# Rows come back only for follows the insert made, not ones that existed
+			followed.update(
+				row['following_id']
+				for row in queries.add_followers(user_id=found[username], followed_names=chunk)
+			)
+
+	results = []
+	for name in names:
+		if name not in found:
+			result = 'not-found'
+		elif found[name] in followed:
+			result = 'followed'
 		else:
-			raise exceptions.NotFound("Could not unfollow: relationship does not exist.")
\ No newline at end of file
+			result = 'already-following'
+		results.append({'follow': name, 'result': result})
+	return {
+		'results': results,
+		'followed': sum(1 for r in results if r['result'] == 'followed')
+	}, status.HTTP_200_OK
\ No newline at end of file
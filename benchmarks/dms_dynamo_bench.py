@@ -0,0 +1,119 @@
+# Measures per-request latency of the DMs service's DynamoDB calls under
+# different DYNAMODB_CONFIG settings, see api_pkg/services/dms_store.py.
+# Threads write a message and read back a page of their inbox in a loop,
+# the way request threads of the service do.
+#
+# Needs DynamoDB Local, see the README. It creates and deletes its own table.
+#
+# Usage: python -m benchmarks.dms_dynamo_bench [--endpoint http://localhost:8000] [--threads 32] [--seconds 10]
+
+# Standard Imports
+import argparse
+import statistics
+import sys
+import threading
+import time
+
+# Local Imports
+from api_pkg.services import dms_ids, dms_schema, dms_store
+
+TABLE_NAME = 'dms_bench'
+
+# botocore's own defaults, i.e. what the service used before DYNAMODB_CONFIG
+DEFAULT_CONFIG = {
+    "POOL_SIZE": 10,
+    "RETRY_MODE": "legacy",
+    "MAX_ATTEMPTS": 5,
+    "CONNECT_TIMEOUT": 60,
+    "READ_TIMEOUT": 60,
+}
+
+VARIANTS = [
+    ('default', DEFAULT_CONFIG),
+    ('tuned', {}),
+    ('tuned, low-level', {"LOW_LEVEL": True}),
+]
+
+def run_requests(store, message_ids, recipient, go, stop, puts, queries, errors):
+    go.wait()
+    try:
+        while not stop.is_set():
+            message_id = message_ids.new_id(recipient)
+            item = {
+                't': recipient,
+                'fr': 'bench',
+                'ts': dms_ids.timestamp_of(message_id),
+                'mId': message_id,
+                'msg': 'Benchmark message',
+            }
+            start = time.perf_counter()
+            store.put_new(item)
+            puts.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            store.query('t', recipient, limit=20)
+            queries.append(time.perf_counter() - start)
+    except Exception as e:
+        errors.append(repr(e))
+
+def run_variant(endpoint, dynamo_config, threads, seconds):
+    store = dms_store.MessageStore(endpoint, TABLE_NAME, dynamo_config)
+    message_ids = dms_ids.MessageIdGenerator()
+    go = threading.Event()
+    stop = threading.Event()
+    puts, queries, errors = [], [], []
+
+    workers = [
+        threading.Thread(
+            target=run_requests,
+            args=(store, message_ids, 'user%d' % i, go, stop, puts, queries, errors)
+        )
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    go.set()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return puts, queries, errors
+
+def describe(name, latencies, seconds):
+    if not latencies:
+        return '  %-6s no requests' % name
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return '  %-6s %8.0f/s  p50 %6.2fms  p99 %6.2fms' % (
+        name, len(latencies) / seconds, statistics.median(latencies) * 1000, p99 * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare DynamoDB access settings of the DMs service.')
+    parser.add_argument('--endpoint', default='http://localhost:8000')
+    parser.add_argument('--threads', type=int, default=32, help='concurrent request threads')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of each variant')
+    args = parser.parse_args()
+
+    client = dms_store.MessageStore(args.endpoint, TABLE_NAME).client
+    if TABLE_NAME in client.list_tables(Limit=100)['TableNames']:
+        client.delete_table(TableName=TABLE_NAME)
+        client.get_waiter('table_not_exists').wait(TableName=TABLE_NAME)
+    client.create_table(**dict(dms_schema.dm_table_schema, TableName=TABLE_NAME))
+    client.get_waiter('table_exists').wait(TableName=TABLE_NAME)
+
+    failed = False
+    try:
+        for name, dynamo_config in VARIANTS:
+            puts, queries, errors = run_variant(args.endpoint, dynamo_config, args.threads, args.seconds)
+            print('%s (%d threads)' % (name, args.threads))
+            print(describe('put', puts, args.seconds))
+            print(describe('query', queries, args.seconds))
+            if errors:
+                failed = True
+                print('  errors: %d, e.g. %s' % (len(errors), errors[0]))
+    finally:
+        client.delete_table(TableName=TABLE_NAME)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
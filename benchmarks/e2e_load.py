@@ -0,0 +1,533 @@
+# Drives the whole stack end to end: starts a gateway and N instances of the
+# users, timelines and DMs services against a fresh SQLite database, seeds it
+# through the services' `init` commands and the API, then runs a weighted mix
+# of operations from many clients through the gateway for a fixed time.
+#
+# Usage: python -m benchmarks.e2e_load [--instances 3] [--gateway flask] [--threads 16] [--seconds 30]
+#            [--mix login=10,post_tweet=10,home_timeline=40,send_dm=20,list_inbox=20]
+#            [--out e2e-<commit>.json] [--compare e2e-<other commit>.json]
+#
+# Reports p50/p99 latency and throughput per operation, and the CPU and RSS
+# of the gateway (all of its processes under gunicorn), and writes them as
+# JSON with the commit they were measured on. --compare prints the change
+# against the results of an earlier run.
+#
+# The services run with a copy of api_pkg/services/api.cfg, so a run measures
+# the settings of the commit checked out. The DMs service needs DynamoDB Local
+# at --dynamodb-url; if nothing answers there, the DM operations are left out
+# of the mix and the results say so.
+
+# Standard Imports
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import random
+import runpy
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Third-Party Imports
+import requests
+
+PASSWORD = 'password'
+
+DEFAULT_MIX = 'login=10,post_tweet=10,home_timeline=40,send_dm=20,list_inbox=20'
+DM_OPERATIONS = {'send_dm', 'list_inbox'}
+
+# Offsets from --base-port, as in routes.cfg
+SERVICE_PORTS = {'USERS': 100, 'TIMELINES': 200, 'DMS': 300}
+SERVICE_APPS = {
+    'USERS': ('api_pkg/services/users_api', 'USERS_APP_CONFIG'),
+    'TIMELINES': ('api_pkg/services/timelines_api', 'TIMELINES_APP_CONFIG'),
+    'DMS': ('api_pkg/services/dms_api', 'DIRECT_MESSAGES_APP_CONFIG'),
+}
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def login(session, rng, username, users):
+    # The gateway turns basic auth on the login route into the JSON body
+    return session.post('/api/v1/users/login', auth=(username, PASSWORD))
+
+def post_tweet(session, rng, username, users):
+    return session.post(
+        '/api/v1/timelines/%s/home' % username,
+        json={'content_text': 'load test tweet %d' % rng.randrange(10 ** 9)},
+        auth=(username, PASSWORD),
+    )
+
+def home_timeline(session, rng, username, users):
+    return session.get('/api/v1/timelines/%s/home' % username, auth=(username, PASSWORD))
+
+def send_dm(session, rng, username, users):
+    return session.post(
+        '/api/v1/dms',
+        json={'to': rng.choice(users), 'message': 'load test message'},
+        auth=(username, PASSWORD),
+    )
+
+def list_inbox(session, rng, username, users):
+    return session.get('/api/v1/dms?limit=25', auth=(username, PASSWORD))
+
+OPERATIONS = {
+    'login': (login, 200),
+    'post_tweet': (post_tweet, 201),
+    'home_timeline': (home_timeline, 200),
+    'send_dm': (send_dm, 201),
+    'list_inbox': (list_inbox, 200),
+}
+
+class GatewaySession(requests.Session):
+    ''' A requests session whose paths are relative to the gateway. '''
+
+    def __init__(self, base_url: str) -> None:
+        super().__init__()
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, self.base_url + url, *args, **kwargs)
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('unknown operation %r, expected one of %s' % (name, ', '.join(OPERATIONS)))
+        mix[name] = float(weight or 1)
+    return mix
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def load_config(path):
+    ''' Returns the settings of a Flask config file, as Config.from_pyfile reads them. '''
+    return {key: value for key, value in runpy.run_path(path).items() if key.isupper()}
+
+def write_config(path, config):
+    with open(path, 'w') as f:
+        for key, value in config.items():
+            f.write('%s = %r\n' % (key, value))
+
+def is_listening(port):
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+        return True
+    except OSError:
+        return False
+
+def dynamodb_reachable(url):
+    # DynamoDB Local answers a bare GET with an error, which is enough
+    try:
+        requests.get(url, timeout=1)
+        return True
+    except requests.RequestException:
+        return False
+
+class Stack:
+    ''' The processes of the gateway and services, logging to files in workdir. '''
+
+    def __init__(self, workdir: str) -> None:
+        self.workdir = workdir
+        self.processes = []
+
+    def start(self, name, command, env):
+        log = open(os.path.join(self.workdir, name + '.log'), 'w')
+        process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        self.processes.append((name, process, log))
+        return process
+
+    def run(self, name, command, env):
+        with open(os.path.join(self.workdir, name + '.log'), 'w') as log:
+            if subprocess.run(command, env=env, stdout=log, stderr=subprocess.STDOUT).returncode:
+                self.fail(name + ' failed')
+
+    def wait_for(self, name, ready, timeout=60):
+        deadline = time.monotonic() + timeout
+        while not ready():
+            for process_name, process, _ in self.processes:
+                if process.poll() is not None:
+                    self.fail(process_name + ' exited with code %d' % process.returncode)
+            if time.monotonic() > deadline:
+                self.fail(name + ' did not start within %d seconds' % timeout)
+            time.sleep(0.2)
+
+    def fail(self, message):
+        print('error:', message, '- logs are in', self.workdir, file=sys.stderr)
+        self.stop()
+        sys.exit(1)
+
+    def stop(self):
+        for _, process, _ in self.processes:
+            if process.poll() is None:
+                os.killpg(process.pid, 15)
+        for _, process, log in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, 9)
+                process.wait()
+            log.close()
+        self.processes = []
+
+def process_tree(pid):
+    ''' Returns pid and the pids of all of its descendants. '''
+    children = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                # The command name is in parentheses and may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children[pid])
+    return tree
+
+def read_usage(pid):
+    ''' Returns (cpu seconds, rss bytes) summed over the process tree of pid. '''
+    cpu, rss = 0.0, 0
+    for member in process_tree(pid):
+        try:
+            with open('/proc/%d/stat' % member) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15 of stat, rss field 24
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss += int(fields[21]) * PAGE_SIZE
+    return cpu, rss
+
+def sample_usage(pid, stop, samples, interval=0.5):
+    while not stop.wait(interval):
+        samples.append((time.monotonic(),) + read_usage(pid))
+
+def start_stack(args, stack, include_dms):
+    workdir = stack.workdir
+    env = dict(os.environ, FLASK_ENV='production', PYTHONPATH=os.getcwd())
+
+    service_config = load_config('api_pkg/services/api.cfg')
+    service_config['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'MBS.db')
+    service_config['DYNAMODB_URL'] = args.dynamodb_url
+    home_config = dict(service_config.get('HOME_TIMELINE_CONFIG', {}))
+    home_config['PATH'] = os.path.join(workdir, 'home_feeds.db')
+    service_config['HOME_TIMELINE_CONFIG'] = home_config
+    service_config_path = os.path.join(workdir, 'api.cfg')
+    write_config(service_config_path, service_config)
+
+    gateway_config = load_config('api_pkg/routes.cfg')
+    gateway_config['SVC_CONFIG'] = {
+        key: dict(svc, PORT=args.base_port + SERVICE_PORTS[key], INSTANCES=args.instances)
+        for key, svc in gateway_config['SVC_CONFIG'].items()
+    }
+    if 'STATE_CONFIG' in gateway_config:
+        gateway_config['STATE_CONFIG'] = dict(gateway_config['STATE_CONFIG'], PATH=os.path.join(workdir, 'pools.state'))
+    gateway_config_path = os.path.join(workdir, 'routes.cfg')
+    write_config(gateway_config_path, gateway_config)
+
+    for key, (app, config_var) in SERVICE_APPS.items():
+        env[config_var] = service_config_path
+    env['GATEWAY_APP_CONFIG'] = gateway_config_path
+
+    print('Initializing the databases...')
+    stack.run('users-init', ['flask', 'init'], dict(env, FLASK_APP=SERVICE_APPS['USERS'][0]))
+    if include_dms:
+        stack.run('dms-init', ['flask', 'init'], dict(env, FLASK_APP=SERVICE_APPS['DMS'][0]))
+
+    print('Starting %d instances of each service...' % args.instances)
+    health_urls = []
+    for key, (app, config_var) in SERVICE_APPS.items():
+        if key == 'DMS' and not include_dms:
+            continue
+        for i in range(args.instances):
+            port = args.base_port + SERVICE_PORTS[key] + i
+            instance_env = dict(env, FLASK_APP=app)
+            if key == 'DMS':
+                # Each instance makes message IDs under its own node ID
+                instance_config_path = os.path.join(workdir, 'dms-%d.cfg' % i)
+                write_config(instance_config_path, dict(service_config, NODE_ID=i))
+                instance_env[config_var] = instance_config_path
+            stack.start('%s-%d' % (key.lower(), i), ['flask', 'run', '-p', str(port), '--no-reload'], instance_env)
+            health_urls.append('http://127.0.0.1:%d/health' % port)
+    for url in health_urls:
+        stack.wait_for(url, lambda url=url: service_healthy(url))
+
+    # Started last, so its health checks find every instance up
+    gateway_port = args.base_port
+    if args.gateway == 'gunicorn':
+        command = ['gunicorn', '-c', 'api_pkg/gunicorn_conf.py', 'api_pkg.gateway:app']
+        env = dict(env, PORT=str(gateway_port))
+    elif args.gateway == 'async':
+        command = [sys.executable, '-m', 'api_pkg.async_gateway', '-p', str(gateway_port)]
+    else:
+        command = ['flask', 'run', '-p', str(gateway_port), '--no-reload']
+        env = dict(env, FLASK_APP='api_pkg/gateway')
+    gateway = stack.start('gateway', command, env)
+    stack.wait_for('gateway', lambda: is_listening(gateway_port))
+    return gateway, 'http://127.0.0.1:%d' % gateway_port
+
+def service_healthy(url):
+    try:
+        return requests.get(url, timeout=1).status_code == 200
+    except requests.RequestException:
+        return False
+
+def seed(base_url, users, args):
+    ''' Creates the users, then has each follow some of the others and post
+        a few tweets, all through the gateway. '''
+    rng = random.Random(args.random_seed)
+    local = threading.local()
+
+    def get_session():
+        if not hasattr(local, 'session'):
+            local.session = GatewaySession(base_url)
+        return local.session
+
+    def create(username):
+        response = get_session().post('/api/v1/users/new', json={
+            'username': username, 'email': username + '@example.com', 'password': PASSWORD,
+        })
+        if response.status_code != 201:
+            raise RuntimeError('creating %s: %d %s' % (username, response.status_code, response.text[:200]))
+
+    def follow(username, followees):
+        response = get_session().post(
+            '/api/v1/users/%s/follows/bulk' % username, json={'follow': followees}, auth=(username, PASSWORD)
+        )
+        if response.status_code != 200:
+            raise RuntimeError('follows of %s: %d %s' % (username, response.status_code, response.text[:200]))
+
+    def tweet(username, count):
+        for i in range(count):
+            response = get_session().post(
+                '/api/v1/timelines/%s/home' % username,
+                json={'content_text': 'seed tweet %d of %s' % (i, username)},
+                auth=(username, PASSWORD),
+            )
+            if response.status_code != 201:
+                raise RuntimeError('tweet of %s: %d %s' % (username, response.status_code, response.text[:200]))
+
+    follows = {
+        username: rng.sample([other for other in users if other != username], min(args.follows, len(users) - 1))
+        for username in users
+    }
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        print('Seeding %d users...' % len(users))
+        list(pool.map(create, users))
+        print('Seeding %d follows each...' % min(args.follows, len(users) - 1))
+        list(pool.map(follow, users, [follows[username] for username in users]))
+        print('Seeding %d tweets each...' % args.tweets)
+        list(pool.map(tweet, users, [args.tweets] * len(users)))
+
+def run_client(base_url, users, mix, seed_value, go, measuring, stop, records):
+    rng = random.Random(seed_value)
+    session = GatewaySession(base_url)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    go.wait()
+    while not stop.is_set():
+        name = rng.choices(names, weights)[0]
+        fn, expected = OPERATIONS[name]
+        username = rng.choice(users)
+        start = time.perf_counter()
+        try:
+            response = fn(session, rng, username, users)
+            response.content
+            outcome = response.status_code
+            cache = response.headers.get('X-Cache')
+        except requests.RequestException as e:
+            outcome, cache = type(e).__name__, None
+        latency = time.perf_counter() - start
+        if measuring.is_set():
+            records.append((name, latency, outcome == expected, outcome, cache))
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(records, seconds):
+    by_operation = collections.defaultdict(list)
+    for record in records:
+        by_operation[record[0]].append(record)
+    summary = {}
+    for name, recorded in sorted(by_operation.items()):
+        latencies = sorted(latency for _, latency, ok, _, _ in recorded if ok)
+        errors = collections.Counter(str(outcome) for _, _, ok, outcome, _ in recorded if not ok)
+        caches = collections.Counter(cache for _, _, ok, _, cache in recorded if ok and cache)
+        summary[name] = {
+            'requests': len(recorded),
+            'errors': sum(errors.values()),
+            'error_outcomes': dict(errors),
+            'throughput': len(latencies) / seconds,
+            'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+            'p90_ms': percentile(latencies, 0.9) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'max_ms': latencies[-1] * 1000 if latencies else None,
+        }
+        if caches:
+            summary[name]['cache'] = dict(caches)
+    return summary
+
+def summarize_usage(samples):
+    if len(samples) < 2:
+        return {}
+    (start, start_cpu, _), (end, end_cpu, end_rss) = samples[0], samples[-1]
+    rss = [sample[2] for sample in samples]
+    return {
+        'cpu_percent': (end_cpu - start_cpu) / (end - start) * 100,
+        'rss_mb_mean': sum(rss) / len(rss) / 2 ** 20,
+        'rss_mb_max': max(rss) / 2 ** 20,
+        'rss_mb_end': end_rss / 2 ** 20,
+    }
+
+def format_ms(value):
+    return '%8.1f' % value if value is not None else '       -'
+
+def print_results(results):
+    print('%-14s %8s %8s %8s %8s %8s %7s' % ('operation', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'errors'))
+    for name, route in results['operations'].items():
+        print('%-14s %8.1f %s %s %s %s %7d' % (
+            name, route['throughput'], format_ms(route['p50_ms']), format_ms(route['p90_ms']),
+            format_ms(route['p99_ms']), format_ms(route['max_ms']), route['errors']))
+        if route['error_outcomes']:
+            print('%14s errors by outcome: %s' % ('', route['error_outcomes']))
+        if route.get('cache'):
+            print('%14s X-Cache: %s' % ('', route['cache']))
+    total = results['total']
+    print('%-14s %8.1f %s %s %s %s %7d' % (
+        'total', total['throughput'], format_ms(total['p50_ms']), format_ms(total['p90_ms']),
+        format_ms(total['p99_ms']), format_ms(total['max_ms']), total['errors']))
+    gateway = results['gateway']
+    if gateway:
+        print('gateway: %.0f%% CPU, RSS %.1f MB mean, %.1f MB max' % (
+            gateway['cpu_percent'], gateway['rss_mb_mean'], gateway['rss_mb_max']))
+    for name in results['skipped']:
+        print('skipped %s: DynamoDB Local is not reachable at %s' % (name, results['config']['dynamodb_url']))
+
+def print_comparison(results, baseline):
+    print('Compared with %s:' % (baseline.get('commit') or 'baseline')[:12])
+    rows = list(results['operations'].items()) + [('total', results['total'])]
+    for name, route in rows:
+        base = baseline['operations'].get(name) if name != 'total' else baseline.get('total')
+        if not base:
+            continue
+        changes = []
+        for key, label in (('throughput', 'req/s'), ('p50_ms', 'p50'), ('p99_ms', 'p99')):
+            if route.get(key) and base.get(key):
+                changes.append('%s %+.1f%%' % (label, (route[key] / base[key] - 1) * 100))
+        print('  %-14s %s' % (name, '  '.join(changes)))
+    if results['gateway'] and baseline.get('gateway'):
+        print('  %-14s CPU %+.0f points  RSS max %+.1f MB' % (
+            'gateway', results['gateway']['cpu_percent'] - baseline['gateway']['cpu_percent'],
+            results['gateway']['rss_mb_max'] - baseline['gateway']['rss_mb_max']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the gateway and services end to end.')
+    parser.add_argument('--instances', type=int, default=3, help='instances of each service')
+    parser.add_argument('--gateway', default='flask', choices=['flask', 'gunicorn', 'async'])
+    parser.add_argument('--base-port', type=int, default=6000, help='gateway port, services at +100, +200 and +300')
+    parser.add_argument('--dynamodb-url', default='http://localhost:8000')
+    parser.add_argument('--users', type=int, default=50, help='users seeded through the API')
+    parser.add_argument('--follows', type=int, default=20, help='users each seeded user follows')
+    parser.add_argument('--tweets', type=int, default=5, help='tweets each seeded user posts')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='operation=weight, comma separated')
+    parser.add_argument('--threads', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds run before measuring')
+    parser.add_argument('--seconds', type=float, default=30, help='seconds measured')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--out', help='results file, e2e-<commit>.json by default')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    include_dms = bool(DM_OPERATIONS & set(args.mix)) and dynamodb_reachable(args.dynamodb_url)
+    skipped = [] if include_dms else sorted(DM_OPERATIONS & set(args.mix))
+    mix = {name: weight for name, weight in args.mix.items() if name not in skipped}
+    if not mix:
+        parser.error('no operations left to run')
+
+    commit, dirty = git_commit()
+    users = ['load%d' % i for i in range(args.users)]
+    stack = Stack(tempfile.mkdtemp(prefix='e2e-load-'))
+    try:
+        gateway, base_url = start_stack(args, stack, include_dms)
+        try:
+            seed(base_url, users, args)
+        except RuntimeError as e:
+            stack.fail('seeding, ' + str(e))
+
+        go, measuring, stop, stop_sampling = (threading.Event() for _ in range(4))
+        records, samples = [], []
+        clients = [
+            threading.Thread(target=run_client, args=(base_url, users, mix, args.random_seed + i, go, measuring, stop, records))
+            for i in range(args.threads)
+        ]
+        for client in clients:
+            client.start()
+        print('Running %s with %d clients for %.0f + %.0f seconds...' % (
+            ', '.join('%s=%g' % item for item in mix.items()), args.threads, args.warmup, args.seconds))
+        go.set()
+        time.sleep(args.warmup)
+        measuring.set()
+        samples.append((time.monotonic(),) + read_usage(gateway.pid))
+        sampler = threading.Thread(target=sample_usage, args=(gateway.pid, stop_sampling, samples))
+        sampler.start()
+        started = time.monotonic()
+        time.sleep(args.seconds)
+        measuring.clear()
+        elapsed = time.monotonic() - started
+        stop_sampling.set()
+        sampler.join()
+        samples.append((time.monotonic(),) + read_usage(gateway.pid))
+        stop.set()
+        for client in clients:
+            client.join()
+    finally:
+        stack.stop()
+
+    operations = summarize(records, elapsed)
+    total = summarize([('total',) + record[1:] for record in records], elapsed).get('total', {})
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'config': dict(vars(args), mix=mix, cpus=os.cpu_count()),
+        'skipped': skipped,
+        'operations': operations,
+        'total': total,
+        'gateway': summarize_usage(samples),
+    }
+    print_results(results)
+
+    out = args.out or 'e2e-%s.json' % (commit[:12] if commit else 'results')
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to', out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+    error_rate = total.get('errors', 0) / total['requests'] if total.get('requests') else 1
+    sys.exit(1 if error_rate > args.max_error_rate else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Measures login throughput of one users service instance: the service runs
+# in this process on a threaded werkzeug server, and client threads log in
+# the sample users over HTTP for a fixed time.
+#
+# Usage: python -m benchmarks.login_bench [--method scrypt] [--workers 2] [--threads 16] [--seconds 10]
+#
+# --workers 0 hashes on the request threads, for comparison with the pool.
+
+# Standard Imports
+import argparse
+import logging
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Third-Party Imports
+import requests
+from werkzeug.serving import make_server
+
+USERS = ['user%d' % i for i in range(1, 8)]
+
+def log_in(url, go, stop, latencies, errors):
+    session = requests.Session()
+    go.wait()
+    i = 0
+    while not stop.is_set():
+        username = USERS[i % len(USERS)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            response = session.post(url, json={'username': username, 'password': 'password'})
+        except requests.RequestException as e:
+            errors.append(repr(e))
+            continue
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append('%d %s' % (response.status_code, response.text[:80]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure login throughput of one users service instance.')
+    parser.add_argument('--method', default='scrypt', choices=['scrypt', 'pbkdf2'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='hashing processes, 0 for none')
+    parser.add_argument('--scrypt-n', type=int, default=32768)
+    parser.add_argument('--pbkdf2-iterations', type=int, default=260000)
+    parser.add_argument('--threads', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5190)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'MBS.db')
+    config_path = os.path.join(workdir, 'api.cfg')
+    password_config = {
+        "METHOD": args.method,
+        "SCRYPT_N": args.scrypt_n,
+        "PBKDF2_ITERATIONS": args.pbkdf2_iterations,
+        "WORKERS": args.workers,
+        "MAX_PENDING": args.threads * 2,
+    }
+    with open(config_path, 'w') as f:
+        f.write('DATABASE_URL = %r\n' % ('sqlite:///' + db_path))
+        f.write('PASSWORD_CONFIG = %r\n' % password_config)
+    with open('api_pkg/services/MBS.sql') as f:
+        db = sqlite3.connect(db_path)
+        db.executescript(f.read())
+        db.close()
+
+    # The service reads its config when imported
+    os.environ['USERS_APP_CONFIG'] = config_path
+    from api_pkg.services import users_api
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('localhost', args.port, users_api.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://localhost:%d/api/v1/users/login' % args.port
+
+    # The sample users have legacy hashes, replaced by their first login
+    for username in USERS:
+        requests.post(url, json={'username': username, 'password': 'password'}).raise_for_status()
+
+    go = threading.Event()
+    stop = threading.Event()
+    latencies, errors = [], []
+    clients = [
+        threading.Thread(target=log_in, args=(url, go, stop, latencies, errors))
+        for _ in range(args.threads)
+    ]
+    for client in clients:
+        client.start()
+    go.set()
+    time.sleep(args.seconds)
+    stop.set()
+    for client in clients:
+        client.join()
+    server.shutdown()
+    users_api.hasher.close()
+
+    print('%s, %s, %d clients' % (
+        users_api.hasher.get_method(),
+        '%d hashing processes' % args.workers if args.workers else 'hashing on request threads',
+        args.threads))
+    if latencies:
+        latencies.sort()
+        print('  %.1f logins/s  p50 %.1fms  p99 %.1fms' % (
+            len(latencies) / args.seconds,
+            statistics.median(latencies) * 1000,
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000))
+    print('  errors: %d%s' % (len(errors), ', e.g. ' + errors[0] if errors else ''))
+    sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+    main()
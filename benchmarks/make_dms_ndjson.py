@@ -0,0 +1,39 @@
+# Writes fake direct messages as newline-delimited JSON, for loading into
+# the DMs table with its import-messages flask command:
+#
+#   python -m benchmarks.make_dms_ndjson 1000000 > dms.ndjson
+#   FLASK_APP=api_pkg/services/dms_api flask import-messages dms.ndjson
+
+# Standard Imports
+import argparse
+from datetime import datetime, timedelta
+import json
+import random
+import sys
+
+def main():
+    parser = argparse.ArgumentParser(description='Write fake direct messages as NDJSON.')
+    parser.add_argument('count', type=int)
+    parser.add_argument('--users', type=int, default=1000, help='distinct senders and recipients')
+    parser.add_argument('--days', type=int, default=30, help='spread of message timestamps')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = datetime.utcnow() - timedelta(days=args.days)
+    span = args.days * 24 * 3600
+    out = sys.stdout
+    for i in range(args.count):
+        sender, recipient = rng.sample(range(1, args.users + 1), 2)
+        message = {
+            'to': 'user%d' % recipient,
+            'from': 'user%d' % sender,
+            'message': 'Message %d' % i,
+            'timestamp': (start + timedelta(seconds=rng.uniform(0, span))).isoformat(),
+        }
+        if rng.random() < 0.1:
+            message['quickreply'] = ['Yes', 'No']
+        out.write(json.dumps(message, separators=(',', ':')) + '\n')
+
+if __name__ == '__main__':
+    main()
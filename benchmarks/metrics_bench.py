@@ -0,0 +1,99 @@
+# Measures what recording metrics adds to each request the gateway proxies:
+# one request count and duration, and one upstream count and latency, first
+# from one thread, then from many threads at once. Checks that no update was
+# lost under contention, and times rendering /metrics.
+#
+# Usage: python -m benchmarks.metrics_bench [--threads 1 8 32] [--requests 200000]
+
+# Standard Imports
+import argparse
+import random
+import sys
+import threading
+import time
+import timeit
+
+# Local Imports
+from api_pkg.api_utils.metrics import GatewayMetrics
+from api_pkg.api_utils.svc_mgr import MicroServiceManager
+
+SVC_CONFIG = {
+    "USERS": {"PREFIX": "/api/v1/users", "PORT": 5100, "INSTANCES": 3},
+    "TIMELINES": {"PREFIX": "/api/v1/timelines", "PORT": 5200, "INSTANCES": 3},
+    "DMS": {"PREFIX": "/api/v1/dms", "PORT": 5300, "INSTANCES": 3},
+}
+
+def make_requests(count: int, seed: int) -> list:
+    ''' Returns (service, route, method, port, status, seconds) tuples like
+        the ones a gateway would record. '''
+    rng = random.Random(seed)
+    services = [(key, svc["PREFIX"], svc["PORT"]) for key, svc in SVC_CONFIG.items()]
+    requests = []
+    for _ in range(count):
+        key, prefix, port = rng.choice(services)
+        requests.append((
+            key, prefix, rng.choice(('GET', 'POST')), port + rng.randrange(3),
+            rng.choice((200, 200, 200, 201, 404, 500)), rng.expovariate(1 / 0.02),
+        ))
+    return requests
+
+def record(metrics: GatewayMetrics, requests: list) -> None:
+    for service, route, method, port, status_code, seconds in requests:
+        metrics.observe_request(service, route, method, status_code, seconds)
+        metrics.observe_upstream(service, port, status_code, seconds)
+
+def record_after(go: threading.Event, metrics: GatewayMetrics, requests: list) -> None:
+    go.wait()
+    record(metrics, requests)
+
+def record_concurrently(metrics: GatewayMetrics, requests: list, threads: int) -> float:
+    ''' Returns the seconds threads took to record requests each. '''
+    go = threading.Event()
+    workers = [threading.Thread(target=record_after, args=(go, metrics, requests)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    started = time.perf_counter()
+    go.set()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+def count_requests(text: str) -> int:
+    return sum(
+        int(float(line.rsplit(' ', 1)[1])) for line in text.splitlines()
+        if line.startswith('gateway_requests_total{')
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost of recording gateway metrics.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200000, help='requests recorded by each thread')
+    args = parser.parse_args()
+
+    svc_mgr = MicroServiceManager(SVC_CONFIG)
+    requests = make_requests(args.requests, seed=1)
+
+    # A bare loop over the same requests, to subtract from the timings
+    empty = min(timeit.repeat(lambda: [None for _ in requests], number=1, repeat=3))
+
+    lost = False
+    print('%8s  %16s  %18s' % ('threads', 'us per request', 'requests/s total'))
+    for threads in args.threads:
+        metrics = GatewayMetrics(svc_mgr)
+        seconds = record_concurrently(metrics, requests, threads)
+        total = threads * len(requests)
+        per_request = (seconds - empty * threads) / total
+        print('%8d  %16.2f  %18.0f' % (threads, per_request * 1e6, total / seconds))
+
+        recorded = count_requests(metrics.render())
+        if recorded != total:
+            print('  lost updates: recorded %d of %d requests' % (recorded, total))
+            lost = True
+
+    started = time.perf_counter()
+    text = metrics.render()
+    print('Rendering %d lines of metrics took %.2fms' % (len(text.splitlines()), (time.perf_counter() - started) * 1000))
+    sys.exit(1 if lost else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Times routing a request path to its service as the number of services
+# grows, comparing the old linear scan of every prefix with PrefixRouter.
+#
+# Usage: python -m benchmarks.router_bench [--services 3 30 300 3000]
+
+# Standard Imports
+import argparse
+import timeit
+
+# Local Imports
+from api_pkg.api_utils.router import PrefixRouter, Route
+
+def make_prefixes(count: int) -> list:
+    # The real services come last, so the linear scan sees every decoy first
+    decoys = ['/api/v1/svc%d' % i for i in range(count - 3)]
+    return decoys + ['/api/v1/users', '/api/v1/timelines', '/api/v1/dms']
+
+def linear_scan(prefixes: list, endpoint: str) -> str:
+    # How MicroServiceManager.get_service_type used to route
+    for prefix in prefixes:
+        if endpoint.find(prefix) == 0:
+            return prefix
+    return ""
+
+def main():
+    parser = argparse.ArgumentParser(description='Time service routing.')
+    parser.add_argument('--services', type=int, nargs='+', default=[3, 30, 300, 3000])
+    parser.add_argument('--number', type=int, default=100000, help='lookups per timing')
+    args = parser.parse_args()
+
+    paths = ['/api/v1/timelines/user1?limit=20', '/api/v1/dms/abc/replies', '/api/v1/nope']
+    print('%8s  %14s  %14s' % ('services', 'linear ns/op', 'trie ns/op'))
+    for count in args.services:
+        prefixes = make_prefixes(count)
+        router = PrefixRouter()
+        for prefix in prefixes:
+            router.add_route(Route(prefix, prefix))
+
+        # Both must agree before either is timed
+        for path in paths:
+            route = router.match(path)
+            assert linear_scan(prefixes, path) == (route.prefix if route else "")
+
+        timings = []
+        for lookup in (
+            lambda: [linear_scan(prefixes, path) for path in paths],
+            lambda: [router.match(path) for path in paths],
+        ):
+            seconds = min(timeit.repeat(lookup, number=args.number // len(paths), repeat=3))
+            timings.append(seconds / args.number * 1e9)
+        print('%8d  %14.0f  %14.0f' % (count, timings[0], timings[1]))
+
+if __name__ == '__main__':
+    main()
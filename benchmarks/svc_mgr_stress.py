@@ -0,0 +1,106 @@
+# Hammers MicroServiceManager from many threads at once: most threads pick
+# workers the way request threads do, while a few keep removing workers and
+# re-admitting them the way failing requests and the health checker do.
+#
+# Usage: python -m benchmarks.svc_mgr_stress [--threads 32] [--seconds 5]
+
+# Standard Imports
+import argparse
+from collections import Counter
+import random
+import sys
+import threading
+import time
+
+# Local Imports
+from api_pkg.api_utils.svc_mgr import MicroServiceManager
+
+SVC_CONFIG = {
+    "USERS": {"PREFIX": "/api/v1/users", "PORT": 5100, "INSTANCES": 3, "STRATEGY": "peak_ewma"},
+    "TIMELINES": {"PREFIX": "/api/v1/timelines", "PORT": 5200, "INSTANCES": 3},
+    "DMS": {"PREFIX": "/api/v1/dms", "PORT": 5300, "INSTANCES": 3, "STRATEGY": "least_outstanding"},
+}
+
+def pick_workers(svc_mgr, go, stop, picks, errors):
+    counts = Counter()
+    service_keys = list(SVC_CONFIG)
+    go.wait()
+    try:
+        while not stop.is_set():
+            for service_key in service_keys:
+                port = svc_mgr.get_worker(service_key)
+                if port != -1:
+                    svc_mgr.begin_request(service_key, port)
+                    svc_mgr.end_request(service_key, port, 0.001)
+                counts[(service_key, port)] += 1
+    except Exception as e:
+        errors.append(repr(e))
+    picks.append(counts)
+
+def churn_workers(svc_mgr, go, stop, errors):
+    rng = random.Random()
+    go.wait()
+    try:
+        while not stop.is_set():
+            service_key = rng.choice(list(SVC_CONFIG))
+            port = SVC_CONFIG[service_key]["PORT"] + rng.randrange(SVC_CONFIG[service_key]["INSTANCES"])
+            if rng.random() < 0.5:
+                svc_mgr.remove_worker(service_key, port)
+            else:
+                svc_mgr.report_success(service_key, port)
+            time.sleep(0.0001)
+    except Exception as e:
+        errors.append(repr(e))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=32, help='threads picking workers')
+    parser.add_argument('--churners', type=int, default=4, help='threads removing and re-admitting workers')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    # No open interval, so re-admission is immediate and the pools churn constantly
+    svc_mgr = MicroServiceManager(SVC_CONFIG, health_config={"OPEN_INTERVAL": 0})
+    go = threading.Event()
+    stop = threading.Event()
+    picks, errors = [], []
+
+    threads = [
+        threading.Thread(target=pick_workers, args=(svc_mgr, go, stop, picks, errors))
+        for _ in range(args.threads)
+    ] + [
+        threading.Thread(target=churn_workers, args=(svc_mgr, go, stop, errors))
+        for _ in range(args.churners)
+    ]
+    for thread in threads:
+        thread.start()
+    go.set()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    total = Counter()
+    for counts in picks:
+        total.update(counts)
+    calls = sum(total.values())
+    print('get_worker calls: %d (%.0f/s) across %d threads' % (calls, calls / args.seconds, args.threads))
+    for service_key in SVC_CONFIG:
+        dist = {port: n for (svc, port), n in sorted(total.items()) if svc == service_key}
+        print('  %-10s %s' % (service_key, dist))
+
+    in_flight = {
+        svc: {port: stats['in_flight'] for port, stats in ports.items()}
+        for svc, ports in svc_mgr.get_load_stats().items()
+    }
+    leaked = any(n != 0 for ports in in_flight.values() for n in ports.values())
+    print('in flight after the run:', in_flight)
+    print('errors:', len(errors))
+    for error in errors[:10]:
+        print('  ' + error)
+
+    if errors or leaked:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Posts tweets for the same author from many threads at once through the
+# timelines service, then checks that the ID each response gave is the ID
+# the tweet was stored under, and that no two tweets share one.
+#
+# Usage: python -m benchmarks.tweet_ids_stress [--threads 16] [--tweets 50]
+
+# Standard Imports
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+def post_tweets(client, thread, count, go, results, errors):
+    go.wait()
+    try:
+        for i in range(count):
+            content = 'thread %d tweet %d' % (thread, i)
+            response = client.post('/api/v1/timelines/user1/home', json={'content_text': content})
+            if response.status_code != 201:
+                errors.append('%d %s' % (response.status_code, response.get_data(as_text=True)))
+                continue
+            results.append((content, response.json['id']))
+    except Exception as e:
+        errors.append(repr(e))
+
+def main():
+    parser = argparse.ArgumentParser(description='Check tweet IDs under concurrent posts by one author.')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--tweets', type=int, default=50, help='tweets posted by each thread')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'MBS.db')
+    config_path = os.path.join(workdir, 'api.cfg')
+    with open(config_path, 'w') as f:
+        f.write('DATABASE_URL = %r\n' % ('sqlite:///' + db_path))
+    with open('api_pkg/services/MBS.sql') as f:
+        db = sqlite3.connect(db_path)
+        db.executescript(f.read())
+        db.close()
+
+    # The service reads its config when imported
+    os.environ['TIMELINES_APP_CONFIG'] = config_path
+    from api_pkg.services import timelines_api
+
+    go = threading.Event()
+    results, errors = [], []
+    threads = [
+        threading.Thread(
+            target=post_tweets,
+            args=(timelines_api.app.test_client(), i, args.tweets, go, results, errors)
+        )
+        for i in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    go.set()
+    for thread in threads:
+        thread.join()
+
+    db = sqlite3.connect(db_path)
+    stored = dict(db.execute(
+        'SELECT content_text, tweets.id FROM tweets, users '
+        'WHERE tweets.author_id = users.id AND username = ?', ('user1',)
+    ))
+    wrong = [(content, given, stored.get(content)) for content, given in results if stored.get(content) != given]
+    given_ids = [given for _, given in results]
+
+    print('Tweets posted: %d, failed: %d' % (len(results), len(errors)))
+    print('IDs not matching the stored tweet: %d' % len(wrong))
+    print('IDs given out more than once: %d' % (len(given_ids) - len(set(given_ids))))
+    for content, given, actual in wrong[:5]:
+        print('  %r was given %s but stored as %s' % (content, given, actual))
+    for error in errors[:5]:
+        print('  error:', error)
+    sys.exit(1 if wrong or errors or len(given_ids) != len(set(given_ids)) else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Posts tweets for the same author from many threads at once through the
+# timelines service, and checks that the ID each response gave is the ID the
+# tweet was stored under, and that no two tweets share one. See also
+# benchmarks/tweet_ids_stress.py, which does the same with more tweets.
+
+# Standard Imports
+import os
+import sqlite3
+import threading
+
+# Third-Party Imports
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THREADS = 8
+TWEETS_PER_THREAD = 25
+
+@pytest.fixture
+def timelines(tmp_path, monkeypatch):
+    ''' The timelines app, on a fresh database seeded from MBS.sql. '''
+    db_path = str(tmp_path / 'MBS.db')
+    config_path = tmp_path / 'api.cfg'
+    config_path.write_text('DATABASE_URL = %r\n' % ('sqlite:///' + db_path))
+    db = sqlite3.connect(db_path)
+    with open(os.path.join(ROOT, 'api_pkg/services/MBS.sql')) as f:
+        db.executescript(f.read())
+    db.close()
+
+    # The service reads its config when imported, and its queries from
+    # paths relative to the repository
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setenv('TIMELINES_APP_CONFIG', str(config_path))
+    from api_pkg.services import timelines_api
+    return timelines_api.app, db_path
+
+def post_tweets(client, thread, go, results, errors):
+    go.wait()
+    try:
+        for i in range(TWEETS_PER_THREAD):
+            content = 'thread %d tweet %d' % (thread, i)
+            response = client.post('/api/v1/timelines/user1/home', json={'content_text': content})
+            if response.status_code != 201:
+                errors.append('%d %s' % (response.status_code, response.get_data(as_text=True)))
+                continue
+            results.append((content, response.json['id']))
+    except Exception as e:
+        errors.append(repr(e))
+
+def test_concurrent_tweets_get_their_stored_ids(timelines):
+    app, db_path = timelines
+    go = threading.Event()
+    results, errors = [], []
+    threads = [
+        threading.Thread(target=post_tweets, args=(app.test_client(), i, go, results, errors))
+        for i in range(THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    go.set()
+    for thread in threads:
+        thread.join()
+
+    db = sqlite3.connect(db_path)
+    stored = dict(db.execute(
+        'SELECT content_text, tweets.id FROM tweets, users '
+        'WHERE tweets.author_id = users.id AND username = ?', ('user1',)
+    ))
+    db.close()
+
+    assert errors == []
+    assert len(results) == THREADS * TWEETS_PER_THREAD
+    assert [(content, given) for content, given in results if stored.get(content) != given] == []
+    given_ids = [given for _, given in results]
+    assert len(given_ids) == len(set(given_ids))